@@ -0,0 +1,196 @@
+import os
+import csv
+import json
+import pickle
+import fnmatch
+import warnings
+from dataclasses import dataclass, field
+import numpy as np
+from numpy.typing import NDArray
+from colors import *
+
+# Statistics over many processed runs of the same experiment (repeatability studies).
+# Only each run's cost curve is read: process writes <bag>/<bag>_cost.npz next to the
+# processed pickle, so dozens of runs load without touching their map stacks. Bags
+# processed before the curve file existed fall back to loading the full pickle.
+#
+# Runs are grouped with selectors: a glob over bag names ("0621_10r_*") or "tag:NAME",
+# which matches bags whose directory has a tags.txt listing NAME (one tag per line).
+
+COST_CURVE_SUFFIX = "_cost.npz"
+TAGS_FILE = "tags.txt"
+
+def cost_curve_path(bag_dir: str, b: str) -> str:
+    return bag_dir + "/" + b + COST_CURVE_SUFFIX
+
+def save_cost_curve(path: str,
+                    t_fine: NDArray[np.float32],
+                    normalized_cost: NDArray[np.float64]
+                    ):
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, t_fine=t_fine, normalized_cost=normalized_cost)
+    os.replace(tmp_path, path)
+
+def load_cost_curve(bag_dir: str, b: str) -> tuple[NDArray[np.float64], NDArray[np.float64]]:
+    path = cost_curve_path(bag_dir, b)
+    if os.path.isfile(path):
+        with np.load(path) as curve:
+            return curve["t_fine"].astype(np.float64), curve["normalized_cost"].astype(np.float64)
+    pkl_path = bag_dir + "/" + b + "_processed.pkl"
+    printC(f"Warning: {path} not found, loading the full {pkl_path} (rerun process to write it)", YELLOW)
+    with open(pkl_path, "rb") as f:
+        pb = pickle.load(f)
+    return np.asarray(pb.t_fine, dtype=np.float64), np.asarray(pb.normalized_cost, dtype=np.float64)
+
+def read_tags(bag_dir: str) -> set[str]:
+    path = bag_dir + "/" + TAGS_FILE
+    if not os.path.isfile(path):
+        return set()
+    with open(path, "r") as f:
+        return {line.strip() for line in f if line.strip() and not line.startswith("#")}
+
+def parse_group(spec: str) -> tuple[str, list[str]]:
+    # "LABEL=SELECTOR[,SELECTOR...]"; a bare selector is its own label
+    label, sep, selectors = spec.partition("=")
+    if not sep:
+        return spec, [spec]
+    return label, [s for s in selectors.split(",") if s]
+
+def matches(bag_dir: str, b: str, selectors: list[str]) -> bool:
+    for selector in selectors:
+        if selector.startswith("tag:"):
+            if selector[4:] in read_tags(bag_dir):
+                return True
+        elif fnmatch.fnmatchcase(b, selector):
+            return True
+    return False
+
+def group_index(dir: str, b: str, groups: list[tuple[str, list[str]]]) -> int | None:
+    # Index of the first group the bag belongs to
+    for i, (_, selectors) in enumerate(groups):
+        if matches(dir + "/" + b, b, selectors):
+            return i
+    return None
+
+def select_groups(dir: str, groups: list[tuple[str, list[str]]]) -> dict[str, list[str]]:
+    # Only bags that have been processed are considered; a bag may belong to several groups
+    bags = sorted(b for b in os.listdir(dir)
+                  if os.path.isfile(cost_curve_path(dir + "/" + b, b))
+                  or os.path.isfile(dir + "/" + b + "/" + b + "_processed.pkl"))
+    return {label: [b for b in bags if matches(dir + "/" + b, b, selectors)] for label, selectors in groups}
+
+def common_grid(curves: list[tuple[NDArray, NDArray]], dt: float, horizon: str = "shortest") -> NDArray[np.float64]:
+    # Time grid from 0 to the end of the shortest run (every run defined everywhere)
+    # or of the longest run (shorter runs are missing past their end)
+    ends = np.array([t[-1] - t[0] for t, _ in curves])
+    end = ends.min() if horizon == "shortest" else ends.max()
+    return np.arange(int(np.floor(end / dt + 1e-9)) + 1) * dt
+
+def resample(curves: list[tuple[NDArray, NDArray]], grid: NDArray[np.float64]) -> NDArray[np.float64]:
+    # (runs, len(grid)) costs, linearly interpolated, NaN past the end of a run
+    resampled = np.empty((len(curves), grid.shape[0]), dtype=np.float64)
+    for i, (t, cost) in enumerate(curves):
+        t = t - t[0]
+        resampled[i] = np.interp(grid, t, cost, right=np.nan)
+    return resampled
+
+def time_to_threshold(resampled: NDArray[np.float64], grid: NDArray[np.float64], threshold: float) -> NDArray[np.float64]:
+    # First grid time each run's cost is at or below threshold, NaN if it never is
+    below = resampled <= threshold # NaN compares False
+    first = np.argmax(below, axis=1)
+    return np.where(below.any(axis=1), grid[first], np.nan)
+
+@dataclass
+class GroupStats:
+    label: str
+    bags: list[str]
+    grid: NDArray[np.float64]
+    mean: NDArray[np.float64]
+    std: NDArray[np.float64]
+    percentiles: dict[float, NDArray[np.float64]]
+    runs: NDArray[np.float64] # (runs, len(grid))
+    final_cost: NDArray[np.float64] # last recorded cost of each run
+    time_to_threshold: dict[float, NDArray[np.float64]] = field(default_factory=dict)
+
+def aggregate(label: str,
+              bags: list[str],
+              curves: list[tuple[NDArray, NDArray]],
+              dt: float = 0.1,
+              percentiles: list[float] = [10., 50., 90.],
+              thresholds: list[float] = [0.5],
+              horizon: str = "shortest"
+              ) -> GroupStats:
+    grid = common_grid(curves, dt, horizon)
+    runs = resample(curves, grid)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) # all-NaN columns, only with the longest horizon
+        mean = np.nanmean(runs, axis=0)
+        std = np.nanstd(runs, axis=0)
+        bands = np.nanpercentile(runs, percentiles, axis=0)
+    final_cost = np.array([cost[-1] for _, cost in curves], dtype=np.float64)
+    stats = GroupStats(label, bags, grid, mean, std, dict(zip(percentiles, bands)), runs, final_cost)
+    for threshold in thresholds:
+        stats.time_to_threshold[threshold] = time_to_threshold(runs, grid, threshold)
+    return stats
+
+def summary(stats: GroupStats) -> dict:
+    def number(x) -> float | None:
+        return None if np.isnan(x) else float(x)
+    final = stats.final_cost
+    out = {"bags": stats.bags,
+           "runs": len(stats.bags),
+           "duration_s": float(stats.grid[-1]),
+           "final_cost": {"mean": number(np.nanmean(final)), "std": number(np.nanstd(final)),
+                          "per_run": dict(zip(stats.bags, map(number, final)))},
+           "time_to_threshold": {}
+           }
+    for threshold, times in stats.time_to_threshold.items():
+        reached = ~np.isnan(times)
+        out["time_to_threshold"][str(threshold)] = {
+                "reached": int(reached.sum()),
+                "mean_s": number(times[reached].mean()) if reached.any() else None,
+                "median_s": number(np.median(times[reached])) if reached.any() else None,
+                "max_s": number(times[reached].max()) if reached.any() else None,
+                "per_run": dict(zip(stats.bags, map(number, times)))
+                }
+    return out
+
+def write_group_csv(path: str, stats: GroupStats):
+    columns = {"t": stats.grid, "mean": stats.mean, "std": stats.std}
+    columns.update({f"p{p:g}": band for p, band in stats.percentiles.items()})
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(list(columns.keys()))
+        writer.writerows(np.column_stack(list(columns.values())))
+
+def aggregate_dir(dir: str,
+                  groups: list[tuple[str, list[str]]],
+                  save_dir: str,
+                  dt: float = 0.1,
+                  percentiles: list[float] = [10., 50., 90.],
+                  thresholds: list[float] = [0.5],
+                  horizon: str = "shortest"
+                  ) -> list[GroupStats]:
+    # Writes aggregate_<label>.csv per group and aggregate_summary.json to save_dir
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+    selected = select_groups(dir, groups)
+    curves = {}
+    results = []
+    report = {"dt": dt, "horizon": horizon, "percentiles": percentiles, "groups": {}}
+    for label, bags in selected.items():
+        if len(bags) == 0:
+            printC(f"Warning: group {label} matched no processed bags", YELLOW)
+            continue
+        for b in bags:
+            if b not in curves: # groups may share bags
+                curves[b] = load_cost_curve(dir + "/" + b, b)
+        stats = aggregate(label, bags, [curves[b] for b in bags], dt, percentiles, thresholds, horizon)
+        write_group_csv(save_dir + "/aggregate_" + label + ".csv", stats)
+        report["groups"][label] = summary(stats)
+        printC(f"{label}: {len(bags)} runs over {stats.grid[-1]:.1f}s", GREEN)
+        results.append(stats)
+    with open(save_dir + "/aggregate_summary.json", "w") as f:
+        json.dump(report, f, indent=2)
+    printC(f"Summary written to {save_dir}/aggregate_summary.json", BLUE)
+    return results
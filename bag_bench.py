@@ -0,0 +1,247 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from colors import *
+import bag_synth
+
+# Benchmarks baggy.py stages on synthetic bags (see bag_synth.py).
+# Every stage runs in a fresh process with --profile, and the per-bag profile report
+# supplies wall time, CPU time, peak RSS and item counts. Results are written to
+# <work dir>/bench_results.json; with --baseline a stage fails when its wall time
+# exceeds the stored one by more than --threshold.
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+BAGGY = SOURCE_DIR + "/baggy.py"
+
+BENCH_SIZES = {
+        "small": {"duration": 60., "num_robots": 4},
+        "medium": {"duration": 300., "num_robots": 8},
+        "large": {"duration": 1200., "num_robots": 16}
+        }
+BENCH_STAGES = ["extract", "process", "plot"]
+
+# Profile stage whose item count is the stage's throughput unit
+THROUGHPUT_ITEMS = {
+        "extract": ("extract/messages", "msgs/s"),
+        "process": ("process/cost", "poses/s"),
+        "plot": ("plot/system_maps", "frames/s")
+        }
+
+def bench_bag_name(size: str) -> str:
+    return "bench_" + size
+
+def ensure_bag(work_dir: str, size: str, regenerate: bool = False) -> str:
+    # Like field bags, stage outputs are written inside the bag directory
+    bag_name = bench_bag_name(size)
+    bag_path = work_dir + "/" + bag_name
+    if regenerate or not os.path.isfile(bag_path + "/metadata.yaml"):
+        printC(f"Generating {size} synthetic bag at {bag_path}...", BLUE, end="")
+        start = time.perf_counter()
+        num_msgs = bag_synth.generate_bag(bag_path, overwrite=True, **BENCH_SIZES[size])
+        printC(f"Done! ({num_msgs} messages, {time.perf_counter() - start:.1f}s)", GREEN)
+    return bag_name
+
+def stage_command(args, stage: str, bag_name: str) -> list[str]:
+    bag_dir = args.work_dir + "/" + bag_name
+    cmd = [sys.executable, BAGGY, stage, "-d", args.work_dir, "-s", bag_name, "--force", "--profile"]
+    if stage in ["process", "plot"]:
+        cmd += ["-p", args.params, "-i", args.idf]
+    if stage == "plot":
+        cmd += ["-o", bag_dir + "/plots", "-c", "red", "-r", str(args.render_jobs)]
+    return cmd + args.stage_args.get(stage, [])
+
+def run_stage(args, stage: str, bag_name: str) -> dict | None:
+    # Fresh process per run so imports, caches and peak RSS are not shared between stages
+    bag_dir = args.work_dir + "/" + bag_name
+    log_path = bag_dir + "/" + bag_name + "_bench_" + stage + ".log"
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        proc = subprocess.run(stage_command(args, stage, bag_name), stdout=log, stderr=subprocess.STDOUT)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        printC(f"Error: {stage} failed on {bag_name}, see {log_path}", RED)
+        return None
+    with open(bag_dir + "/" + bag_name + "_" + stage + "_profile.json", "r") as f:
+        report = json.load(f)
+    stages = {row["stage"]: row for row in report["stages"]}
+    top = stages[stage]
+    items_stage, unit = THROUGHPUT_ITEMS[stage]
+    items = stages[items_stage]["items"] if items_stage in stages else 0
+    return {"wall_s": top["wall_s"],
+            "cpu_s": top["cpu_s"],
+            "process_s": elapsed, # including interpreter start-up and imports
+            "import_s": report.get("import_s", 0.),
+            "peak_rss_mb": top["peak_rss_mb"],
+            "items": items,
+            "throughput": items / top["wall_s"] if top["wall_s"] > 0 else 0.,
+            "unit": unit
+            }
+
+def best_of(runs: list[dict]) -> dict:
+    # Minimum wall time over repeats is the least noisy estimate
+    return min(runs, key=lambda r: r["wall_s"])
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        limit = baseline[key]["wall_s"] * (1. + threshold)
+        if result["wall_s"] > limit:
+            regressions.append(key)
+    return regressions
+
+def print_results(results: dict, baseline: dict | None):
+    print("-" * 105)
+    print(f"{'benchmark':<22}{'wall s':>9}{'import s':>9}{'cpu s':>9}{'peak MB':>9}{'items':>9}{'throughput':>18}{'vs baseline':>14}")
+    print("-" * 105)
+    for key, r in results.items():
+        ratio = ""
+        if baseline is not None and key in baseline:
+            ratio = f"{r['wall_s'] / baseline[key]['wall_s']:.2f}x"
+        throughput = f"{r['throughput']:.1f} {r['unit']}"
+        print(f"{key:<22}{r['wall_s']:>9.2f}{r['import_s']:>9.2f}{r['cpu_s']:>9.2f}{r['peak_rss_mb']:>9.1f}{r['items']:>9}{throughput:>18}{ratio:>14}")
+    print("-" * 105)
+
+def machine_info() -> dict:
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count()
+            }
+
+def main(args):
+    os.makedirs(args.work_dir, exist_ok=True)
+    args.work_dir = os.path.abspath(args.work_dir)
+    if any(stage != "extract" for stage in args.stages) and (args.params is None or args.idf is None):
+        printC("Error: process and plot benchmarks need --params and --idf. Exiting...", RED)
+        exit(1)
+    args.stage_args = {stage: getattr(args, stage + "_args").split() for stage in BENCH_STAGES}
+
+    results = {}
+    failed = False
+    for size in args.sizes:
+        bag_name = ensure_bag(args.work_dir, size, args.regenerate)
+        for stage in BENCH_STAGES:
+            if stage not in args.stages:
+                continue
+            runs = []
+            for i in range(args.repeat):
+                printC(f"{size}/{stage} run {i + 1}/{args.repeat}...", BLUE, end="")
+                run = run_stage(args, stage, bag_name)
+                if run is None:
+                    failed = True
+                    break
+                printC(f"{run['wall_s']:.2f}s", GREEN)
+                runs.append(run)
+            if len(runs) == 0:
+                break # later stages need this one's output
+            results[size + "/" + stage] = best_of(runs)
+
+    baseline = None
+    if args.baseline is not None and os.path.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+
+    report = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "machine": machine_info(), "results": results}
+    with open(args.work_dir + "/bench_results.json", "w") as f:
+        json.dump(report, f, indent=2)
+    printC(f"Results written to {args.work_dir}/bench_results.json", BLUE)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        printC(f"Baseline saved to {args.baseline}", GREEN)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for key in regressions:
+            printC(f"Regression: {key} took {results[key]['wall_s']:.2f}s, baseline {baseline[key]['wall_s']:.2f}s "
+                   f"(threshold +{args.threshold * 100:.0f}%)", RED)
+        if len(regressions) > 0:
+            failed = True
+        else:
+            printC("No regressions against the baseline", GREEN)
+    if failed:
+        exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="bag_bench.py",
+                                     description="Benchmarks baggy.py stages on synthetic bags"
+                                     )
+    parser.add_argument("-w",
+                        "--work-dir",
+                        type=str,
+                        default="/tmp/baggy_bench",
+                        help="Where synthetic bags and their outputs are kept. default: /tmp/baggy_bench"
+                        )
+    parser.add_argument("--sizes",
+                        type=str,
+                        nargs="+",
+                        choices=list(BENCH_SIZES.keys()),
+                        default=["small"],
+                        help="Synthetic bag sizes to benchmark. default: small"
+                        )
+    parser.add_argument("--stages",
+                        type=str,
+                        nargs="+",
+                        choices=BENCH_STAGES,
+                        default=BENCH_STAGES,
+                        help="Stages to benchmark, in pipeline order. default: all"
+                        )
+    parser.add_argument("-p",
+                        "--params",
+                        type=str,
+                        default=None,
+                        help="Coverage control parameters file (process and plot)"
+                        )
+    parser.add_argument("-i",
+                        "--idf",
+                        type=str,
+                        default=None,
+                        help="IDF file (process and plot)"
+                        )
+    parser.add_argument("-n",
+                        "--repeat",
+                        type=int,
+                        default=1,
+                        help="Runs per stage, the fastest is kept. default: 1"
+                        )
+    parser.add_argument("-r",
+                        "--render-jobs",
+                        type=int,
+                        default=1,
+                        help="Render workers for the plot stage. default: 1"
+                        )
+    parser.add_argument("--extract-args", type=str, default="", help="Extra baggy.py extract arguments, e.g. '--stream'")
+    parser.add_argument("--process-args", type=str, default="", help="Extra baggy.py process arguments")
+    parser.add_argument("--plot-args", type=str, default="", help="Extra baggy.py plot arguments")
+    parser.add_argument("-b",
+                        "--baseline",
+                        type=str,
+                        default=None,
+                        help="Baseline results JSON to compare against"
+                        )
+    parser.add_argument("--save-baseline",
+                        action="store_true",
+                        help="Store this run's results as the baseline instead of comparing"
+                        )
+    parser.add_argument("-t",
+                        "--threshold",
+                        type=float,
+                        default=0.2,
+                        help="Allowed slowdown relative to the baseline before failing. default: 0.2 (20%%)"
+                        )
+    parser.add_argument("--regenerate",
+                        action="store_true",
+                        help="Rewrite the synthetic bags even if they exist"
+                        )
+    args = parser.parse_args()
+    if args.save_baseline and args.baseline is None:
+        printC("Error: --save-baseline needs --baseline FILE. Exiting...", RED)
+        exit(1)
+    main(args)
@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+import time
+
+# Per-bag manifest recording the hashed inputs of each pipeline stage:
+#   <bag>/<bag>_manifest.json = {"stages": {stage: {"key", "inputs", "outputs", "time"}}}
+# A stage is skipped when its key matches the recorded one and its outputs still exist.
+# Downstream stages include the upstream key in their inputs, so rerunning extract with
+# different inputs invalidates process and plot as well.
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def file_hash(path: str | None, chunk_size: int = 1 << 20) -> str | None:
+    if path is None or not os.path.isfile(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def code_hash(modules: list[str]) -> str:
+    # "Code version" of a stage: the sources of the modules it runs
+    h = hashlib.sha256()
+    for module in sorted(modules):
+        h.update(module.encode())
+        h.update((file_hash(SOURCE_DIR + "/" + module + ".py") or "").encode())
+    return h.hexdigest()
+
+def path_fingerprint(path: str) -> str | None:
+    # Cheap stand-in for outputs produced before the manifest existed
+    if not os.path.exists(path):
+        return None
+    stats = []
+    if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            for fn in sorted(files):
+                st = os.stat(os.path.join(root, fn))
+                stats.append((os.path.relpath(os.path.join(root, fn), path), st.st_size, st.st_mtime_ns))
+    else:
+        st = os.stat(path)
+        stats.append((os.path.basename(path), st.st_size, st.st_mtime_ns))
+    return hash_bytes(json.dumps(sorted(stats)).encode())
+
+def stage_key(inputs: dict) -> str:
+    return hash_bytes(json.dumps(inputs, sort_keys=True).encode())
+
+def manifest_path(bag_dir: str, bag_name: str) -> str:
+    return bag_dir + "/" + bag_name + "_manifest.json"
+
+def load_manifest(bag_dir: str, bag_name: str) -> dict:
+    path = manifest_path(bag_dir, bag_name)
+    if not os.path.isfile(path):
+        return {"stages": {}}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return {"stages": {}}
+
+def save_manifest(bag_dir: str, bag_name: str, manifest: dict):
+    path = manifest_path(bag_dir, bag_name)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def recorded_key(bag_dir: str, bag_name: str, stage: str) -> str | None:
+    entry = load_manifest(bag_dir, bag_name)["stages"].get(stage)
+    return None if entry is None else entry["key"]
+
+def is_fresh(bag_dir: str,
+             bag_name: str,
+             stage: str,
+             key: str,
+             outputs: list[str]
+             ) -> bool:
+    entry = load_manifest(bag_dir, bag_name)["stages"].get(stage)
+    if entry is None or entry["key"] != key:
+        return False
+    return all(os.path.exists(p) for p in outputs)
+
+def record(bag_dir: str,
+           bag_name: str,
+           stage: str,
+           key: str,
+           inputs: dict,
+           outputs: list[str]
+           ):
+    manifest = load_manifest(bag_dir, bag_name)
+    manifest["stages"][stage] = {
+            "key": key,
+            "inputs": inputs,
+            "outputs": outputs,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+            }
+    save_manifest(bag_dir, bag_name, manifest)
@@ -0,0 +1,380 @@
+import os
+import re
+import json
+import time
+import sqlite3
+from collections import deque
+from dataclasses import dataclass
+import numpy as np
+from numpy.typing import NDArray
+from rosbags.rosbag2 import Reader
+from rosbags.typesys import get_types_from_msg
+import coverage_control
+import bag_reader
+import msg_handlers
+import bag_utils as utils
+from system_maps import SystemMaps
+from colors import *
+
+# Online view of a flight: coverage cost and the latest system map, updated while a bag
+# is still being recorded (SqliteTailSource) or while a finished bag is replayed at a
+# chosen speed (ReplaySource, for testing on the ground).
+#
+# Latency stays bounded because each poll is coalesced before any heavy work: every
+# mission_control message is applied (its edges matter), but only the newest robot
+# positions and system map of the poll are evaluated. With a fixed poll period the work
+# per poll is one objective evaluation and one map binning, whatever the message rate.
+#
+# Outputs in the output directory:
+#   <bag>_live_cost.csv     bag time, mission time and normalized cost of each evaluation
+#   <bag>_live_status.json  latest state, rewritten every poll
+#   <bag>_live_map.png      latest system map with robot positions, at most every render_period
+
+POSITION_HISTORY = 1024 # recent robot positions kept to look up the takeoff reference
+LIVE_TOPICS = ["/mission_control", "/sim/all_robot_positions", "/sim/global_map", "/sim/system_map"]
+
+@dataclass(frozen=True)
+class LiveConnection:
+    # The subset of rosbags' Connection used by bag_reader.extract_topic
+    id: int
+    topic: str
+    msgtype: str
+
+def register_msgdefs(msgdefs: dict[str, str]):
+    # Custom message definitions recorded in the bag, registered in bag_reader's typestore
+    typs = {}
+    for msgtype, msgdef in msgdefs.items():
+        if msgdef:
+            typs.update(get_types_from_msg(msgdef, msgtype))
+    bag_reader.typestore.register(typs)
+
+class ReplaySource:
+    # Replays a finished bag in bag-time order. rate is the speed-up over real time;
+    # 0 replays as fast as the processor keeps up.
+    def __init__(self, bag_path: str, rate: float = 1.):
+        self.bag_path = bag_path
+        self.rate = rate
+
+    def batches(self, poll_period: float):
+        with Reader(self.bag_path) as reader:
+            register_msgdefs({c.msgtype: c.msgdef.data for c in reader.connections})
+            connections = [c for c in reader.connections
+                           if c.topic in LIVE_TOPICS and msg_handlers.is_supported(c.msgtype)]
+            if len(connections) == 0: # rosbags would read every connection
+                printC(f"Warning: {self.bag_path} has none of the live topics {', '.join(LIVE_TOPICS)}", YELLOW)
+                return
+            # Each batch spans what a recorder would have written during one poll period
+            span = poll_period * (self.rate if self.rate > 0 else 1.) * 1e9
+            wall_start = time.perf_counter()
+            batch = []
+            batch_end = reader.start_time + span
+            for connection, timestamp, rawdata in reader.messages(connections=connections):
+                if timestamp > batch_end and len(batch) > 0:
+                    self.wait_until(wall_start, (batch[-1][1] - reader.start_time) / 1e9)
+                    yield batch
+                    batch = []
+                    batch_end = timestamp + span
+                batch.append((connection, timestamp, rawdata))
+            if len(batch) > 0:
+                self.wait_until(wall_start, (batch[-1][1] - reader.start_time) / 1e9)
+                yield batch
+
+    def wait_until(self, wall_start: float, bag_elapsed: float):
+        if self.rate <= 0:
+            return
+        delay = wall_start + bag_elapsed / self.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+def db3_files(bag_dir: str) -> list[str]:
+    # rosbag2 splits recordings into <name>_0.db3, <name>_1.db3, ...
+    files = [f for f in os.listdir(bag_dir) if f.endswith(".db3")]
+    def split_index(fn: str) -> int:
+        match = re.search(r"_(\d+)\.db3$", fn)
+        return int(match.group(1)) if match else 0
+    return [bag_dir + "/" + f for f in sorted(files, key=split_index)]
+
+class SqliteTailSource:
+    # Polls the sqlite3 storage of a bag that is still being recorded. metadata.yaml is
+    # only written when recording stops, so topics and message definitions are read from
+    # the database itself. Messages are read by row id, i.e. in arrival order.
+    def __init__(self,
+                 bag_dir: str,
+                 idle_timeout: float = 30.,
+                 batch_limit: int = 20000
+                 ):
+        self.bag_dir = bag_dir
+        self.idle_timeout = idle_timeout
+        self.batch_limit = batch_limit
+        self.connections = {}
+        self.registered = set()
+
+    def open(self, path: str) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=5.)
+
+    def refresh_topics(self, db: sqlite3.Connection):
+        tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        msgdefs = {}
+        if "message_definitions" in tables:
+            for msgtype, msgdef in db.execute("SELECT topic_type, encoded_message_definition FROM message_definitions"):
+                if msgtype not in self.registered:
+                    msgdefs[msgtype] = msgdef
+        if len(msgdefs) > 0:
+            register_msgdefs(msgdefs)
+            self.registered.update(msgdefs.keys())
+        self.connections = {}
+        for topic_id, topic, msgtype in db.execute("SELECT id, name, type FROM topics"):
+            if topic in LIVE_TOPICS and msg_handlers.is_supported(msgtype):
+                self.connections[topic_id] = LiveConnection(topic_id, topic, msgtype)
+
+    def batches(self, poll_period: float):
+        file_idx = 0
+        last_id = 0
+        last_message = time.perf_counter()
+        db = None
+        while True:
+            files = db3_files(self.bag_dir) if os.path.isdir(self.bag_dir) else []
+            if db is None and file_idx < len(files):
+                db = self.open(files[file_idx])
+                last_id = 0
+            batch = []
+            if db is not None:
+                try:
+                    self.refresh_topics(db)
+                    ids = ",".join(str(i) for i in self.connections) or "-1"
+                    rows = db.execute(f"SELECT id, topic_id, timestamp, data FROM messages "
+                                      f"WHERE id > ? AND topic_id IN ({ids}) ORDER BY id LIMIT ?",
+                                      (last_id, self.batch_limit)
+                                      ).fetchall()
+                except sqlite3.OperationalError:
+                    rows = [] # tables not created yet, or the recorder holds a write lock
+                for row_id, topic_id, timestamp, data in rows:
+                    batch.append((self.connections[topic_id], timestamp, data))
+                    last_id = row_id
+                if len(rows) == 0 and file_idx + 1 < len(files):
+                    db.close() # the recorder moved on to the next split
+                    db = None
+                    file_idx += 1
+                    continue
+            if len(batch) > 0:
+                last_message = time.perf_counter()
+                yield batch
+                if len(batch) == self.batch_limit:
+                    continue # backlog, read on without sleeping
+            elif time.perf_counter() - last_message > self.idle_timeout:
+                if db is not None:
+                    db.close()
+                return
+            time.sleep(poll_period)
+
+class LiveProcessor:
+    def __init__(self,
+                 params_file: str,
+                 idf_file: str,
+                 save_dir: str,
+                 bag_name: str,
+                 color_scheme: dict,
+                 render_period: float = 2.
+                 ):
+        self.cc_parameters = coverage_control.Parameters(params_file)
+        self.idf_file = idf_file
+        self.world_size = int(self.cc_parameters.pWorldMapSize)
+        self.save_dir = save_dir
+        self.bag_name = bag_name
+        self.color_scheme = color_scheme
+        self.render_period = render_period
+        self.cc_env = None
+        self.initial_cost = None
+        self.takeoff_time = None
+        self.mission_start = None
+        self.land_time = None
+        self.mission_state = None
+        self.t_mission = None
+        self.map_size = None
+        self.binning_factor = None
+        self.positions = None
+        self.t_positions = None
+        self.position_history = deque(maxlen=POSITION_HISTORY)
+        self.normalized_cost = None
+        self.system_map = None
+        self.t_system_map = None
+        self.last_render = -np.inf
+        self.counts = {"messages": 0, "cost_evals": 0, "maps": 0, "coalesced": 0}
+        self.latencies = []
+        os.makedirs(save_dir, exist_ok=True)
+        self.cost_file = open(self.path("_live_cost.csv"), "w")
+        self.cost_file.write("bag_time_s,mission_time_s,normalized_cost\n")
+
+    def path(self, suffix: str) -> str:
+        return self.save_dir + "/" + self.bag_name + suffix
+
+    def update(self, batch: list[tuple]):
+        poll_start = time.perf_counter()
+        latest = {}
+        for connection, timestamp, rawdata in batch:
+            if connection.topic not in LIVE_TOPICS:
+                continue
+            self.counts["messages"] += 1
+            if connection.topic == "/mission_control":
+                _, _, entry = bag_reader.extract_topic(connection, timestamp, rawdata)
+                if self.update_mission(*next(iter(entry.items()))):
+                    self.set_reference()
+            elif connection.topic == "/sim/all_robot_positions":
+                # Decoding positions is cheap; the history lets the takeoff reference be
+                # picked after the fact. Only the newest one is evaluated.
+                _, _, entry = bag_reader.extract_topic(connection, timestamp, rawdata)
+                if latest.pop(connection.topic, None) is not None:
+                    self.counts["coalesced"] += 1
+                self.position_history.append(next(iter(entry.items())))
+                latest[connection.topic] = self.position_history[-1]
+            elif connection.topic == "/sim/global_map" and self.map_size is not None:
+                continue
+            else:
+                if connection.topic in latest:
+                    self.counts["coalesced"] += 1
+                latest[connection.topic] = (connection, timestamp, rawdata)
+        # The global map sets the map grid, so it goes before a system map of the same poll
+        global_map = latest.pop("/sim/global_map", None)
+        if global_map is not None:
+            self.apply(*global_map)
+        for topic, message in latest.items():
+            if topic == "/sim/all_robot_positions":
+                self.update_cost(*message)
+            else:
+                self.apply(*message)
+        self.latencies.append(time.perf_counter() - poll_start)
+        self.render()
+        self.write_status()
+
+    def apply(self, connection, timestamp, rawdata):
+        _, _, entry = bag_reader.extract_topic(connection, timestamp, rawdata)
+        t, data = next(iter(entry.items()))
+        if connection.topic == "/sim/global_map":
+            self.map_size, self.binning_factor = utils.map_grid(self.cc_parameters, data)
+        elif connection.topic == "/sim/system_map" and self.map_size is not None:
+            self.system_map = SystemMaps.from_points([data], self.map_size, self.binning_factor, quantize=True)[0]
+            self.t_system_map = t
+            self.counts["maps"] += 1
+
+    def update_mission(self, t_ns: int, data: NDArray[bool]) -> bool:
+        # Same edges as utils.experiment_window: ob_takeoff (2) and ob_land (3) rising, timed
+        # at the last sample before the edge. Returns True on the takeoff edge.
+        takeoff = False
+        if self.mission_state is not None:
+            if data[2] and not self.mission_state[2] and self.takeoff_time is None:
+                self.takeoff_time = self.t_mission / 1e9
+                takeoff = True
+                printC(f"\nTakeoff at {self.takeoff_time:.2f}s", GREEN)
+            if data[3] and not self.mission_state[3] and self.land_time is None:
+                self.land_time = self.t_mission / 1e9
+                printC(f"\nLanding at {self.land_time:.2f}s", GREEN)
+        self.mission_state = data
+        self.t_mission = t_ns
+        return takeoff
+
+    def objective(self, positions: NDArray) -> float:
+        point_vector = coverage_control.PointVector(positions)
+        if self.cc_env is None:
+            self.cc_env = utils.create_cc_env(self.cc_parameters, self.idf_file, point_vector)
+            if not self.cc_env:
+                raise RuntimeError(f"Failed to create CoverageSystem from {self.idf_file}")
+        else:
+            self.cc_env.SetGlobalRobotPositions(point_vector)
+        self.counts["cost_evals"] += 1
+        return self.cc_env.GetObjectiveValue()
+
+    def set_reference(self):
+        # As in process_bag: normalize by the positions nearest the takeoff time, and
+        # count mission time from that sample
+        if len(self.position_history) == 0:
+            return
+        t_history = np.array([t for t, _ in self.position_history])
+        t_ref, positions = self.position_history[int(np.argmin(np.abs(t_history - self.takeoff_time)))]
+        self.initial_cost = self.objective(np.clip(positions, 1, self.world_size - 1))
+        self.mission_start = t_ref
+
+    def update_cost(self, t: float, positions: NDArray):
+        positions = np.clip(positions, 1, self.world_size - 1)
+        cost = self.objective(positions)
+        if self.initial_cost is None:
+            self.initial_cost = cost
+        self.normalized_cost = cost / self.initial_cost
+        self.positions = positions
+        self.t_positions = t
+        mission_time = t - self.mission_start if self.mission_start is not None else float("nan")
+        self.cost_file.write(f"{t:.6f},{mission_time:.6f},{self.normalized_cost:.8f}\n")
+        self.cost_file.flush()
+
+    def render(self):
+        now = time.perf_counter()
+        if self.system_map is None or now - self.last_render < self.render_period:
+            return
+        self.last_render = now
+        import matplotlib # only the live view needs it
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots(figsize=(4, 4))
+        ax.imshow(self.system_map, origin="lower", cmap=self.color_scheme["idf"], vmin=0., vmax=1.)
+        if self.positions is not None:
+            ax.scatter(self.positions[:, 0], self.positions[:, 1],
+                       c=self.color_scheme["robot"], marker=self.color_scheme["robot_marker"])
+        title = f"t = {self.t_system_map - (self.takeoff_time or self.t_system_map):.1f}s"
+        if self.normalized_cost is not None:
+            title += f", cost {self.normalized_cost:.3f}"
+        ax.set_title(title)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        fig.tight_layout()
+        tmp_path = self.path("_live_map.tmp.png")
+        fig.savefig(tmp_path)
+        plt.close(fig)
+        os.replace(tmp_path, self.path("_live_map.png")) # viewers never see a partial file
+
+    def status(self) -> dict:
+        latencies = np.array(self.latencies[-100:])
+        def number(x) -> float | None:
+            return None if x is None else float(x)
+        return {"bag": self.bag_name,
+                "t_positions": number(self.t_positions),
+                "t_system_map": number(self.t_system_map),
+                "takeoff_time": number(self.takeoff_time),
+                "land_time": number(self.land_time),
+                "normalized_cost": number(self.normalized_cost),
+                "num_robots": None if self.positions is None else int(self.positions.shape[0]),
+                "counts": self.counts,
+                "poll_latency_ms": {"mean": float(latencies.mean() * 1e3) if latencies.size else None,
+                                    "max": float(latencies.max() * 1e3) if latencies.size else None}
+                }
+
+    def write_status(self):
+        tmp_path = self.path("_live_status.tmp.json")
+        with open(tmp_path, "w") as f:
+            json.dump(self.status(), f, indent=2)
+        os.replace(tmp_path, self.path("_live_status.json"))
+
+    def close(self):
+        self.cost_file.close()
+        self.last_render = -np.inf
+        self.render()
+        self.write_status()
+
+def run_live(source,
+             processor: LiveProcessor,
+             poll_period: float = 0.5
+             ):
+    try:
+        for batch in source.batches(poll_period):
+            processor.update(batch)
+            cost = "-" if processor.normalized_cost is None else f"{processor.normalized_cost:.4f}"
+            printC(f"t={processor.t_positions or 0:.2f}s cost={cost} msgs={processor.counts['messages']} "
+                   f"latency={processor.latencies[-1] * 1e3:.1f}ms", BLUE, end="\r")
+    except KeyboardInterrupt:
+        printC("\nStopped", YELLOW)
+    finally:
+        processor.close()
+    latencies = np.array(processor.latencies) * 1e3
+    printC(f"\nDone! {processor.counts['cost_evals']} cost evaluations, {processor.counts['maps']} maps, "
+           f"{processor.counts['coalesced']} messages coalesced", GREEN)
+    if latencies.size > 0:
+        printC(f"Per-poll latency: mean {latencies.mean():.1f}ms, p99 {np.percentile(latencies, 99):.1f}ms, "
+               f"max {latencies.max():.1f}ms", GREEN)
@@ -4,6 +4,10 @@ import shutil
 import os
 from os.path import isdir
 import bag_utils as utils
+import frame_render
+import bag_cache
+import bag_profile
+import time_align
 from bag_utils import printC
 import re
 import numpy as np
@@ -18,12 +22,15 @@ from seaborn import plotting_context, axes_style
 from skimage.transform import resize
 from colors import *
 from bag_process import ProcessedBag
+from system_maps import SystemMaps
+from trajectories import Trajectories
 
 ONE_COLUMN_WIDTH = 3.5
 TWO_COLUMN_WIDTH = 7.16
 LEGEND_WIDTH = 0.5
 FIGURE_HEIGHT = 3.5
 FIGURE_HEIGHT_FLAT = 2
+BACKGROUND_CACHE_DIR = os.path.expanduser("~/.cache/baggy/backgrounds")
 
 def seaborn_colors(colors : list[str]) -> list[[float]]:
     sns_colors = []
@@ -77,17 +84,15 @@ def so_theme():
             "pdf.fonttype": 42,
         }
     )
-def plot_cost_helper(figsize: tuple[float, float],
+def cost_figure(figsize: tuple[float, float],
                 trace: tuple[NDArray[np.float32], NDArray[np.float32]],
                 point: tuple[np.float32, np.float32] | None,
-                save_dir: str,
-                filename: str,
                 color: str,
                 marker: str,
                 markersize: int,
                 x_label: str,
                 y_label: str,
-                ):
+                ) -> plt.Figure:
     fig, ax = plt.subplots(figsize=figsize)
     ax.plot(trace[0], trace[1], color=color) 
     if point is not None:
@@ -95,16 +100,65 @@ def plot_cost_helper(figsize: tuple[float, float],
     ax.set_xlabel(x_label)
     ax.set_ylabel(y_label)
     plt.tight_layout()
+    return fig
+
+def plot_cost_helper(figsize: tuple[float, float],
+                trace: tuple[NDArray[np.float32], NDArray[np.float32]],
+                point: tuple[np.float32, np.float32] | None,
+                save_dir: str,
+                filename: str,
+                color: str,
+                marker: str,
+                markersize: int,
+                x_label: str,
+                y_label: str,
+                ):
+    fig = cost_figure(figsize, trace, point, color, marker, markersize, x_label, y_label)
     utils.save_fig(fig, save_dir, filename)
     plt.close()
 
+class CostRenderer:
+    # Reuses one figure for every cost video frame: the trace and marker artists are
+    # updated in place with set_data. Limits follow the data like a fresh plot would,
+    # so the layout is recomputed from the default subplot params each frame.
+    def __init__(self, ctx: dict):
+        self.traces = ctx["traces"]
+        colors = ctx["colors"]
+        self.fig, self.ax = plt.subplots(figsize=ctx["figsize"])
+        self.lines = []
+        self.points = []
+        for j in range(len(self.traces)):
+            label = ctx["labels"][j] if ctx["labels"] is not None else None
+            line, = self.ax.plot([], [], color=colors[j % len(colors)], label=label)
+            point, = self.ax.plot([], [], color=colors[j % len(colors)], marker="o", markersize=3)
+            self.lines.append(line)
+            self.points.append(point)
+        if ctx["ylim"] is not None:
+            self.ax.set_ylim(*ctx["ylim"])
+        self.ax.set_xlabel(ctx["x_label"])
+        self.ax.set_ylabel(ctx["y_label"])
+        if ctx["legend_loc"] is not None:
+            self.ax.legend(loc=ctx["legend_loc"])
+
+    def render(self, i: int) -> NDArray[np.uint8]:
+        for (t_fine, normalized_cost), line, point in zip(self.traces, self.lines, self.points):
+            line.set_data(t_fine[:i], normalized_cost[:i])
+            point.set_data([t_fine[i]], [normalized_cost[i]])
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.fig.subplots_adjust(**{k: plt.rcParams["figure.subplot." + k]
+                                    for k in ["left", "right", "bottom", "top", "wspace", "hspace"]})
+        self.fig.tight_layout()
+        return frame_render.figure_to_frame(self.fig)
+
 def plot_cost(normalized_cost_arr: NDArray[np.float32],
               t_fine: NDArray[np.float32],
               save_dir: str,
               bag_name: str,
               colors: list[str],
               generate_video: bool = True,
-              save_times: list[float] = [0., 15., 30., 45., 60.]
+              save_times: list[float] = [0., 15., 30., 45., 60.],
+              render_jobs: int = 1
               ):
 
     printC(f"Plotting the cost function for all times...", BLUE, end="")
@@ -122,8 +176,8 @@ def plot_cost(normalized_cost_arr: NDArray[np.float32],
     printC("Done!", GREEN)
 
     printC(f"Plotting cost up to specific times from list {save_times}...", BLUE, end="")
-    for time in save_times:
-        i = np.argmin(np.abs(t_fine - time))
+    save_indices = time_align.nearest_index(t_fine, save_times)
+    for time, i in zip(save_times, save_indices):
         plot_cost_helper((ONE_COLUMN_WIDTH, FIGURE_HEIGHT),
                     trace = (t_fine[:i], normalized_cost_arr[:i]),
                     point = (t_fine[i], normalized_cost_arr[i]),
@@ -149,65 +203,50 @@ def plot_cost(normalized_cost_arr: NDArray[np.float32],
     printC("Done!", GREEN)
     
     if generate_video:
-        tmp_dir = save_dir + f"/{bag_name}_cost_tmp"
-        if not os.path.isdir(tmp_dir):
-            os.makedirs(tmp_dir)
-
         assert t_fine.shape[0] > 2
         fps = 1 / np.mean(np.diff(t_fine))
-        for i in range(t_fine.shape[0]):
-            printC(f"Plotting cost video frames ({i:06d} / {t_fine.shape[0]:06d})...", BLUE, end="\r", flush=True)
-            plot_cost_helper((TWO_COLUMN_WIDTH, FIGURE_HEIGHT_FLAT),
-                        trace = (t_fine[:i], normalized_cost_arr[:i]),
-                        point = (t_fine[i], normalized_cost_arr[i]),
-                        save_dir = tmp_dir,
-                        filename= f"{t_fine[i]:.2f}_{i:06d}",
-                        color="green",
-                        marker="o",
-                        markersize=3,
-                        x_label="Time (s)",
-                        y_label="Cost"
-                        )
-        printC("\nDone!", GREEN)
-
-        printC(f"Generating video...", BLUE, end="")
-        create_video(tmp_dir, save_dir + "/" + bag_name + "_cost.mp4", fps=fps)
-        printC("Done!", GREEN)
-
-        if os.path.exists(tmp_dir):
-            shutil.rmtree(tmp_dir)
-
-def plot_trajectory(robot_poses: list[coverage_control.PointVector],
+        ctx = {"traces": [(t_fine, normalized_cost_arr)],
+               "colors": ["green"],
+               "labels": None,
+               "figsize": (TWO_COLUMN_WIDTH, FIGURE_HEIGHT_FLAT),
+               "ylim": None,
+               "x_label": "Time (s)",
+               "y_label": "Cost",
+               "legend_loc": None
+               }
+        frame_render.render_video(CostRenderer,
+                                  ctx,
+                                  [(i,) for i in range(t_fine.shape[0])],
+                                  save_dir + "/" + bag_name + "_cost.mp4",
+                                  fps=fps,
+                                  jobs=render_jobs,
+                                  setup_fn=set_theme,
+                                  label="cost video"
+                                  )
+
+def plot_trajectory(robot_poses: Trajectories | NDArray[np.float32],
                     save_dir: str,
                     bag_name: str,
                     colors: list[str]
                     ):
+    # robot_poses is a trajectory store or a (T, robots, 2) array such as ProcessedBag.robot_poses
+    if not isinstance(robot_poses, Trajectories):
+        poses = np.swapaxes(np.asarray(robot_poses), 0, 1)
+        robot_poses = Trajectories([str(i) for i in range(poses.shape[0])], np.arange(poses.shape[1]),
+                                   poses, np.full(poses.shape[0], poses.shape[1]))
     fig, ax = plt.subplots(figsize=(ONE_COLUMN_WIDTH, FIGURE_HEIGHT))
     save_fn = save_dir + "/" + bag_name + "_traj.png"
     printC(f"Plotting the trajectories and saving to {save_fn}...", BLUE, end="")
-    # Get the trajectories
-    total_steps = len(robot_poses)
-    for i in range(0, len(robot_poses[0])):
-        data_arr = np.empty((total_steps, 2), dtype=np.float64)
-        for t in range(0, total_steps):
-            data_arr[t] = robot_poses[t][i]
-        color = colors[i % len(colors)]
+    for i in range(robot_poses.num_robots):
+        data_arr = robot_poses.samples(i)
         ax.plot(data_arr[:,0],
-                   data_arr[:,1],
-                   color=color
-                   )
-        ax.plot(data_arr[0,0],
-                   data_arr[0,1],
-                   color="red",
-                   marker="*",
-                   markersize=1
-                   )
-        ax.plot(data_arr[-1,0],
-                   data_arr[-1,1],
-                   color="black",
-                   marker="x",
-                   markersize=1
-                   )
+                data_arr[:,1],
+                color=colors[i % len(colors)]
+                )
+    start = robot_poses.start()
+    end = robot_poses.end()
+    ax.plot(start[:,0], start[:,1], color="red", marker="*", markersize=1, linestyle="none")
+    ax.plot(end[:,0], end[:,1], color="black", marker="x", markersize=1, linestyle="none")
     ax.set_xlabel('x (m)')
     ax.set_ylabel('y (m)')
     ax.set_xlim([0,512])
@@ -216,90 +255,173 @@ def plot_trajectory(robot_poses: list[coverage_control.PointVector],
     utils.save_fig(fig, save_dir, bag_name+"_traj")
     printC("Done!", GREEN)
 
-def plot_system_maps(system_maps: NDArray[np.float32],
-                     poses: NDArray[np.float32],
-                     t_coarse: NDArray[np.float32],
-                     save_dir: str,
-                     bag_name: str,
-                     color_scheme: dict,
-                     global_map: NDArray[np.float32] | None = None,
-                     en_axis_labels = False,
-                     en_grid = False,
-                     generate_video: bool = True,
-                     save_times: list[float] = [0., 15., 30., 45., 60.],
-                     background_map: NDArray[np.float32] | None = None
-                     ):
-
-    tmp_dir = save_dir + f"/{bag_name}_tmp"
-    if not os.path.isdir(tmp_dir):
-        os.makedirs(tmp_dir)
-
-    for i in range(0, system_maps.shape[0], 1):
-        printC(f"Plotting map video frames ({i:06d} / {system_maps.shape[0]:06d})...", BLUE, end="\r", flush=True)
-        fig, ax = plt.subplots(figsize=(ONE_COLUMN_WIDTH, FIGURE_HEIGHT))
+def load_background(background_map: str,
+                    shape: tuple[int, int],
+                    cache_dir: str | None = BACKGROUND_CACHE_DIR
+                    ) -> NDArray:
+    # Background image decoded, resized to the map grid and flipped for origin="lower".
+    # The result is cached on disk by image hash and target shape so repeat runs
+    # (and other bags from the same site) skip the decode and anti-aliased resize.
+    cache_path = None
+    if cache_dir is not None:
+        key = bag_cache.file_hash(background_map)
+        cache_path = f"{cache_dir}/{key}_{shape[0]}x{shape[1]}.npy"
+        if os.path.isfile(cache_path):
+            return np.load(cache_path)
+    background_image = plt.imread(background_map)
+    background_resized = np.flipud(resize(background_image, shape, anti_aliasing=True))
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, background_resized)
+        os.replace(tmp_path, cache_path) # render workers may race on the same file
+    return background_resized
+
+def snapshot_name(bag_name: str, t: float, background_map: str | None) -> str:
+    if background_map is not None:
+        return f"{bag_name}_buckner_{t:.2f}"
+    return f"{bag_name}_sys_{t:.2f}"
+
+class SystemMapRenderer:
+    # Builds the figure, colormaps and static layers (global map or background image,
+    # spine styling) once. Per frame only the system map image data, its alpha and the
+    # robot offsets change; they are redrawn over a cached copy of the static layers.
+    def __init__(self, ctx: dict):
+        self.ctx = ctx
+        color_scheme = ctx["color_scheme"]
+        global_map = ctx["global_map"]
+        background_map = ctx["background_map"]
+        poses = ctx["poses"]
+        blank = np.full(ctx["map_shape"], np.nan)
+        self.fig, self.ax = plt.subplots(figsize=(ONE_COLUMN_WIDTH, FIGURE_HEIGHT))
+        ax = self.ax
         if global_map is not None:
             if background_map is not None:
-                system_map_masked = np.ma.masked_where(np.isnan(system_maps[i]), system_maps[i])
-                background_image = plt.imread(background_map)
-                background_resized = resize(background_image, system_map_masked.shape, anti_aliasing=True)
-
-                visible_mask = ~np.isnan(system_maps[i])
-                fog_mask = np.isnan(system_maps[i])
-
-                ax.imshow(np.flipud(background_resized))
-
-                visible_map = np.where(visible_mask, system_maps[i], np.nan)
-               # overlay_map = np.where(visible_map == 0., system_maps[i], np.nan)
-               # ax.imshow(overlay_map, origin="lower", cmap=color_scheme["idf"], vmin=0., vmax=1.0, alpha=0.3)
-                #visible_map = np.where(visible_map > 0., system_maps[i], np.nan)
-                alpha_map = np.where(np.isnan(visible_map), 0., system_maps[i])
-                ax.imshow(visible_map, origin="lower", cmap=color_scheme["idf"], vmin=0., vmax=1.0, alpha=alpha_map)
-
-                fog_map = np.where(fog_mask, 1, np.nan)
-                ax.imshow(fog_map, origin="lower", cmap="gray", alpha=0.85)
-
+                self.mode = "background"
+                background_image = ctx.get("background_image")
+                if background_image is None:
+                    background_image = load_background(background_map, ctx["map_shape"])
+                ax.imshow(background_image)
+                self.visible_im = ax.imshow(blank, origin="lower", cmap=color_scheme["idf"], vmin=0., vmax=1.0, alpha=np.zeros(ctx["map_shape"]))
+                self.fog_im = ax.imshow(blank, origin="lower", cmap="gray", alpha=0.85)
+                self.animated = [self.visible_im, self.fog_im]
             else:
-                system_map_masked = np.ma.masked_where(np.isnan(system_maps[i]), system_maps[i])
+                self.mode = "global"
                 ax.imshow(global_map, origin="lower", cmap="gray_r", alpha=0.5)
-                ax.imshow(system_map_masked, origin="lower", cmap=color_scheme["idf"], vmin=0.0, vmax=1.0)
+                self.map_im = ax.imshow(np.ma.masked_invalid(blank), origin="lower", cmap=color_scheme["idf"], vmin=0.0, vmax=1.0)
+                self.animated = [self.map_im]
         else:
-            ax.imshow(system_maps[i], origin="lower", cmap=color_scheme["idf"]) #pyright: ignore
-        ax.scatter(poses[i,:,0], poses[i,:,1], marker=color_scheme["robot_marker"], color=color_scheme["robot"], edgecolors='black')
-        if en_axis_labels:
+            self.mode = "plain"
+            self.map_im = ax.imshow(blank, origin="lower", cmap=color_scheme["idf"]) #pyright: ignore
+            self.animated = [self.map_im]
+        self.scatter = ax.scatter(poses[0,:,0], poses[0,:,1], marker=color_scheme["robot_marker"], color=color_scheme["robot"], edgecolors='black')
+        if ctx["en_axis_labels"]:
             ax.set_xlabel("x (m)") 
             ax.set_ylabel("y (m)")
         else:
             ax.get_xaxis().set_visible(False)
             ax.get_yaxis().set_visible(False)
-        ax.grid(visible=en_grid)
+        ax.grid(visible=ctx["en_grid"])
 
-        # For repeatability experiments
-        if bag_name in hacky_color_map:
+        # For repeatability experiments, the frame takes the color of the bag's group
+        highlight_color = ctx.get("highlight_color")
+        if highlight_color is not None:
             for spine in ax.spines.values():
-                # TODO terrible
-                l = [hacky_color_map[bag_name]]
-                c_sns = seaborn_colors(l)
-                spine.set_edgecolor(c_sns[0])
+                spine.set_edgecolor(seaborn_colors([highlight_color])[0])
                 spine.set_linewidth(4)
-        utils.save_fig(fig, tmp_dir, f"{t_coarse[i]:.2f}_{i:06d}") 
-        if t_coarse[i] in save_times:
-            if background_map is not None:
-                fn = f"{bag_name}_buckner_{t_coarse[i]:.2f}"
-            else:
-                fn = f"{bag_name}_sys_{t_coarse[i]:.2f}"
-
-            utils.save_fig(fig, save_dir, fn) 
-        plt.close()
-    printC("\nDone!", GREEN)
 
-    if generate_video:
-        printC(f"Generating video and saving in {save_dir}...", BLUE, end="")
-        if background_map is not None:
-            vfn =save_dir + "/" + bag_name + "_buckner.mp4"
+        # Spines sit on top of the images, so they are redrawn with the animated artists
+        self.animated = self.animated + [self.scatter] + list(ax.spines.values())
+        for artist in self.animated:
+            artist.set_animated(True)
+        self.fig.canvas.draw()
+        self.static_background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+    def update(self, i: int, system_map: NDArray[np.float32]):
+        if self.mode == "background":
+            visible_map = np.where(~np.isnan(system_map), system_map, np.nan)
+            self.visible_im.set_data(visible_map)
+            self.visible_im.set_alpha(np.where(np.isnan(visible_map), 0., system_map))
+            self.fog_im.set_data(np.where(np.isnan(system_map), 1, np.nan))
+        elif self.mode == "global":
+            self.map_im.set_data(np.ma.masked_where(np.isnan(system_map), system_map))
         else:
-            vfn =save_dir + "/" + bag_name + "_sys.mp4"
-        create_video(tmp_dir, vfn)
-        printC("Done!", GREEN)
+            self.map_im.set_data(system_map)
+            self.map_im.autoscale() # imshow without vmin/vmax scales to each frame
+        self.scatter.set_offsets(self.ctx["poses"][i])
+
+    def save_snapshot(self, i: int):
+        # savefig skips animated artists, so draw everything normally for the snapshot
+        t_coarse = self.ctx["t_coarse"]
+        for artist in self.animated:
+            artist.set_animated(False)
+        fn = snapshot_name(self.ctx["bag_name"], t_coarse[i], self.ctx["background_map"])
+        utils.save_fig(self.fig, self.ctx["save_dir"], fn)
+        for artist in self.animated:
+            artist.set_animated(True)
+
+    def render(self, i: int, system_map_slice) -> NDArray[np.uint8]:
+        # system_map_slice is system_maps[i:i+1] so SystemMaps frames are upscaled in the worker
+        self.update(i, system_map_slice[0])
+        if self.ctx["t_coarse"][i] in self.ctx["save_times"]:
+            self.save_snapshot(i)
+        canvas = self.fig.canvas
+        canvas.restore_region(self.static_background)
+        for artist in sorted(self.animated, key=lambda a: a.get_zorder()):
+            self.ax.draw_artist(artist)
+        rgba = np.asarray(canvas.buffer_rgba())
+        return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+
+def plot_system_maps(system_maps: SystemMaps | NDArray[np.float32],
+                     poses: NDArray[np.float32],
+                     t_coarse: NDArray[np.float32],
+                     save_dir: str,
+                     bag_name: str,
+                     color_scheme: dict,
+                     global_map: NDArray[np.float32] | None = None,
+                     en_axis_labels = False,
+                     en_grid = False,
+                     generate_video: bool = True,
+                     save_times: list[float] = [0., 15., 30., 45., 60.],
+                     background_map: NDArray[np.float32] | None = None,
+                     render_jobs: int = 1,
+                     highlight_color: str | None = None
+                     ):
+    ctx = {"poses": poses,
+           "map_shape": system_maps.shape[1:],
+           "t_coarse": t_coarse,
+           "save_dir": save_dir,
+           "bag_name": bag_name,
+           "color_scheme": color_scheme,
+           "global_map": global_map,
+           "en_axis_labels": en_axis_labels,
+           "en_grid": en_grid,
+           "save_times": save_times,
+           "background_map": background_map,
+           "highlight_color": highlight_color
+           }
+    if background_map is not None:
+        # Preprocessed once here and shipped to the render workers with the context
+        ctx["background_image"] = load_background(background_map, ctx["map_shape"])
+        vfn = save_dir + "/" + bag_name + "_buckner.mp4"
+    else:
+        vfn = save_dir + "/" + bag_name + "_sys.mp4"
+    if generate_video:
+        printC(f"Rendering video to {vfn}", BLUE)
+        frame_render.render_video(SystemMapRenderer,
+                                  ctx,
+                                  [(i, system_maps[i:i + 1]) for i in range(system_maps.shape[0])],
+                                  vfn,
+                                  jobs=render_jobs,
+                                  setup_fn=set_theme,
+                                  label="map video"
+                                  )
+    else:
+        # Only the snapshot frames are needed
+        tasks = [(i, system_maps[i:i + 1]) for i in range(system_maps.shape[0]) if t_coarse[i] in save_times]
+        for _ in frame_render.render_frames(SystemMapRenderer, ctx, tasks, render_jobs, set_theme):
+            pass
 
 def img_num_key(s):
     match = re.search(r"(\d+)(?=\D*$)", s) # use last integer in fn for sorting
@@ -355,7 +477,9 @@ def plot_bag(bag_data: ProcessedBag,
              save_dir: str,
              color_choice: str,
              global_map_time: float = 60.,
-             background_map: NDArray[np.float32] | None = None
+             background_map: NDArray[np.float32] | None = None,
+             render_jobs: int = 1,
+             highlight_color: str | None = None
              ):
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
@@ -365,27 +489,32 @@ def plot_bag(bag_data: ProcessedBag,
     #plot_cost(bag_data.normalized_cost, bag_data.t_fine, save_dir, bag_data.bag_name, colors)
     #plot_trajectory(robot_poses, save_dir, bag_name, colors)
 
-    global_map_idx = np.argmin(np.abs(bag_data.t_coarse - global_map_time))
-    plot_global_map(bag_data.global_map,
-                    save_dir,
-                    bag_data.bag_name + f"_global_{global_map_time}",
-                    map_colors[color_choice],
-                    bag_data.robot_poses[global_map_idx]
-                    )
-    plot_system_maps(bag_data.system_maps,
-                     bag_data.robot_poses,
-                     bag_data.t_coarse,
-                     save_dir,
-                     bag_data.bag_name,
-                     map_colors[color_choice],
-                     bag_data.global_map,
-                     background_map = background_map
-                     )
+    global_map_idx = time_align.nearest_index(bag_data.t_coarse, global_map_time)
+    with bag_profile.stage("global_map", items=1):
+        plot_global_map(bag_data.global_map,
+                        save_dir,
+                        bag_data.bag_name + f"_global_{global_map_time}",
+                        map_colors[color_choice],
+                        bag_data.robot_poses[global_map_idx]
+                        )
+    with bag_profile.stage("system_maps", items=len(bag_data.system_maps)):
+        plot_system_maps(bag_data.system_maps,
+                         bag_data.robot_poses,
+                         bag_data.t_coarse,
+                         save_dir,
+                         bag_data.bag_name,
+                         map_colors[color_choice],
+                         bag_data.global_map,
+                         background_map = background_map,
+                         render_jobs = render_jobs,
+                         highlight_color = highlight_color
+                         )
 
 def plot_combined_cost(bag_data_arr: list[ProcessedBag],
                        save_dir: str,
                        color_choice: str,
-                       generate_video: bool = True
+                       generate_video: bool = True,
+                       render_jobs: int = 1
                       ):
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
@@ -406,10 +535,6 @@ def plot_combined_cost(bag_data_arr: list[ProcessedBag],
     plt.close()
 
     if generate_video:
-        tmp_dir = save_dir + "/combined_cost_tmp"
-        if not os.path.isdir(tmp_dir):
-            os.makedirs(tmp_dir)
-
         min_idx = 0
         min_time = np.inf
         for i, data in enumerate(bag_data_arr):
@@ -420,30 +545,25 @@ def plot_combined_cost(bag_data_arr: list[ProcessedBag],
         data_i = bag_data_arr[min_idx]
         assert data_i.t_fine.shape[0] > 2
         fps = 1 / np.mean(np.diff(data_i.t_fine))
-        for i in range(0, data_i.t_fine.shape[0], 1):
-            if i >= data_i.t_fine.shape[0]:
-                break
-            printC(f"Plotting cost video frames ({i:06d} / {data_i.t_fine.shape[0]:06d})...", BLUE, end="\r", flush=True)
-            fig, ax = plt.subplots(figsize=(TWO_COLUMN_WIDTH, FIGURE_HEIGHT * 0.7))
-            for j, data in enumerate(bag_data_arr):
-                ax.plot(data.t_fine[:i], data.normalized_cost[:i], color=colors[j % len(colors)], label=f"Exp.-{j}")
-                ax.plot(data.t_fine[i], data.normalized_cost[i], color=colors[j % len(colors)], marker="o", markersize=3)
-            #ax.set_xlim(0.0, data_i.t_fine[-1])
-            ax.set_ylim(0.0, 1.3)
-            ax.set_xlabel('Time (s)')
-            ax.set_ylabel('Normalized Coverage Cost')
-            plt.legend(loc='lower left')
-            plt.tight_layout()
-            utils.save_fig(fig, tmp_dir, f"{data_i.t_fine[i]:.2f}_{i:06d}")
-            plt.close()
-        printC("\nDone!", GREEN)
-
-        printC(f"Generating video...", BLUE, end="")
-        create_video(tmp_dir, save_dir + "/combined_cost.mp4", fps=fps)
-        printC("Done!", GREEN)
-
-        if os.path.exists(tmp_dir):
-            shutil.rmtree(tmp_dir)
+        # Only the cost traces go to the render workers, not the map stacks
+        ctx = {"traces": [(data.t_fine, data.normalized_cost) for data in bag_data_arr],
+               "colors": colors,
+               "labels": [f"Exp.-{j}" for j in range(len(bag_data_arr))],
+               "figsize": (TWO_COLUMN_WIDTH, FIGURE_HEIGHT * 0.7),
+               "ylim": (0.0, 1.3),
+               "x_label": "Time (s)",
+               "y_label": "Normalized Coverage Cost",
+               "legend_loc": "lower left"
+               }
+        frame_render.render_video(CostRenderer,
+                                  ctx,
+                                  [(i,) for i in range(data_i.t_fine.shape[0])],
+                                  save_dir + "/combined_cost.mp4",
+                                  fps=fps,
+                                  jobs=render_jobs,
+                                  setup_fn=set_theme,
+                                  label="combined cost video"
+                                  )
 
 def plot_combined_global_map(bag_data_arr: list[ProcessedBag],
                              save_dir: str,
@@ -460,7 +580,7 @@ def plot_combined_global_map(bag_data_arr: list[ProcessedBag],
     for t in times_to_plot:
         robot_poses = []
         for bag_data in bag_data_arr:
-            pose_idx = np.argmin(np.abs(bag_data.t_coarse - t))
+            pose_idx = time_align.nearest_index(bag_data.t_coarse, t)
             robot_poses.append(bag_data.robot_poses[pose_idx])
 
         plot_global_map(bag_data_arr[0].global_map,
@@ -470,3 +590,29 @@ def plot_combined_global_map(bag_data_arr: list[ProcessedBag],
                         np.array(robot_poses),
                         alt_marker_colors=colors
                         )
+
+def plot_aggregate_cost(group_stats: list,
+                        save_dir: str,
+                        band: tuple[float, float] = (10., 90.),
+                        filename: str = "aggregate_cost"
+                        ):
+    # Mean cost per group with a percentile band (bag_aggregate.GroupStats)
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+    colors = seaborn_colors(catpuccin_colors)
+    set_theme()
+
+    fig, ax = plt.subplots(figsize=(ONE_COLUMN_WIDTH, FIGURE_HEIGHT))
+    printC(f"Plotting and saving to {save_dir}/{filename}.png...", GREEN, end="")
+    for i, stats in enumerate(group_stats):
+        color = colors[i % len(colors)]
+        ax.plot(stats.grid, stats.mean, color=color, label=f"{stats.label} (n={len(stats.bags)})")
+        if band[0] in stats.percentiles and band[1] in stats.percentiles:
+            ax.fill_between(stats.grid, stats.percentiles[band[0]], stats.percentiles[band[1]], color=color, alpha=0.25, linewidth=0)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Normalized Coverage Cost')
+    plt.legend()
+    plt.tight_layout()
+    utils.save_fig(fig, save_dir, filename)
+    printC("Done!", GREEN)
+    plt.close()
@@ -1,11 +1,18 @@
 import pdb
+import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 import numpy as np
 from numpy.typing import NDArray
 import coverage_control
 import bag_utils as utils
+import time_align
+import bag_profile
+import bag_aggregate
 from bag_utils import printC
+from bag_store import BagStore
+from system_maps import SystemMaps
 from colors import *
 
 @dataclass
@@ -14,64 +21,231 @@ class ProcessedBag:
     robot_poses: NDArray[np.float32]
     normalized_cost: NDArray[np.float32]
     global_map: NDArray[np.float32]
-    system_maps: NDArray[np.float32]
+    system_maps: SystemMaps | NDArray[np.float32] # older pickles hold the dense upscaled stack
     t_coarse: NDArray[np.float32]
     t_fine: NDArray[np.float32]
 
 def calc_cost(cc_env: coverage_control.CoverageSystem,
-              robot_poses: list[coverage_control.PointVector],
+              robot_poses: NDArray[np.float64],
               ):
-    total_steps = len(robot_poses)
+    total_steps = robot_poses.shape[0]
     normalized_cost_arr = np.empty(total_steps, dtype=np.float64)
     initial_cost = cc_env.GetObjectiveValue()
     normalized_cost_arr[0] = 1.
     for i in range(1, total_steps):
-        cc_env.SetGlobalRobotPositions(robot_poses[i])
+        cc_env.SetGlobalRobotPositions(coverage_control.PointVector(robot_poses[i]))
         normalized_cost = cc_env.GetObjectiveValue() / initial_cost
         normalized_cost_arr[i] = normalized_cost
     return normalized_cost_arr
 
-def process_bag(bag_dict: dict,
+def calc_cost_chunk(params_file: str,
+                    idf_file: str,
+                    robot_poses: NDArray[np.float64]
+                    ) -> NDArray[np.float64]:
+    # Raw objective values for a chunk of poses, evaluated on a CoverageSystem owned by this process
+    cc_parameters = coverage_control.Parameters(params_file)
+    cc_env = utils.create_cc_env(cc_parameters, idf_file, coverage_control.PointVector(robot_poses[0]))
+    if not cc_env:
+        raise RuntimeError(f"Failed to create CoverageSystem from {params_file} and {idf_file}")
+    cost_arr = np.empty(robot_poses.shape[0], dtype=np.float64)
+    cost_arr[0] = cc_env.GetObjectiveValue()
+    for i in range(1, robot_poses.shape[0]):
+        cc_env.SetGlobalRobotPositions(coverage_control.PointVector(robot_poses[i]))
+        cost_arr[i] = cc_env.GetObjectiveValue()
+    return cost_arr
+
+def calc_cost_batched(params_file: str,
+                      idf_file: str,
+                      robot_poses: NDArray[np.float64],
+                      jobs: int = 1,
+                      eval_idx: NDArray[np.int64] | None = None
+                      ) -> NDArray[np.float64]:
+    # Splits the pose timeline into one chunk per worker, each with its own CoverageSystem.
+    # The objective only depends on the current positions, so chunks are independent.
+    # With eval_idx, only those samples are evaluated and the rest are linearly interpolated.
+    total_steps = robot_poses.shape[0]
+    if eval_idx is None:
+        eval_idx = np.arange(total_steps)
+    eval_idx = np.union1d(eval_idx, [0, total_steps - 1]) # normalization needs the first sample
+    chunks = [c for c in np.array_split(eval_idx, max(1, jobs)) if c.shape[0] > 0]
+    if len(chunks) == 1:
+        cost_arr = calc_cost_chunk(params_file, idf_file, robot_poses[eval_idx])
+    else:
+        with ProcessPoolExecutor(max_workers=len(chunks)) as pool:
+            futures = [pool.submit(calc_cost_chunk, params_file, idf_file, robot_poses[c]) for c in chunks]
+            cost_arr = np.concatenate([f.result() for f in futures])
+    normalized_cost_arr = cost_arr / cost_arr[0]
+    normalized_cost_arr[0] = 1.
+    if eval_idx.shape[0] == total_steps:
+        return normalized_cost_arr
+    return np.interp(np.arange(total_steps), eval_idx, normalized_cost_arr)
+
+def cost_eval_indices(total_steps: int,
+                      stride: int = 1,
+                      pose_indices: NDArray[np.int64] | None = None
+                      ) -> NDArray[np.int64] | None:
+    # None means every pose sample; pose_indices evaluates at map rate
+    if pose_indices is not None:
+        return np.union1d(pose_indices, [0, total_steps - 1])
+    if stride > 1:
+        return np.union1d(np.arange(0, total_steps, stride), [0, total_steps - 1])
+    return None
+
+@dataclass
+class CostReport:
+    samples: int
+    candidates: int # samples the cost would otherwise be evaluated at
+    evaluated: int
+    tolerance: float
+    slope: float # largest |change in normalized cost| per cell of robot displacement between evaluations
+    error_bound: float # slope * tolerance, estimated error of a reused sample
+    verified: int = 0
+    verify_error: float = 0. # largest error observed on reused samples evaluated exactly
+
+    @property
+    def reused(self) -> int:
+        return self.candidates - self.evaluated
+
+def max_displacement(a: NDArray, b: NDArray) -> NDArray:
+    # Largest per-robot distance between (..., R, 2) pose sets
+    return np.max(np.linalg.norm(a - b, axis=-1), axis=-1)
+
+def reuse_sources(robot_poses: NDArray[np.float64],
+                  tolerance: float,
+                  block_size: int = 256
+                  ) -> NDArray[np.int64]:
+    # For each sample, the sample whose cost it reuses: the last evaluated one, as long as
+    # no robot has moved more than tolerance cells from it. Scanned a block at a time.
+    total_steps = robot_poses.shape[0]
+    source = np.empty(total_steps, dtype=np.int64)
+    source[0] = ref = 0
+    i = 1
+    while i < total_steps:
+        block = robot_poses[i:i + block_size]
+        moved = np.flatnonzero(max_displacement(block, robot_poses[ref]) > tolerance)
+        if moved.shape[0] == 0:
+            source[i:i + block.shape[0]] = ref
+            i += block.shape[0]
+            continue
+        j = i + moved[0]
+        source[i:j] = ref
+        source[j] = ref = j
+        i = j + 1
+    return source
+
+def calc_cost_incremental(params_file: str,
+                          idf_file: str,
+                          robot_poses: NDArray[np.float64],
+                          tolerance: float,
+                          jobs: int = 1,
+                          eval_idx: NDArray[np.int64] | None = None,
+                          verify: int = 0
+                          ) -> tuple[NDArray[np.float64], CostReport]:
+    # Skips evaluations while every robot stays within tolerance cells of the last
+    # evaluated positions and reuses that cost instead. tolerance=0 only skips exact
+    # repeats, so the result is identical to calc_cost_batched. Combined with eval_idx
+    # (stride or map rate) the reuse applies among those samples before interpolation.
+    total_steps = robot_poses.shape[0]
+    candidates = np.arange(total_steps) if eval_idx is None else np.union1d(eval_idx, [0, total_steps - 1])
+    source = reuse_sources(robot_poses[candidates], tolerance)
+    evaluated = np.unique(source)
+    cost_evaluated = calc_cost_batched(params_file, idf_file, robot_poses[candidates[evaluated]], jobs)
+    cost_candidates = cost_evaluated[np.searchsorted(evaluated, source)]
+
+    disp = max_displacement(robot_poses[candidates[evaluated[1:]]], robot_poses[candidates[evaluated[:-1]]])
+    slopes = np.abs(np.diff(cost_evaluated))[disp > 0] / disp[disp > 0]
+    slope = float(slopes.max()) if slopes.shape[0] > 0 else 0.
+    report = CostReport(total_steps, candidates.shape[0], evaluated.shape[0], tolerance, slope, slope * tolerance)
+
+    reused = np.flatnonzero(source != np.arange(source.shape[0]))
+    if verify > 0 and reused.shape[0] > 0:
+        rng = np.random.default_rng(0)
+        check = np.sort(rng.choice(reused, min(verify, reused.shape[0]), replace=False))
+        # The first sample is the normalization reference
+        exact = calc_cost_batched(params_file, idf_file, robot_poses[np.concatenate([[0], candidates[check]])], jobs)[1:]
+        report.verified = check.shape[0]
+        report.verify_error = float(np.max(np.abs(exact - cost_candidates[check])))
+
+    if candidates.shape[0] == total_steps:
+        return cost_candidates, report
+    return np.interp(np.arange(total_steps), candidates, cost_candidates), report
+
+def process_bag(bag_dict: BagStore | dict,
                 params_file: str,
                 idf_file: str,
                 save_dir: str,
                 bag_name: str,
-                save: bool = True
+                save: bool = True,
+                lossless_maps: bool = False,
+                cost_jobs: int = 1,
+                cost_stride: int = 1,
+                cost_at_map_rate: bool = False,
+                cost_tolerance: float | None = None,
+                cost_verify: int = 0
                 ):
     cc_parameters = coverage_control.Parameters(params_file)
-    total_time = bag_dict["total_time"]
 
-    mission_control_data, t_mission_control = utils.get_mission_control(bag_dict)
-    start_time, stop_time = utils.experiment_window(mission_control_data, t_mission_control)
+    with bag_profile.stage("load"):
+        mission_control_data, t_mission_control = utils.get_mission_control(bag_dict)
+        start_time, stop_time = utils.experiment_window(mission_control_data, t_mission_control)
 
-    robot_poses, t_poses  = utils.get_robot_poses(bag_dict)
-    poses_start = utils.align(t_poses, start_time)
-    poses_stop  = utils.align(t_poses, stop_time)
-    robot_poses = robot_poses[poses_start:poses_stop]
-    t_fine = t_poses[poses_start:poses_stop]
+        robot_poses, t_poses  = utils.get_robot_poses(bag_dict, int(cc_parameters.pWorldMapSize))
+        poses_start = utils.align(t_poses, start_time)
+        poses_stop  = utils.align(t_poses, stop_time)
+        robot_poses = robot_poses[poses_start:poses_stop]
+        t_fine = t_poses[poses_start:poses_stop]
+    printC(f"Robot poses: {robot_poses.shape[0]} samples x {robot_poses.shape[1]} robots, "
+           f"{robot_poses.nbytes / 1e6:.1f} MB", BLUE)
 
-    global_map_upscaled, system_maps_upscaled, t_system_maps = utils.get_maps(bag_dict)
+    with bag_profile.stage("get_maps"):
+        global_map_upscaled, system_maps, t_system_maps = utils.get_maps(bag_dict, cc_parameters, quantize=not lossless_maps)
     maps_start = utils.align(t_system_maps, start_time)
     maps_stop = utils.align(t_system_maps, stop_time)
-    system_maps_upscaled = system_maps_upscaled[maps_start:maps_stop]
+    system_maps = system_maps[maps_start:maps_stop]
+    printC(f"System maps: {system_maps.nbytes / 1e6:.1f} MB stored "
+           f"({system_maps.dense_nbytes / 1e6:.1f} MB as a dense upscaled stack)", BLUE)
     t_coarse = t_system_maps[maps_start:maps_stop]
 
-    X, Y = np.meshgrid(t_fine, t_coarse) 
-    pose_indices = np.argmin(np.abs(X - Y), axis=1)
-    poses_for_maps = np.array(robot_poses)[pose_indices]
+    with bag_profile.stage("align", items=t_coarse.shape[0]):
+        pose_indices = time_align.nearest_index(t_fine, t_coarse)
+        poses_for_maps = robot_poses[pose_indices]
 
     # Creates a file containing start positions of the robots from the current bag.
     # Allows future simulation runs to be initialized with the same start positions.
     utils.create_pose_file(poses_for_maps[0], bag_name)
 
-    cc_env = utils.create_cc_env(cc_parameters, idf_file, robot_poses[0])
-    if cc_env is None:
-        printC("Exiting...", RED)
-        exit(1)
+    eval_idx = cost_eval_indices(robot_poses.shape[0], cost_stride, pose_indices if cost_at_map_rate else None)
+    num_evals = robot_poses.shape[0] if eval_idx is None else eval_idx.shape[0]
+    if cost_tolerance is not None:
+        printC(f"Evaluating coverage cost for {bag_name} (reusing within {cost_tolerance} cells, "
+               f"{cost_jobs} workers)...", BLUE, end="")
+        with bag_profile.stage("cost"):
+            normalized_cost, report = calc_cost_incremental(params_file, idf_file, robot_poses, cost_tolerance,
+                                                            cost_jobs, eval_idx, cost_verify)
+        bag_profile.count("cost", report.evaluated)
+        printC("Done!", GREEN)
+        printC(f"Evaluated {report.evaluated}/{report.candidates} samples, reused {report.reused} "
+               f"({100 * report.reused / report.candidates:.1f}%). Estimated error bound "
+               f"{report.error_bound:.2e} (max slope {report.slope:.2e} per cell)", BLUE)
+        if report.verified > 0:
+            printC(f"Largest error on {report.verified} reused samples evaluated exactly: {report.verify_error:.2e}",
+                   YELLOW if report.verify_error > report.error_bound else BLUE)
+    elif cost_jobs > 1 or eval_idx is not None:
+        printC(f"Evaluating coverage cost for {bag_name} ({num_evals}/{robot_poses.shape[0]} samples, "
+               f"{cost_jobs} workers)...", BLUE, end="")
+        with bag_profile.stage("cost", items=num_evals):
+            normalized_cost = calc_cost_batched(params_file, idf_file, robot_poses, cost_jobs, eval_idx)
+        printC("Done!", GREEN)
+    else:
+        cc_env = utils.create_cc_env(cc_parameters, idf_file, coverage_control.PointVector(robot_poses[0]))
+        if not cc_env:
+            printC("Exiting...", RED)
+            exit(1)
 
-    printC(f"Evaluating coverage cost for {bag_name}...", BLUE, end="")
-    normalized_cost = calc_cost(cc_env, robot_poses)
-    printC("Done!", GREEN)
+        printC(f"Evaluating coverage cost for {bag_name}...", BLUE, end="")
+        with bag_profile.stage("cost", items=num_evals):
+            normalized_cost = calc_cost(cc_env, robot_poses)
+        printC("Done!", GREEN)
 
     t_coarse -= t_coarse[0]
     t_fine -= t_fine[0]
@@ -80,14 +254,16 @@ def process_bag(bag_dict: dict,
                       poses_for_maps,
                       normalized_cost,
                       global_map_upscaled,
-                      system_maps_upscaled,
+                      system_maps,
                       t_coarse,
                       t_fine
                       )
     if save:
         save_path = save_dir + "/" + bag_name + "_processed.pkl"
         printC(f"Saving to {save_path}...", BLUE, end="")
-        with open(save_path, "wb") as f:
+        with bag_profile.stage("save"), open(save_path, "wb") as f:
             pickle.dump(pb, f, protocol=pickle.HIGHEST_PROTOCOL)
-        printC("Done!", GREEN)
+        printC(f"Done! ({os.path.getsize(save_path) / 1e6:.1f} MB)", GREEN)
+        # Small copy of the cost curve for multi-bag statistics (see bag_aggregate.py)
+        bag_aggregate.save_cost_curve(bag_aggregate.cost_curve_path(save_dir, bag_name), t_fine, normalized_cost)
     return pb
@@ -0,0 +1,192 @@
+import os
+import csv
+import json
+import time
+import resource
+import cProfile
+from contextlib import contextmanager, nullcontext
+
+# Opt-in stage instrumentation for baggy.py --profile.
+# Stages nest: stage("cost") entered inside stage("process") is recorded as "process/cost".
+# Each stage accumulates calls, items, wall time, CPU time, the process's peak RSS when the
+# stage ended and how much the stage raised that high-water mark. Hot loops use add() to
+# accumulate wall time per message without the cost of a context manager.
+# When no profiler is active every helper is a no-op.
+#
+# Work done in child processes (--decode-jobs, --cost-jobs, --render-jobs) is only seen as
+# the parent's wall time; CPU time and RSS are for the main process.
+
+PROFILE_BACKENDS = ["cprofile", "pyinstrument"]
+
+_active = None
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KiB on Linux
+
+def new_entry() -> dict:
+    return {"calls": 0, "items": 0, "wall_s": 0., "cpu_s": 0., "peak_rss_mb": 0., "rss_growth_mb": 0.}
+
+class Profiler:
+    def __init__(self,
+                 dump_stage: str | None = None,
+                 dump_path: str | None = None,
+                 backend: str = "cprofile"
+                 ):
+        self.stats = {}
+        self.stack = []
+        self.dump_stage = dump_stage
+        self.dump_path = dump_path
+        self.backend = backend
+        self.dumper = None
+
+    def full_name(self, name: str) -> str:
+        return "/".join(self.stack + [name])
+
+    def entry(self, full_name: str) -> dict:
+        entry = self.stats.get(full_name)
+        if entry is None:
+            entry = new_entry()
+            self.stats[full_name] = entry
+        return entry
+
+    @contextmanager
+    def stage(self, name: str, items: int = 0):
+        full_name = self.full_name(name)
+        entry = self.entry(full_name) # registered on entry so parents are listed before children
+        self.stack.append(name)
+        dumping = full_name == self.dump_stage
+        if dumping:
+            self.start_dump()
+        rss_start = peak_rss_mb()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            if dumping:
+                self.stop_dump()
+            self.stack.pop()
+            rss = peak_rss_mb()
+            entry["calls"] += 1
+            entry["items"] += items
+            entry["wall_s"] += wall
+            entry["cpu_s"] += cpu
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"], rss)
+            entry["rss_growth_mb"] += rss - rss_start
+
+    def add(self, name: str, wall: float, items: int = 1):
+        entry = self.entry(self.full_name(name))
+        entry["calls"] += 1
+        entry["items"] += items
+        entry["wall_s"] += wall
+
+    def count(self, name: str, items: int):
+        self.entry(self.full_name(name))["items"] += items
+
+    def start_dump(self):
+        if self.dumper is None:
+            if self.backend == "pyinstrument":
+                import pyinstrument # optional, only needed for this backend
+                self.dumper = pyinstrument.Profiler()
+            else:
+                self.dumper = cProfile.Profile()
+        if self.backend == "pyinstrument":
+            self.dumper.start()
+        else:
+            self.dumper.enable()
+
+    def stop_dump(self):
+        if self.backend == "pyinstrument":
+            self.dumper.stop()
+        else:
+            self.dumper.disable()
+
+    def write_dump(self) -> str | None:
+        if self.dumper is None or self.dump_path is None:
+            return None
+        if self.backend == "pyinstrument":
+            path = self.dump_path + ".html"
+            with open(path, "w") as f:
+                f.write(self.dumper.output_html())
+        else:
+            path = self.dump_path + ".prof" # view with snakeviz or python -m pstats
+            self.dumper.dump_stats(path)
+        return path
+
+    def rows(self) -> list[dict]:
+        return [{"stage": name, **entry} for name, entry in self.stats.items()]
+
+    def write_report(self, path_prefix: str, info: dict) -> list[str]:
+        # <prefix>.json with the run info and per-stage stats, <prefix>.csv with one row per stage
+        rows = self.rows()
+        with open(path_prefix + ".json", "w") as f:
+            json.dump({**info, "stages": rows}, f, indent=2)
+        with open(path_prefix + ".csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["stage"] + list(new_entry().keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+        paths = [path_prefix + ".json", path_prefix + ".csv"]
+        dump = self.write_dump()
+        if dump is not None:
+            paths.append(dump)
+        return paths
+
+    def summary(self) -> str:
+        width = max([len(name) for name in self.stats] + [5]) + 2
+        lines = [f"{'stage':<{width}}{'calls':>8}{'items':>10}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}"]
+        for row in self.rows():
+            lines.append(f"{row['stage']:<{width}}{row['calls']:>8}{row['items']:>10}{row['wall_s']:>10.3f}"
+                         f"{row['cpu_s']:>10.3f}{row['peak_rss_mb']:>10.1f}")
+        return "\n".join(lines)
+
+def start(dump_stage: str | None = None,
+          dump_path: str | None = None,
+          backend: str = "cprofile"
+          ) -> Profiler:
+    global _active
+    _active = Profiler(dump_stage, dump_path, backend)
+    return _active
+
+def stop() -> Profiler | None:
+    global _active
+    profiler, _active = _active, None
+    return profiler
+
+def active() -> Profiler | None:
+    return _active
+
+def stage(name: str, items: int = 0):
+    if _active is None:
+        return nullcontext()
+    return _active.stage(name, items)
+
+def add(name: str, wall: float, items: int = 1):
+    if _active is not None:
+        _active.add(name, wall, items)
+
+def count(name: str, items: int):
+    if _active is not None:
+        _active.count(name, items)
+
+def timed(name: str, iterable):
+    # Wraps an iterator so the time spent producing each item is accumulated under name
+    if _active is None:
+        return iterable
+    entry = _active.entry(_active.full_name(name))
+    entry["calls"] += 1
+    return _timed(entry, iterable)
+
+def _timed(entry: dict, iterable):
+    iterator = iter(iterable)
+    while True:
+        wall_start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            entry["wall_s"] += time.perf_counter() - wall_start
+            return
+        entry["wall_s"] += time.perf_counter() - wall_start
+        entry["items"] += 1
+        yield item
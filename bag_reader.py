@@ -1,115 +1,281 @@
 from warnings import warn
+from fnmatch import fnmatch
+import heapq
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from rosbags.rosbag2 import Reader 
 from rosbags.typesys import Stores, get_typestore, get_types_from_msg
-from sensor_msgs_py import point_cloud2
-import coverage_control
 import argparse
 import numpy as np
+from numpy.typing import NDArray
 import pdb
 import sys
 import pickle
+import time
 from colors import *
-from bag_utils import printC
+import time_align
+import bag_store
+import bag_profile
+import trajectories
+import msg_handlers
 
 
 typestore = get_typestore(Stores.ROS2_JAZZY)
 
+MISSION_CONTROL_MSGTYPE = msg_handlers.MISSION_CONTROL_MSGTYPE
+ROBOT_POSITIONS_MSGTYPE = msg_handlers.ROBOT_POSITIONS_MSGTYPE
+DECODE_BATCH_SIZE = 512 # messages per worker task, amortizes the IPC overhead
+
+_worker_connections = None
+_worker_fast = True
+_bound_handlers = {} # (topic, msgtype, msgdef) -> BoundHandler, None when unsupported
+
 def hline():
     print("--------------------------------------------------------------------------------")
 
-def pc2_to_native(msg: object) -> object:
-    dtype = np.dtype([ 
-            ("x", np.float32),
-            ("y", np.float32),
-            ("z", np.float32),
-            ("intensity", np.float32)
-            ])
-    arr = np.frombuffer(msg.data, dtype=dtype)
-    points = [tuple(pt) for pt in arr]
-    pc2_native = point_cloud2.create_cloud(msg.header, msg.fields, points)
-    return pc2_native
-
 def extract_topic(
         connection,
         timestamp,
         rawdata
     ) -> tuple[str, str, dict] | None:
-    split = connection.topic.split("/")
-    namespace = split[1]
-    topic_name = split[-1]
     msg = typestore.deserialize_cdr(rawdata, connection.msgtype)
-    if connection.msgtype == "geometry_msgs/msg/PoseStamped":
-        data = get_position(msg)
-    elif connection.msgtype == "geometry_msgs/msg/TwistStamped":
-        data = get_vel(msg)
-    elif connection.msgtype == "sensor_msgs/msg/PointCloud2":
-        data = get_pc2(msg)
-    elif connection.msgtype == "async_pac_gnn_interfaces/msg/MissionControl":
-        if "offboard_enable" in msg.__dataclass_fields__:
-              data = get_mission_ctrl_legacy(msg)
-        else:
-              data = get_mission_ctrl(msg)
-    elif connection.msgtype == "async_pac_gnn_interfaces/msg/RobotPositions":
-        data = get_all_robot_positions(msg)
-    else:
+    return convert_msg(connection, timestamp, msg)
+
+def topic_key(topic: str) -> tuple[str, str]:
+    # "/r0/pose" -> ("r0", "pose"), "/sim/all_robot_positions" -> ("sim", "all_robot_positions")
+    split = topic.split("/")
+    return split[1], split[-1]
+
+class BoundHandler:
+    # A msg_handlers.MessageHandler resolved for one connection: topic key, the converter
+    # matching the recorded message definition and its batch decoder, built on first use
+    def __init__(self, connection, handler: msg_handlers.MessageHandler):
+        self.handler = handler
+        self.msgtype = connection.msgtype
+        self.namespace, self.topic_name = topic_key(connection.topic)
+        self.convert = handler.converter(typestore.fielddefs, connection.msgtype)
+        self.has_header = "header" in msg_handlers.field_names(typestore.fielddefs, connection.msgtype)
+        self._decoder = None
+        self._decoder_built = handler.batch_decoder is None
+
+    @property
+    def decoder(self):
+        if not self._decoder_built:
+            self._decoder = self.handler.batch_decoder(typestore.fielddefs, self.msgtype)
+            self._decoder_built = True
+        return self._decoder
+
+def bind_handler(connection) -> BoundHandler | None:
+    # Resolved once per connection and message definition, legacy and current MissionControl
+    # differ. Live connections carry no definition, they only ever see one per msgtype.
+    msgdef = connection.msgdef.data if hasattr(connection, "msgdef") else None
+    key = (connection.topic, connection.msgtype, msgdef)
+    if key not in _bound_handlers:
+        handler = msg_handlers.get_handler(connection.msgtype)
+        _bound_handlers[key] = None if handler is None else BoundHandler(connection, handler)
+    return _bound_handlers[key]
+
+def convert_msg(
+        connection,
+        timestamp,
+        msg
+    ) -> tuple[str, str, dict] | None:
+    bound = bind_handler(connection)
+    if bound is None:
         return None
-    if "header" in msg.__dataclass_fields__: # use the recorded time, if available
+    data = bound.convert(msg)
+    if bound.has_header: # use the recorded time, if available
         t = msg.header.stamp.sec + msg.header.stamp.nanosec / 1e9
         entry = {t: data}
     else:
-        entry = {timestamp: data} 
-    return namespace, topic_name, entry
-
-def get_position(msg):
-    return np.array([msg.pose.position.x, msg.pose.position.y, msg.pose.position.z])
-
-def get_vel(msg):
-    return np.array([msg.twist.linear.x, msg.twist.linear.y, msg.twist.linear.z])
-
-def get_pc2(msg):
-    pc2_native = pc2_to_native(msg)
-    points_list = point_cloud2.read_points_list(pc2_native, field_names=["x", "y", "intensity"])
-    points_arr = np.array(points_list)
-    return points_arr 
-
-def get_mission_ctrl_legacy(msg): # supporting old naming conventions
-    return np.array([
-            msg.hw_enable,
-            msg.offboard_enable,
-            msg.takeoff,
-            msg.land,
-            msg.geofence,
-            msg.pac_offboard_only,
-            msg.pac_lpac_l1,
-            msg.pac_lpac_l2
-            ], dtype = bool)
-
-def get_mission_ctrl(msg):
-    return np.array([
-            msg.hw_enable,
-            msg.ob_enable,
-            msg.ob_takeoff,
-            msg.ob_land,
-            msg.geofence,
-            msg.pac_offboard_only,
-            msg.pac_lpac_l1,
-            msg.pac_lpac_l2
-            ], dtype = bool)
-
-def get_all_robot_positions(msg) -> coverage_control.PointVector:
-    positions = []
-    for i in range(0, len(msg.positions), 2):
-        positions.append([msg.positions[i], msg.positions[i + 1]])
-    return np.array((positions))
-
-def extract_bag(filepath: str, save: bool = True) -> dict:
+        entry = {timestamp: data}
+    return bound.namespace, bound.topic_name, entry
+
+def _init_decoder(typs: dict, connections: dict, fast: bool, handler_modules: list[str]):
+    # Workers get the custom message definitions registered in the parent's typestore
+    # and the handler modules it loaded
+    global _worker_connections, _worker_fast
+    typestore.register(typs)
+    msg_handlers.load_handlers(handler_modules)
+    _worker_connections = connections
+    _worker_fast = fast
+
+def _decode_batch(batch: list[tuple]) -> list:
+    return decode_batch([(_worker_connections[conn_id], timestamp, rawdata) for conn_id, timestamp, rawdata in batch],
+                        _worker_fast)
+
+def extract_topic_profiled(connection, timestamp, rawdata, profiler: bag_profile.Profiler):
+    # extract_topic with deserialization and the msgtype handler timed separately
+    wall_start = time.perf_counter()
+    msg = typestore.deserialize_cdr(rawdata, connection.msgtype)
+    wall_mid = time.perf_counter()
+    result = convert_msg(connection, timestamp, msg)
+    profiler.add("deserialize", wall_mid - wall_start)
+    profiler.add("handler/" + connection.msgtype, time.perf_counter() - wall_mid)
+    return result
+
+def decode_batch(batch: list[tuple],
+                 fast: bool = True,
+                 profiler: bag_profile.Profiler | None = None
+                 ) -> list:
+    # extract_topic results for (connection, timestamp, rawdata) messages, in order.
+    # The handler is resolved once per connection; messages of types with a batch decoder
+    # are read straight from their CDR bytes (see cdr_fast.py), the rest go through the typestore.
+    results = [None] * len(batch)
+    by_connection = {}
+    for i, (connection, _, _) in enumerate(batch):
+        by_connection.setdefault(connection.id, []).append(i)
+    for idx in by_connection.values():
+        connection = batch[idx[0]][0]
+        bound = bind_handler(connection)
+        if bound is None:
+            continue
+        decoder = bound.decoder if fast else None
+        decoded = [None] * len(idx)
+        if decoder is not None:
+            wall_start = time.perf_counter()
+            decoded = decoder.decode([batch[i][2] for i in idx])
+            if profiler is not None:
+                profiler.add("fast/" + connection.msgtype, time.perf_counter() - wall_start, len(idx))
+        for i, item in zip(idx, decoded):
+            _, timestamp, rawdata = batch[i]
+            if item is not None:
+                t, data = item
+                results[i] = (bound.namespace, bound.topic_name, {timestamp if t is None else t: data})
+            elif profiler is not None:
+                results[i] = extract_topic_profiled(connection, timestamp, rawdata, profiler)
+            else:
+                results[i] = extract_topic(connection, timestamp, rawdata)
+    return results
+
+def batched(messages, batch_size: int):
+    batch = []
+    for message in messages:
+        batch.append(message)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def decode_messages(messages,
+                    connections: list,
+                    typs: dict,
+                    jobs: int = 1,
+                    batch_size: int = DECODE_BATCH_SIZE,
+                    fast: bool = True,
+                    handler_modules: list[str] = []
+                    ):
+    # Yields (timestamp, extract_topic result) in message order, decoding batch_size
+    # messages at a time. With jobs > 1 the raw messages are read here and decoded in a
+    # process pool, with at most 4 * jobs batches in flight.
+    if jobs <= 1:
+        profiler = bag_profile.active()
+        for batch in batched(messages, batch_size):
+            yield from zip([timestamp for _, timestamp, _ in batch], decode_batch(batch, fast, profiler))
+        return
+    raw = ((connection.id, timestamp, bytes(rawdata)) for connection, timestamp, rawdata in messages)
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_init_decoder,
+                             initargs=(typs, {c.id: c for c in connections}, fast, handler_modules)
+                             ) as pool:
+        pending = deque()
+        for batch in batched(raw, batch_size):
+            timestamps = [timestamp for _, timestamp, _ in batch]
+            pending.append((timestamps, pool.submit(_decode_batch, batch)))
+            while len(pending) >= 4 * jobs:
+                timestamps, future = pending.popleft()
+                yield from zip(timestamps, future.result())
+        while pending:
+            timestamps, future = pending.popleft()
+            yield from zip(timestamps, future.result())
+
+def is_unwindowed(connection) -> bool:
+    handler = msg_handlers.get_handler(connection.msgtype)
+    return (handler is not None and handler.unwindowed) or connection.topic.endswith("/global_map")
+
+def select_connections(connections: list,
+                       topics: list[str] | None = None,
+                       msgtypes: list[str] | None = None
+                       ) -> list:
+    # Topics are shell-style patterns matched against the full topic name (e.g. "/r*/pose")
+    selected = []
+    for conn in connections:
+        if not msg_handlers.is_supported(conn.msgtype):
+            continue
+        if msgtypes is not None and conn.msgtype not in msgtypes:
+            continue
+        if topics is not None and not any(fnmatch(conn.topic, pattern) for pattern in topics):
+            continue
+        selected.append(conn)
+    return selected
+
+def mission_window(reader: Reader,
+                   padding: float = 0.
+                   ) -> tuple[int, int] | None:
+    # Bag-time window [takeoff, land] in ns from the mission_control edges.
+    # Only the mission_control connection is deserialized.
+    conns = [c for c in reader.connections if c.msgtype == MISSION_CONTROL_MSGTYPE]
+    if len(conns) == 0:
+        return None
+    mission_control_data = []
+    t_mission_control = []
+    for connection, timestamp, rawdata in reader.messages(connections=conns):
+        _, _, entry = extract_topic(connection, timestamp, rawdata)
+        for t, data in entry.items():
+            t_mission_control.append(t)
+            mission_control_data.append(data)
+    mission_control_data = np.array(mission_control_data)
+    t_mission_control = np.array(t_mission_control)
+    takeoff = np.diff(mission_control_data[:, 2].astype(int)) == 1
+    landing = np.diff(mission_control_data[:, 3].astype(int)) == 1
+    if not takeoff.any() or not landing.any():
+        return None
+    start_time, stop_time = time_align.experiment_window(mission_control_data, t_mission_control)
+    return int((start_time - padding) * 1e9), int((stop_time + padding) * 1e9)
+
+def save_trajectories(save_path: str):
+    # Dense (robots, T, 3) pose and velocity arrays next to the topics (see trajectories.py)
+    with bag_profile.stage("trajectories"):
+        saved = trajectories.save_trajectories(save_path)
+    if len(saved) > 0:
+        printC(f"Saved per-robot trajectories ({', '.join(saved)})", BLUE)
+
+def extract_bag(filepath: str,
+                save: bool = True,
+                fmt: str = "columnar",
+                topics: list[str] | None = None,
+                msgtypes: list[str] | None = None,
+                start: float | None = None,
+                stop: float | None = None,
+                use_mission_window: bool = False,
+                window_padding: float = 1.,
+                stream: bool = False,
+                memory_limit: int = bag_store.DEFAULT_MEMORY_LIMIT,
+                decode_jobs: int = 1,
+                fast_decode: bool = True,
+                handler_modules: list[str] = []
+                ) -> "dict | bag_store.BagStore":
+    # start/stop are seconds relative to the start of the recording.
+    # With stream=True decoded data is spilled to disk as it arrives (at most memory_limit
+    # bytes buffered) and the resulting columnar store is returned instead of the table.
+    # decode_jobs > 1 deserializes messages in a process pool; results keep the message order.
+    # fast_decode reads fixed-layout messages straight from their CDR bytes (see cdr_fast.py).
+    # handler_modules are imported first so they can register handlers for more message types.
     printC(f"Reading from {filepath}", BLUE)
     if filepath[-1] == "/": # Account for trailing slash
         filepath = filepath[:-1]
     split = filepath.split("/")
     filename = split[-1]
-    save_path = filepath + "/" + filename + ".pkl"
+    if fmt == "columnar":
+        save_path = bag_store.columnar_path(filepath, filename)
+    else:
+        save_path = filepath + "/" + filename + ".pkl"
+    if stream and (not save or fmt != "columnar"):
+        printC("Error: streaming extraction writes the columnar format and requires saving.", RED)
+        return {}
 
+    handler_modules = msg_handlers.load_handlers(handler_modules)
     with Reader(filepath) as reader:
         # Get any custom message definitions not included in the default typestore
         typs = {}
@@ -120,38 +286,106 @@ def extract_bag(filepath: str, save: bool = True) -> dict:
         printC("Found the following topics:", BLUE)
         hline()
         for connection in reader.connections:
-            print(connection.topic, connection.msgtype)
+            handler = msg_handlers.get_handler(connection.msgtype)
+            print(connection.topic, connection.msgtype, "->", handler.describe() if handler is not None else "unsupported")
         hline()
 
+        # Unselected connections are never read, let alone deserialized
+        connections = select_connections(reader.connections, topics, msgtypes)
+        if len(connections) == 0:
+            printC("Error: no supported topics match the given filters.", RED)
+            return {}
+        skipped = len(reader.connections) - len(connections)
+        if skipped > 0:
+            printC(f"Skipping {skipped} unsupported or filtered topics", YELLOW)
+
+        window_start = None if start is None else reader.start_time + int(start * 1e9)
+        window_stop = None if stop is None else reader.start_time + int(stop * 1e9)
+        if use_mission_window:
+            with bag_profile.stage("mission_window"):
+                window = mission_window(reader, window_padding)
+            if window is None:
+                printC("Warning: no takeoff/land edges in mission_control, reading the full bag", YELLOW)
+            else:
+                window_start, window_stop = window
+        if window_start is not None or window_stop is not None:
+            t0 = (window_start if window_start is not None else reader.start_time) - reader.start_time
+            t1 = (window_stop if window_stop is not None else reader.end_time) - reader.start_time
+            printC(f"Reading window [{t0 / 1e9:.2f}s, {t1 / 1e9:.2f}s] of the recording", BLUE)
+
+        # Mission control and the global map are needed by process regardless of the window.
+        # rosbags reads every connection when given none, so empty selections get no stream.
+        unwindowed = [c for c in connections if is_unwindowed(c)]
+        windowed = [c for c in connections if not is_unwindowed(c)]
+        streams = []
+        if len(unwindowed) > 0:
+            streams.append(reader.messages(connections=unwindowed))
+        if len(windowed) > 0:
+            streams.append(reader.messages(connections=windowed, start=window_start, stop=window_stop))
+        messages = streams[0] if len(streams) == 1 else heapq.merge(*streams, key=lambda m: m[1])
+
         table = {}
+        # Stacked topics (RobotPositions) are collected straight into a (T, N, 2) array sized by the message count
+        stacked = {tuple(topic_key(c.topic)): c.msgcount for c in connections
+                   if msg_handlers.get_handler(c.msgtype).stacked}
+        writer = bag_store.StreamingTableWriter(save_path, memory_limit) if stream else None
         cnt = 1
-        num_msgs = reader.message_count
+        num_msgs = sum(c.msgcount for c in connections)
         start_time = -1
         end_time = 0
-        for connection, timestamp, rawdata in reader.messages():
-            if start_time == -1:
-                start_time = timestamp
-            end_time = timestamp
-            result = extract_topic(connection, timestamp, rawdata)
-            sys.stdout.write(f"Processed {cnt}/{num_msgs} messages in the playback.\r")
-            sys.stdout.flush()
-            cnt+=1
-            if result is None:
-                continue
-            namespace, topic_name, entry = result
-            if namespace not in table.keys():
-                table[namespace] = {}
-            if topic_name not in table[namespace].keys():
-                table[namespace][topic_name] = entry
-            else:
-                table[namespace][topic_name].update(entry)
+        try:
+            with bag_profile.stage("messages"):
+                messages = bag_profile.timed("read", messages)
+                for timestamp, result in decode_messages(messages, connections, typs, decode_jobs,
+                                                            fast=fast_decode, handler_modules=handler_modules):
+                    if start_time == -1:
+                        start_time = timestamp
+                    end_time = timestamp
+                    sys.stdout.write(f"Processed {cnt}/{num_msgs} messages in the playback.\r")
+                    sys.stdout.flush()
+                    cnt+=1
+                    if result is None:
+                        continue
+                    namespace, topic_name, entry = result
+                    if writer is not None:
+                        for t, data in entry.items():
+                            writer.append(namespace, topic_name, t, data)
+                        continue
+                    if namespace not in table.keys():
+                        table[namespace] = {}
+                    if topic_name not in table[namespace].keys():
+                        if (namespace, topic_name) in stacked:
+                            table[namespace][topic_name] = bag_store.StackedTopic(stacked[(namespace, topic_name)])
+                            table[namespace][topic_name].update(entry)
+                        else:
+                            table[namespace][topic_name] = entry
+                    else:
+                        table[namespace][topic_name].update(entry)
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        bag_profile.count("messages", cnt - 1)
         elapsed_time = (end_time - start_time) / 1e9
         table["total_time"] = elapsed_time
         printC("\nDone!", GREEN)
         printC(f"Elapsed time {elapsed_time}s", RED)
+        if writer is not None:
+            printC(f"Finalizing {save_path} ({writer.num_flushes} spills to disk)...", BLUE, end="")
+            with bag_profile.stage("save"):
+                writer.close({"total_time": elapsed_time})
+            printC("Done!", GREEN)
+            save_trajectories(save_path)
+            return bag_store.BagStore(save_path)
         if save:
             printC(f"Saving to {save_path}...", BLUE, end="")
-            with open(save_path, "wb") as f:
-                pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+            with bag_profile.stage("save"):
+                if fmt == "columnar":
+                    bag_store.save_table(table, save_path)
+                else:
+                    with open(save_path, "wb") as f:
+                        pickle.dump(bag_store.plain_table(table), f, protocol=pickle.HIGHEST_PROTOCOL)
             printC("Done!", GREEN)
+            if fmt == "columnar":
+                save_trajectories(save_path)
         return table
@@ -0,0 +1,356 @@
+import os
+import json
+import pickle
+import shutil
+import numpy as np
+from numpy.typing import NDArray
+
+# Columnar on-disk layout for extracted bags:
+#   <bag>_columnar/meta.json
+#   <bag>_columnar/<namespace>/<topic>/t.npy        (T,) timestamps
+#   <bag>_columnar/<namespace>/<topic>/values.npy   (T, ...) stacked, or (sum N_i, ...) ragged
+#   <bag>_columnar/<namespace>/<topic>/offsets.npy  (T + 1,) row offsets, ragged topics only
+# Every array is a plain .npy so it can be memory-mapped topic by topic.
+
+FORMAT_VERSION = 1
+META_FILE = "meta.json"
+DEFAULT_MEMORY_LIMIT = 256 * 1024**2 # bytes of decoded data buffered before spilling to disk
+COPY_CHUNK_SIZE = 16 * 1024**2
+
+def columnar_path(bag_dir: str, bag_name: str) -> str:
+    return bag_dir + "/" + bag_name + "_columnar"
+
+def is_stackable(values: list[NDArray]) -> bool:
+    return len(values) > 0 and all(v.shape == values[0].shape for v in values)
+
+def save_topic(topic_dir: str,
+               t: NDArray,
+               values: list[NDArray]
+               ):
+    os.makedirs(topic_dir, exist_ok=True)
+    np.save(topic_dir + "/t.npy", np.asarray(t))
+    if is_stackable(values):
+        np.save(topic_dir + "/values.npy", np.stack(values))
+        return
+    lengths = [v.shape[0] if v.ndim > 0 else 1 for v in values]
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    np.save(topic_dir + "/values.npy", np.concatenate([np.atleast_1d(v) for v in values]))
+    np.save(topic_dir + "/offsets.npy", offsets)
+
+class StackedTopic:
+    # Collector for a topic of equally shaped arrays, used in place of the {timestamp: value}
+    # dict during extraction. Values are copied straight into a (capacity, N, ...) array
+    # preallocated from the message count; a duplicate timestamp overwrites its row, like
+    # dict.update. If N changes mid-recording (e.g. robots joining or dropping out) the array
+    # is widened, rows are padded with NaN and counts keeps each row's real N.
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self.t = None
+        self.values = None
+        self.counts = np.zeros(self.capacity, dtype=np.int64)
+        self.rows = {} # timestamp -> row
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def update(self, entry: dict):
+        for t, value in entry.items():
+            self.append(t, value)
+
+    def append(self, t, value: NDArray):
+        value = np.asarray(value)
+        if self.values is None:
+            self.t = np.empty(self.capacity, dtype=np.asarray(t).dtype)
+            self.values = np.full((self.capacity,) + value.shape, np.nan, dtype=value.dtype)
+        if value.shape[1:] != self.values.shape[2:] or value.dtype != self.values.dtype:
+            raise ValueError(f"Cannot stack {value.dtype}{value.shape} into {self.values.dtype}{self.values.shape[1:]}")
+        row = self.rows.get(t)
+        if row is None:
+            row = self.size
+            if row == self.values.shape[0]: # more messages than announced
+                self.resize(2 * row, self.values.shape[1])
+            self.rows[t] = row
+            self.t[row] = t
+            self.size += 1
+        if value.shape[0] > self.values.shape[1]:
+            self.resize(self.values.shape[0], value.shape[0])
+        self.values[row, :value.shape[0]] = value
+        self.values[row, value.shape[0]:] = np.nan
+        self.counts[row] = value.shape[0]
+
+    def resize(self, capacity: int, width: int):
+        values = np.full((capacity, width) + self.values.shape[2:], np.nan, dtype=self.values.dtype)
+        values[:self.size, :self.values.shape[1]] = self.values[:self.size]
+        t = np.empty(capacity, dtype=self.t.dtype)
+        t[:self.size] = self.t[:self.size]
+        counts = np.zeros(capacity, dtype=np.int64)
+        counts[:self.size] = self.counts[:self.size]
+        self.values, self.t, self.counts = values, t, counts
+
+    def arrays(self) -> tuple[NDArray, NDArray, NDArray[np.int64]]:
+        # (T,) timestamps, (T, N, ...) NaN-padded values and (T,) counts, in insertion order
+        return self.t[:self.size], self.values[:self.size], self.counts[:self.size]
+
+    def rows_list(self) -> list[NDArray]:
+        t, values, counts = self.arrays()
+        return [values[i, :counts[i]] for i in range(self.size)]
+
+    def to_dict(self) -> dict:
+        return dict(zip(self.arrays()[0].tolist(), self.rows_list()))
+
+def plain_table(table: dict) -> dict:
+    # The legacy pickle format only holds plain {timestamp: value} dicts
+    return {namespace: {topic: entries.to_dict() if isinstance(entries, StackedTopic) else entries
+                        for topic, entries in topics.items()} if isinstance(topics, dict) else topics
+            for namespace, topics in table.items()}
+
+def save_stacked_topic(topic_dir: str, entries: StackedTopic):
+    # Same files as save_topic on the equivalent dict
+    t, values, counts = entries.arrays()
+    if np.all(counts == values.shape[1]):
+        os.makedirs(topic_dir, exist_ok=True)
+        np.save(topic_dir + "/t.npy", t)
+        np.save(topic_dir + "/values.npy", values)
+        return
+    save_topic(topic_dir, t, entries.rows_list())
+
+def save_table(table: dict, path: str):
+    # table is the nested {namespace: {topic: {timestamp: ndarray}}} dict from extract_bag
+    if os.path.isdir(path):
+        shutil.rmtree(path) # drop topics left over from a previous extraction
+    os.makedirs(path)
+    meta = {"format_version": FORMAT_VERSION, "topics": {}}
+    for namespace, topics in table.items():
+        if not isinstance(topics, dict):
+            meta[namespace] = topics # scalar metadata such as total_time
+            continue
+        for topic, entries in topics.items():
+            if isinstance(entries, StackedTopic):
+                save_stacked_topic(path + "/" + namespace + "/" + topic, entries)
+            else:
+                t = np.array(list(entries.keys())) # int64 ns for bag timestamps, float64 s for header stamps
+                save_topic(path + "/" + namespace + "/" + topic, t, list(entries.values()))
+            meta["topics"].setdefault(namespace, []).append(topic)
+    with open(path + "/" + META_FILE, "w") as f:
+        json.dump(meta, f, indent=2)
+
+def convert_pkl(pkl_path: str, path: str):
+    with open(pkl_path, "rb") as f:
+        table = pickle.load(f)
+    save_table(table, path)
+
+def write_npy_header(f, dtype: np.dtype, shape: tuple[int, ...]):
+    header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": shape}
+    np.lib.format.write_array_header_1_0(f, header)
+
+def copy_bytes(src, dst, offset: int, size: int):
+    src.seek(offset)
+    while size > 0:
+        chunk = src.read(min(size, COPY_CHUNK_SIZE))
+        dst.write(chunk)
+        size -= len(chunk)
+
+def last_occurrences(t: NDArray) -> NDArray[np.int64] | None:
+    # Rows kept when entries are inserted one by one into a {t: value} dict:
+    # duplicate timestamps keep their first position but take the last value.
+    # None when every timestamp is unique.
+    _, first = np.unique(t, return_index=True)
+    if first.shape[0] == t.shape[0]:
+        return None
+    _, last_reversed = np.unique(t[::-1], return_index=True)
+    last = t.shape[0] - 1 - last_reversed
+    return last[np.argsort(first)]
+
+class TopicSpool:
+    # Append-only on-disk buffer for a single topic. Decoded values are kept in memory
+    # until flush(), then appended as raw C-order bytes next to their timestamps and
+    # leading-axis lengths. finalize() turns the spool into the save_topic layout.
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path)
+        self.t = []
+        self.values = []
+        self.nbytes = 0
+        self.t_dtype = None
+        self.dtype = None
+        self.ndim = None
+        self.row_shape = None # trailing shape shared by every value
+
+    def append(self, t, value: NDArray) -> int:
+        value = np.asarray(value)
+        if self.dtype is None:
+            self.t_dtype = np.asarray(t).dtype
+            self.dtype = value.dtype
+            self.ndim = value.ndim
+            self.row_shape = value.shape[1:]
+        elif value.dtype != self.dtype or value.ndim != self.ndim or value.shape[1:] != self.row_shape:
+            raise ValueError(f"Cannot stream {self.path}: value {value.dtype}{value.shape} does not match "
+                             f"{self.dtype}(N, {', '.join(map(str, self.row_shape))})")
+        self.t.append(t)
+        self.values.append(value)
+        size = value.nbytes + 16
+        self.nbytes += size
+        return size
+
+    def flush(self):
+        if len(self.t) == 0:
+            return
+        with open(self.path + "/t.bin", "ab") as f:
+            np.asarray(self.t, dtype=self.t_dtype).tofile(f)
+        with open(self.path + "/lengths.bin", "ab") as f:
+            np.array([v.shape[0] if v.ndim > 0 else 1 for v in self.values], dtype=np.int64).tofile(f)
+        with open(self.path + "/values.bin", "ab") as f:
+            for v in self.values:
+                f.write(np.ascontiguousarray(v).data)
+        self.t = []
+        self.values = []
+        self.nbytes = 0
+
+    def finalize(self, topic_dir: str):
+        # Same files as save_topic would write for the equivalent {t: value} dict
+        self.flush()
+        t = np.fromfile(self.path + "/t.bin", dtype=self.t_dtype)
+        lengths = np.fromfile(self.path + "/lengths.bin", dtype=np.int64)
+        row_nbytes = self.dtype.itemsize * int(np.prod(self.row_shape, dtype=np.int64))
+        starts = np.zeros(lengths.shape[0] + 1, dtype=np.int64)
+        np.cumsum(lengths, out=starts[1:])
+        keep = last_occurrences(t)
+        if keep is not None:
+            t = t[keep]
+            lengths = lengths[keep]
+        os.makedirs(topic_dir, exist_ok=True)
+        np.save(topic_dir + "/t.npy", t)
+        stackable = self.ndim == 0 or bool(np.all(lengths == lengths[0]))
+        if stackable:
+            shape = (t.shape[0],) + ((int(lengths[0]),) + self.row_shape if self.ndim > 0 else ())
+        else:
+            shape = (int(lengths.sum()),) + self.row_shape
+        with open(self.path + "/values.bin", "rb") as src, open(topic_dir + "/values.npy", "wb") as dst:
+            write_npy_header(dst, self.dtype, shape)
+            if keep is None:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+            else:
+                for i in keep:
+                    copy_bytes(src, dst, int(starts[i]) * row_nbytes, int(starts[i + 1] - starts[i]) * row_nbytes)
+        if not stackable:
+            offsets = np.zeros(lengths.shape[0] + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            np.save(topic_dir + "/offsets.npy", offsets)
+        shutil.rmtree(self.path)
+
+class StreamingTableWriter:
+    # Writes the columnar store incrementally, with at most memory_limit bytes of decoded
+    # values held in memory. Produces the same store as save_table on the full table.
+    def __init__(self, path: str, memory_limit: int = DEFAULT_MEMORY_LIMIT):
+        self.path = path
+        self.spool_path = path + ".partial"
+        self.memory_limit = memory_limit
+        self.spools = {}
+        self.buffered = 0
+        self.num_flushes = 0
+        if os.path.isdir(self.spool_path):
+            shutil.rmtree(self.spool_path) # left over from an interrupted extraction
+        os.makedirs(self.spool_path)
+
+    def append(self, namespace: str, topic: str, t, value: NDArray):
+        spool = self.spools.get((namespace, topic))
+        if spool is None:
+            spool = TopicSpool(self.spool_path + "/" + namespace + "/" + topic)
+            self.spools[(namespace, topic)] = spool
+        self.buffered += spool.append(t, value)
+        if self.buffered > self.memory_limit:
+            self.flush()
+
+    def flush(self):
+        for spool in self.spools.values():
+            spool.flush()
+        self.buffered = 0
+        self.num_flushes += 1
+
+    def close(self, metadata: dict):
+        # metadata holds scalar entries such as total_time
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        meta = {"format_version": FORMAT_VERSION, "topics": {}}
+        for (namespace, topic), spool in self.spools.items():
+            spool.finalize(self.path + "/" + namespace + "/" + topic)
+            meta["topics"].setdefault(namespace, []).append(topic)
+        meta.update(metadata)
+        with open(self.path + "/" + META_FILE, "w") as f:
+            json.dump(meta, f, indent=2)
+        shutil.rmtree(self.spool_path)
+
+    def abort(self):
+        if os.path.isdir(self.spool_path):
+            shutil.rmtree(self.spool_path)
+
+class BagStore:
+    def __init__(self, path: str, mmap: bool = True):
+        self.path = path
+        self.mmap_mode = "r" if mmap else None
+        with open(path + "/" + META_FILE, "r") as f:
+            self.meta = json.load(f)
+        if self.meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported columnar format version {self.meta['format_version']} in {path}")
+
+    @property
+    def total_time(self) -> float:
+        return self.meta["total_time"]
+
+    def namespaces(self) -> list[str]:
+        return list(self.meta["topics"].keys())
+
+    def topics(self, namespace: str) -> list[str]:
+        return self.meta["topics"].get(namespace, [])
+
+    def has_topic(self, namespace: str, topic: str) -> bool:
+        return topic in self.topics(namespace)
+
+    def load_topic(self,
+                   namespace: str,
+                   topic: str
+                   ) -> tuple[NDArray, NDArray | list[NDArray]]:
+        # Timestamps are small and often modified in place, so they are read into memory.
+        # Values stay memory-mapped; ragged topics come back as a list of views.
+        topic_dir = self.path + "/" + namespace + "/" + topic
+        t = np.load(topic_dir + "/t.npy")
+        values = np.load(topic_dir + "/values.npy", mmap_mode=self.mmap_mode)
+        if not os.path.isfile(topic_dir + "/offsets.npy"):
+            return t, values
+        offsets = np.load(topic_dir + "/offsets.npy")
+        return t, [values[offsets[i]:offsets[i + 1]] for i in range(t.shape[0])]
+
+def load_extracted(bag_dir: str, bag_name: str) -> "BagStore | dict":
+    # Prefer the columnar store, fall back to the legacy nested-dict pickle
+    path = columnar_path(bag_dir, bag_name)
+    if os.path.isfile(path + "/" + META_FILE):
+        return BagStore(path)
+    with open(bag_dir + "/" + bag_name + ".pkl", "rb") as f:
+        return pickle.load(f)
+
+def topic_arrays(bag: "BagStore | dict",
+                 namespace: str,
+                 topic: str
+                 ) -> tuple[NDArray, NDArray | list[NDArray]]:
+    # Uniform (timestamps, values) access for both the columnar store and legacy dicts
+    if isinstance(bag, BagStore):
+        return bag.load_topic(namespace, topic)
+    entries = bag[namespace][topic]
+    if isinstance(entries, StackedTopic):
+        t, values, counts = entries.arrays()
+        if np.all(counts == values.shape[1]):
+            return t.copy(), values
+        return t.copy(), entries.rows_list()
+    t = np.array(list(entries.keys())) # int64 ns for bag timestamps, float64 s for header stamps
+    values = list(entries.values())
+    if is_stackable(values):
+        return t, np.stack(values)
+    return t, values
+
+def bag_namespaces(bag: "BagStore | dict") -> list[str]:
+    if isinstance(bag, BagStore):
+        return bag.namespaces()
+    return [k for k, v in bag.items() if isinstance(v, dict)]
@@ -0,0 +1,192 @@
+import argparse
+import os
+import shutil
+import numpy as np
+from numpy.typing import NDArray
+from rosbags.rosbag2 import Writer
+from rosbags.typesys import Stores, get_typestore, get_types_from_msg
+from colors import *
+
+# Synthetic rosbag2 recordings shaped like the field bags baggy.py consumes:
+#   /mission_control            MissionControl, takeoff and land edges at 10% and 90% of the run
+#   /sim/all_robot_positions    RobotPositions, flat [x0, y0, x1, y1, ...]
+#   /sim/global_map             PointCloud2 (x, y, z, intensity) over every binned cell, once
+#   /sim/system_map             PointCloud2 of the explored cells, growing over time
+#   /r{i}/pose, /r{i}/vel       PoseStamped and TwistStamped per robot
+# Everything is seeded, so the same arguments always produce the same bag.
+
+MISSION_CONTROL_MSGDEF = """bool hw_enable
+bool ob_enable
+bool ob_takeoff
+bool ob_land
+bool geofence
+bool pac_offboard_only
+bool pac_lpac_l1
+bool pac_lpac_l2
+"""
+MISSION_CONTROL_LEGACY_MSGDEF = MISSION_CONTROL_MSGDEF.replace("ob_enable", "offboard_enable") \
+                                                      .replace("ob_takeoff", "takeoff") \
+                                                      .replace("ob_land", "land")
+ROBOT_POSITIONS_MSGDEF = """std_msgs/Header header
+float32[] positions
+"""
+MISSION_CONTROL_MSGTYPE = "async_pac_gnn_interfaces/msg/MissionControl"
+ROBOT_POSITIONS_MSGTYPE = "async_pac_gnn_interfaces/msg/RobotPositions"
+START_TIME = 1000. # seconds, header stamps and bag time share this clock
+
+def make_typestore(legacy_mission_control: bool = False):
+    typestore = get_typestore(Stores.ROS2_JAZZY)
+    mission_control = MISSION_CONTROL_LEGACY_MSGDEF if legacy_mission_control else MISSION_CONTROL_MSGDEF
+    typestore.register(get_types_from_msg(mission_control, MISSION_CONTROL_MSGTYPE))
+    typestore.register(get_types_from_msg(ROBOT_POSITIONS_MSGDEF, ROBOT_POSITIONS_MSGTYPE))
+    return typestore, mission_control
+
+class SyntheticBag:
+    def __init__(self, typestore):
+        self.types = typestore.types
+
+    def header(self, t: float):
+        ns = int(round(t * 1e9))
+        stamp = self.types["builtin_interfaces/msg/Time"](sec=ns // 1000000000, nanosec=ns % 1000000000)
+        return self.types["std_msgs/msg/Header"](stamp=stamp, frame_id="map")
+
+    def point_cloud(self, t: float, points: NDArray[np.float32]):
+        field = self.types["sensor_msgs/msg/PointField"]
+        fields = [field(name=name, offset=4 * i, datatype=7, count=1) for i, name in enumerate(["x", "y", "z", "intensity"])]
+        data = np.ascontiguousarray(points, dtype=np.float32).view(np.uint8).reshape(-1)
+        return self.types["sensor_msgs/msg/PointCloud2"](header=self.header(t),
+                                                         height=1,
+                                                         width=points.shape[0],
+                                                         fields=fields,
+                                                         is_bigendian=False,
+                                                         point_step=16,
+                                                         row_step=16 * points.shape[0],
+                                                         data=data,
+                                                         is_dense=True
+                                                         )
+
+    def pose(self, t: float, position: NDArray):
+        T = self.types
+        point = T["geometry_msgs/msg/Point"](x=float(position[0]), y=float(position[1]), z=2.)
+        orientation = T["geometry_msgs/msg/Quaternion"](x=0., y=0., z=0., w=1.)
+        return T["geometry_msgs/msg/PoseStamped"](header=self.header(t),
+                                                  pose=T["geometry_msgs/msg/Pose"](position=point, orientation=orientation)
+                                                  )
+
+    def twist(self, t: float, velocity: NDArray):
+        T = self.types
+        linear = T["geometry_msgs/msg/Vector3"](x=float(velocity[0]), y=float(velocity[1]), z=0.)
+        angular = T["geometry_msgs/msg/Vector3"](x=0., y=0., z=0.)
+        return T["geometry_msgs/msg/TwistStamped"](header=self.header(t),
+                                                   twist=T["geometry_msgs/msg/Twist"](linear=linear, angular=angular)
+                                                   )
+
+    def robot_positions(self, t: float, positions: NDArray):
+        return self.types[ROBOT_POSITIONS_MSGTYPE](header=self.header(t),
+                                                   positions=positions.astype(np.float32).reshape(-1)
+                                                   )
+
+    def mission_control(self, takeoff: bool, land: bool):
+        return self.types[MISSION_CONTROL_MSGTYPE](True, True, takeoff, land, True, False, True, False)
+
+def generate_bag(path: str,
+                 duration: float = 60.,
+                 num_robots: int = 4,
+                 pose_rate: float = 20.,
+                 map_rate: float = 2.,
+                 mission_rate: float = 1.,
+                 map_size: int = 512,
+                 binning_factor: int = 2,
+                 legacy_mission_control: bool = False,
+                 seed: int = 0,
+                 overwrite: bool = False
+                 ) -> int:
+    # Writes the bag at path (a rosbag2 directory) and returns the number of messages
+    if os.path.exists(path):
+        if not overwrite:
+            raise FileExistsError(f"{path} already exists")
+        shutil.rmtree(path)
+    rng = np.random.default_rng(seed)
+    typestore, mission_control_msgdef = make_typestore(legacy_mission_control)
+    synth = SyntheticBag(typestore)
+
+    cells = np.arange(0, map_size, binning_factor, dtype=np.float32)
+    xs, ys = np.meshgrid(cells, cells)
+    grid = np.stack([xs.ravel(), ys.ravel(), np.zeros(xs.size, dtype=np.float32), rng.random(xs.size, dtype=np.float32)], axis=1)
+    # Cells are explored in a fixed random order, so system maps grow monotonically
+    explore_order = rng.permutation(grid.shape[0])
+
+    margin = 0.1 * map_size
+    start = rng.uniform(margin, map_size - margin, (num_robots, 2))
+    amplitude = rng.uniform(0.05, 0.15, (num_robots, 2)) * map_size
+    phase = rng.uniform(0, 2 * np.pi, (num_robots, 2))
+    period = 0.5 * duration
+
+    num_steps = int(duration * pose_rate)
+    map_every = max(1, int(round(pose_rate / map_rate)))
+    mission_every = max(1, int(round(pose_rate / mission_rate)))
+    num_msgs = 0
+    with Writer(path, version=8) as writer:
+        conn_mission = writer.add_connection("/mission_control", MISSION_CONTROL_MSGTYPE,
+                                             typestore=typestore, msgdef=mission_control_msgdef)
+        conn_positions = writer.add_connection("/sim/all_robot_positions", ROBOT_POSITIONS_MSGTYPE,
+                                               typestore=typestore, msgdef=ROBOT_POSITIONS_MSGDEF)
+        conn_global = writer.add_connection("/sim/global_map", "sensor_msgs/msg/PointCloud2", typestore=typestore)
+        conn_system = writer.add_connection("/sim/system_map", "sensor_msgs/msg/PointCloud2", typestore=typestore)
+        conn_pose = [writer.add_connection(f"/r{i}/pose", "geometry_msgs/msg/PoseStamped", typestore=typestore)
+                     for i in range(num_robots)]
+        conn_vel = [writer.add_connection(f"/r{i}/vel", "geometry_msgs/msg/TwistStamped", typestore=typestore)
+                    for i in range(num_robots)]
+
+        def write(connection, t: float, msg):
+            nonlocal num_msgs
+            writer.write(connection, int(round(t * 1e9)), typestore.serialize_cdr(msg, connection.msgtype))
+            num_msgs += 1
+
+        for k in range(num_steps):
+            t_rel = k / pose_rate
+            t = START_TIME + t_rel
+            angle = 2 * np.pi * t_rel / period + phase
+            positions = np.clip(start + amplitude * np.sin(angle), 1, map_size - 1)
+            velocities = amplitude * 2 * np.pi / period * np.cos(angle)
+            if k == 0:
+                write(conn_global, t, synth.point_cloud(t, grid))
+            if k % mission_every == 0:
+                write(conn_mission, t, synth.mission_control(t_rel > 0.1 * duration, t_rel > 0.9 * duration))
+            write(conn_positions, t, synth.robot_positions(t, positions))
+            for i in range(num_robots):
+                write(conn_pose[i], t, synth.pose(t, positions[i]))
+                write(conn_vel[i], t, synth.twist(t, velocities[i]))
+            if k % map_every == 0:
+                num_explored = int(grid.shape[0] * (k + 1) / num_steps)
+                write(conn_system, t, synth.point_cloud(t, grid[np.sort(explore_order[:num_explored])]))
+    return num_msgs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="bag_synth.py",
+                                     description="Writes a synthetic rosbag2 recording for testing and benchmarking"
+                                     )
+    parser.add_argument("path", type=str, help="Output bag directory")
+    parser.add_argument("-t", "--duration", type=float, default=60., help="Recording length in seconds. default: 60")
+    parser.add_argument("-n", "--robots", type=int, default=4, help="Number of robots. default: 4")
+    parser.add_argument("--pose-rate", type=float, default=20., help="Pose/velocity rate in Hz. default: 20")
+    parser.add_argument("--map-rate", type=float, default=2., help="System map rate in Hz. default: 2")
+    parser.add_argument("--map-size", type=int, default=512, help="World map size in cells. default: 512")
+    parser.add_argument("--binning", type=int, default=2, help="Map binning factor. default: 2")
+    parser.add_argument("--legacy-mission-control", action="store_true", help="Use the old MissionControl field names")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed. default: 0")
+    parser.add_argument("--force", action="store_true", help="Overwrite an existing bag")
+    args = parser.parse_args()
+    printC(f"Writing {args.path}...", BLUE, end="")
+    num_msgs = generate_bag(args.path,
+                            duration=args.duration,
+                            num_robots=args.robots,
+                            pose_rate=args.pose_rate,
+                            map_rate=args.map_rate,
+                            map_size=args.map_size,
+                            binning_factor=args.binning,
+                            legacy_mission_control=args.legacy_mission_control,
+                            seed=args.seed,
+                            overwrite=args.force
+                            )
+    printC(f"Done! ({num_msgs} messages)", GREEN)
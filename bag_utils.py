@@ -3,90 +3,104 @@ import os
 import re
 import numpy as np
 from numpy.typing import NDArray
-import matplotlib.pyplot as plt
 import coverage_control
-from scipy import ndimage
 from colors import *
+from bag_store import BagStore, topic_arrays, bag_namespaces
+import time_align
+import trajectories
+from time_align import experiment_window # re-exported, lives with the other light helpers
+import bag_profile
+from system_maps import SystemMaps, bin_maps, zoom_maps
 
-def save_fig(fig: plt.Figure,
+def save_fig(fig: "matplotlib.figure.Figure", # matplotlib is not imported here, process does not need it
              figure_dir: str,
              filename_no_ext: str
              ):
     fig.savefig(figure_dir + "/" + filename_no_ext + ".pdf")
     fig.savefig(figure_dir + "/" + filename_no_ext + ".png")
 
-def get_robot_poses(bag_dict: dict) -> tuple[list[coverage_control.PointVector], NDArray[np.float32]]:
-    all_pose_data = bag_dict["sim"]["all_robot_positions"]
-    t_pos_arr = np.array(list(all_pose_data.keys()))
-    t_pos_arr = np.sort(t_pos_arr)
-    data_vec = [coverage_control.PointVector(np.clip(all_pose_data[t], 1, 511)) for t in t_pos_arr] # TODO: BAD!
-    return data_vec, t_pos_arr
+def get_robot_poses(bag: BagStore | dict,
+                    world_size: int = 512
+                    ) -> tuple[NDArray[np.float64], NDArray[np.float32]]:
+    # (T, R, 2) positions sorted by time, clipped to the interior of the world.
+    # Converted to PointVector only where CoverageSystem needs them.
+    t_pos_arr, all_pose_data = topic_arrays(bag, "sim", "all_robot_positions")
+    if isinstance(all_pose_data, list): # the robot count changed during the recording
+        counts = np.array([p.shape[0] for p in all_pose_data])
+        num_robots = np.bincount(counts).argmax()
+        keep = np.flatnonzero(counts == num_robots)
+        printC(f"Warning: robot count varies between {counts.min()} and {counts.max()}, "
+               f"keeping the {keep.shape[0]}/{counts.shape[0]} samples with {num_robots} robots", YELLOW)
+        t_pos_arr = t_pos_arr[keep]
+        all_pose_data = np.stack([all_pose_data[i] for i in keep])
+    order = np.argsort(t_pos_arr, kind="stable")
+    t_pos_arr = t_pos_arr[order]
+    robot_poses = np.asarray(all_pose_data, dtype=np.float64)[order]
+    np.clip(robot_poses, 1, world_size - 1, out=robot_poses)
+    return robot_poses, t_pos_arr
 
-def get_individual_poses_at_start(bag_dict: dict,
-                                  start_time: np.float64
+def get_individual_poses_at_start(bag: BagStore | dict,
+                                  start_time: np.float64,
+                                  world_size: int = 512
                                   ) -> dict:
-    # Extract the pose from each robot's namespace
-    start_pose_dict = {}
-    for k, v in bag_dict.items():
-        if re.match(k, r"r\d+"):
-            pose_dict = v["pose"]
-            t_pos_arr = np.array(list(pose_dict.keys()))
-            start_idx = np.argmin(np.abs(t_pos_arr - start_time))
-            start_pose = np.clip(pose_dict[t_pos_arr[start_idx]], 1, 511)
-            start_pose_dict[k] = start_pose
-    return start_pose_dict
+    # Pose of each robot's namespace nearest to start_time
+    poses = trajectories.load_trajectories(bag, "pose")
+    if poses is None:
+        return {}
+    start_poses = np.clip(poses.at(start_time), 1, world_size - 1)
+    return dict(zip(poses.robots, start_poses))
 
-def get_mission_control(bag_dict: dict) -> tuple[NDArray[np.float32], NDArray[np.float32]]:
-    mission_control_data = np.array(list(bag_dict["mission_control"]["mission_control"].values()))
-    t_mission_control = np.array(list(bag_dict["mission_control"]["mission_control"].keys()))
-    return mission_control_data, t_mission_control
+def get_mission_control(bag: BagStore | dict) -> tuple[NDArray[np.float32], NDArray[np.float32]]:
+    t_mission_control, mission_control_data = topic_arrays(bag, "mission_control", "mission_control")
+    return np.asarray(mission_control_data), t_mission_control
+
+def map_grid(cc_parameters: coverage_control.Parameters,
+             global_map: NDArray[np.float32]
+             ) -> tuple[int, int]:
+    map_size = int(cc_parameters.pWorldMapSize)
+    # The parameters do not carry the map binning, so infer it from the cell spacing
+    # of the global map, which covers every cell
+    x_cells = np.unique(global_map[:, 0].astype(int))
+    binning_factor = int(np.min(np.diff(x_cells))) if x_cells.shape[0] > 1 else 1
+    return map_size, binning_factor
+
+def upscale_maps(maps: list[NDArray[np.float32]] | NDArray[np.float32],
+                 map_size: int = 512,
+                 binning_factor: int = 2,
+                 order: int = 1,
+                 dtype: type = np.float32
+                 ) -> NDArray:
+    # Dense binned grids upscaled to (T, map_size, map_size)
+    return zoom_maps(bin_maps(maps, map_size, binning_factor), binning_factor, order, dtype)
 
 def upscale_map(map: NDArray[np.float32], map_size=512, binning_factor = 2, order=1):
-    # Assumes binning
-    x_coord = map[:, 0].astype(int) // binning_factor
-    y_coord = map[:, 1].astype(int) // binning_factor
-    val = map[:, 2]
-    dense_size = map_size // binning_factor
-    map_dense = np.full((dense_size, dense_size), np.nan) 
-    for i in range(map.shape[0]):
-        map_dense[y_coord[i], x_coord[i]] = val[i]
-    map_upscaled = np.clip(ndimage.zoom(map_dense, 2, order=order), 0, 1)
-    return map_upscaled
+    return upscale_maps([map], map_size, binning_factor, order, dtype=np.float64)[0]
 
-def get_maps(bag_dict: dict) -> tuple[NDArray[np.float32], NDArray[np.float32], NDArray[np.float32]]:
+def get_maps(bag: BagStore | dict,
+             cc_parameters: coverage_control.Parameters,
+             quantize: bool = True
+             ) -> tuple[NDArray[np.float32], SystemMaps, NDArray[np.float32]]:
     # Only need one global map
-    global_map = next(iter(bag_dict["sim"]["global_map"].values()), None)
+    _, global_maps = topic_arrays(bag, "sim", "global_map")
+    global_map = global_maps[0] if len(global_maps) > 0 else None
     if global_map is None:
         printC("Error: global map is none. Exiting...", RED)
         exit(1)
-    global_map_upscaled = upscale_map(global_map, order=3)
+    map_size, binning_factor = map_grid(cc_parameters, global_map)
+    with bag_profile.stage("upscale", items=1):
+        global_map_upscaled = upscale_map(global_map, map_size, binning_factor, order=3)
 
-    # System maps are indexed by timestep
-    system_maps = list(bag_dict["sim"]["system_map"].values())
-    t_system_maps = np.array(list(bag_dict["sim"]["system_map"].keys()))
-    system_maps_upscaled = np.zeros((len(t_system_maps), 512,512), dtype=np.float32) # TODO fix magic numbers
-    for i in range(system_maps_upscaled.shape[0]):
-        system_maps_upscaled[i] = upscale_map(system_maps[i])
-    return global_map_upscaled, system_maps_upscaled, t_system_maps
+    # System maps are indexed by timestep and kept binned; frames are upscaled on access
+    with bag_profile.stage("load_system_maps"):
+        t_system_maps, system_maps = topic_arrays(bag, "sim", "system_map")
+    with bag_profile.stage("bin", items=len(system_maps)):
+        system_maps_binned = SystemMaps.from_points(system_maps, map_size, binning_factor, quantize)
+    return global_map_upscaled, system_maps_binned, t_system_maps
 
 def align(arr: NDArray[np.float64], 
           val: np.float64
           ) -> np.int64:
-    return np.argmin(np.abs(arr - val))
-def experiment_window(mission_control_data: NDArray[bool], 
-                      t_mission_control: NDArray[np.float32]
-                      ) -> tuple[np.float64, np.float64]:
-    takeoff = mission_control_data[:,2]
-    landing = mission_control_data[:,3]
-
-    idx_start = np.argmax(np.diff(takeoff.astype(int)) == 1)
-    idx_stop = np.argmax(np.diff(landing.astype(int)) == 1)
-    assert idx_start < idx_stop
-
-    start_time = t_mission_control[idx_start] / 1e9
-    stop_time = t_mission_control[idx_stop] / 1e9
-    return start_time, stop_time
-
+    return time_align.nearest_index(arr, val)
 def create_cc_env(cc_parameters: coverage_control.Parameters,
                   idf_path: str,
                   robot_poses: coverage_control.PointVector
@@ -114,10 +128,3 @@ def create_pose_file(robot_poses: NDArray[np.float32],
             f.write(f"{i} {robot_poses[i,0]} {robot_poses[i,1]} 1.5708\n")
         f.close()
     printC("Done!", GREEN)
-
-def printC(msg: str, 
-           COLOR: str,
-           end: str = "\n",
-           flush: bool = True
-           ):
-    print(COLOR + msg + RESET, end=end, flush=flush)
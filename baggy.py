@@ -1,11 +1,18 @@
-import bag_reader
-import bag_process
-import bag_plotter
+import bag_store
+import bag_cache
+import bag_profile
+import msg_handlers
 import argparse
+import importlib
 import os
 import pickle
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout, redirect_stderr
+from dataclasses import dataclass
 from colors import *
-from bag_utils import printC
 
 import pdb
 
@@ -38,32 +45,368 @@ def load_bag(filepath: str):
         bag = pickle.load(f)
     return bag
 
+# Heavy modules each subcommand needs, imported only once it is known which one runs,
+# so --help, extract and convert never load matplotlib, seaborn, OpenCV, scipy or coverage_control
+STAGE_IMPORTS = {
+        "extract": ["bag_reader"],
+        "convert": [],
+        "process": ["bag_process"],
+        "plot": ["bag_plotter"],
+        "live": ["bag_live"],
+        "aggregate": ["bag_aggregate"]
+        }
+
+# Source modules whose code determines each stage's output (see bag_cache.code_hash)
+STAGE_MODULES = {
+        "extract": ["bag_reader", "bag_store", "time_align", "trajectories", "cdr_fast", "msg_handlers"],
+        "process": ["bag_process", "bag_store", "bag_utils", "bag_aggregate", "trajectories", "system_maps", "time_align"],
+        "plot": ["bag_plotter", "bag_utils", "colors", "system_maps", "time_align", "frame_render"]
+        }
+
+SKIPPED = "skipped"
+
+@dataclass
+class BagResult:
+    bag: str
+    ok: bool
+    elapsed: float
+    error: str = ""
+    data: object = None
+    skipped: bool = False
+
+def extracted_path(bag_dir: str, b: str) -> str:
+    # Mirrors bag_store.load_extracted: columnar store first, then the legacy pkl
+    path = bag_store.columnar_path(bag_dir, b)
+    if os.path.isdir(path):
+        return path
+    return bag_dir + "/" + b + ".pkl"
+
+def upstream_key(bag_dir: str, b: str, stage: str, output_path: str) -> str | None:
+    key = bag_cache.recorded_key(bag_dir, b, stage)
+    if key is not None:
+        return key
+    return bag_cache.path_fingerprint(output_path) # produced before the manifest existed
+
+def stage_inputs(args, b: str) -> tuple[dict, list[str]]:
+    # Hashed inputs and expected outputs of the stage selected by args.command
+    bag_dir = args.dir + "/" + b
+    inputs = {"code": bag_cache.code_hash(STAGE_MODULES[args.command])}
+    if args.command == "extract":
+        inputs["bag_metadata"] = bag_cache.file_hash(bag_dir + "/metadata.yaml")
+        inputs["options"] = {"format": args.format,
+                             "topics": args.topics,
+                             "msgtypes": args.msgtypes,
+                             "start": args.start,
+                             "stop": args.stop,
+                             "mission_window": args.mission_window,
+                             "window_padding": args.window_padding
+                             }
+        # Handler modules from outside the repo are part of the code version too
+        inputs["handlers"] = {m: bag_cache.file_hash(msg_handlers.module_source(m) or "")
+                              for m in msg_handlers.handler_modules(args.handlers)}
+        if args.format == "columnar":
+            outputs = [bag_store.columnar_path(bag_dir, b) + "/" + bag_store.META_FILE]
+        else:
+            outputs = [bag_dir + "/" + b + ".pkl"]
+    elif args.command == "process":
+        inputs["extract"] = upstream_key(bag_dir, b, "extract", extracted_path(bag_dir, b))
+        inputs["params"] = bag_cache.file_hash(args.params)
+        inputs["idf"] = bag_cache.file_hash(args.idf)
+        inputs["options"] = {"lossless_maps": args.lossless_maps,
+                             "cost_stride": args.cost_stride,
+                             "cost_map_rate": args.cost_map_rate,
+                             "cost_tolerance": args.cost_tolerance
+                             }
+        outputs = [bag_dir + "/" + b + "_processed.pkl", bag_dir + "/" + b + "_cost.npz"]
+    elif args.command == "plot":
+        inputs["process"] = upstream_key(bag_dir, b, "process", bag_dir + "/" + b + "_processed.pkl")
+        inputs["color"] = args.color
+        inputs["background"] = bag_cache.file_hash(args.background)
+        inputs["output"] = os.path.abspath(args.output)
+        inputs["highlight_color"] = highlight_color(args, b)
+        video = "_buckner.mp4" if args.background is not None else "_sys.mp4"
+        outputs = [args.output + "/" + b + video]
+    return inputs, outputs
+
+def highlight_color(args, b: str) -> str | None:
+    # Bags in the n-th --group get the n-th palette color as their system map frame
+    if not args.group:
+        return None
+    import bag_aggregate
+    groups = [bag_aggregate.parse_group(spec) for spec in args.group]
+    idx = bag_aggregate.group_index(args.dir, b, groups)
+    return None if idx is None else catpuccin_colors[idx % len(catpuccin_colors)]
+
+def is_cached_stage(args) -> bool:
+    # Combined plots need every bag loaded, so there is nothing to skip per bag
+    return args.command in STAGE_MODULES and not (args.command == "plot" and args.combine)
+
+def run_bag(args, b: str):
+    bag_dir = args.dir + "/" + b
+    if is_cached_stage(args):
+        inputs, outputs = stage_inputs(args, b)
+        key = bag_cache.stage_key(inputs)
+        if not args.force and bag_cache.is_fresh(bag_dir, b, args.command, key, outputs):
+            printC(f"{b}: {args.command} inputs unchanged, skipping (use --force to rerun)", YELLOW)
+            return SKIPPED
+
+    data = run_stage_profiled(args, b) if args.profile else run_stage(args, b)
+
+    if is_cached_stage(args):
+        bag_cache.record(bag_dir, b, args.command, key, inputs, outputs)
+    return data
+
+def import_stage(command: str) -> float:
+    # Returns the import time in seconds (0 when the modules are already loaded)
+    start = time.perf_counter()
+    for module in STAGE_IMPORTS[command]:
+        importlib.import_module(module)
+    return time.perf_counter() - start
+
+def run_stage(args, b: str):
+    if args.command == "extract":
+        import bag_reader
+        filepath = args.dir + "/" + b
+        bag_reader.extract_bag(filepath,
+                               save=True,
+                               fmt=args.format,
+                               topics=args.topics,
+                               msgtypes=args.msgtypes,
+                               start=args.start,
+                               stop=args.stop,
+                               use_mission_window=args.mission_window,
+                               window_padding=args.window_padding,
+                               stream=args.stream,
+                               memory_limit=int(args.memory_limit * 1024**2),
+                               decode_jobs=args.decode_jobs,
+                               fast_decode=not args.no_fast_decode,
+                               handler_modules=args.handlers
+                               )
+    elif args.command == "convert":
+        filedir = args.dir + "/" + b
+        pkl_path = filedir + "/" + b + ".pkl"
+        save_path = bag_store.columnar_path(filedir, b)
+        printC(f"Converting {pkl_path} to {save_path}...", BLUE, end="")
+        bag_store.convert_pkl(pkl_path, save_path)
+        printC("Done!", GREEN)
+    elif args.command == "process":
+        import bag_process
+        filedir = args.dir + "/" + b 
+        bag_dict = bag_store.load_extracted(filedir, b) # columnar store or pkl, both share name of bag dir
+        bag_process.process_bag(bag_dict,
+                                args.params,
+                                args.idf,
+                                filedir,
+                                b,
+                                save=True,
+                                lossless_maps=args.lossless_maps,
+                                cost_jobs=args.cost_jobs,
+                                cost_stride=args.cost_stride,
+                                cost_at_map_rate=args.cost_map_rate,
+                                cost_tolerance=args.cost_tolerance,
+                                cost_verify=args.cost_verify
+                                )
+    elif args.command == "plot":
+        import bag_plotter
+        filepath = args.dir + "/" + b + "/" + b + "_processed.pkl" # pkl file shares name of bag dir
+        bag_data = load_bag(filepath)
+        if args.combine:
+            return bag_data
+        bag_plotter.plot_bag(bag_data,
+                             args.output,
+                             args.color,
+                             background_map=args.background,
+                             render_jobs=args.render_jobs,
+                             highlight_color=highlight_color(args, b)
+                             )
+    return None
+
+def run_stage_profiled(args, b: str):
+    # Stage timings go to <bag>/<bag>_<command>_profile.{json,csv}, plus a cProfile or
+    # pyinstrument dump of --profile-dump's stage, e.g. "process/cost"
+    bag_dir = args.dir + "/" + b
+    prefix = bag_dir + "/" + b + "_" + args.command
+    dump_path = None
+    if args.profile_dump is not None:
+        dump_path = prefix + "_" + args.profile_dump.replace("/", "_")
+    profiler = bag_profile.start(args.profile_dump, dump_path, args.profile_backend)
+    try:
+        with bag_profile.stage(args.command):
+            return run_stage(args, b)
+    finally:
+        bag_profile.stop()
+        if os.path.isdir(bag_dir):
+            info = {"bag": b,
+                    "command": args.command,
+                    "import_s": args.import_time,
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+                    }
+            paths = profiler.write_report(prefix + "_profile", info)
+            print(profiler.summary())
+            printC(f"Profile written to {', '.join(paths)}", BLUE)
+
+def run_bag_safe(args, b: str, log_path: str | None = None) -> BagResult:
+    # Failures (including exit() calls deep in the pipeline) are recorded per bag
+    # so one bad bag does not abort the rest of the batch
+    start = time.perf_counter()
+    log = open(log_path, "w") if log_path is not None else None
+    try:
+        with redirect_stdout(log or sys.stdout), redirect_stderr(log or sys.stderr):
+            try:
+                data = run_bag(args, b)
+            except SystemExit as e:
+                return BagResult(b, False, time.perf_counter() - start, f"exit({e.code})")
+            except Exception as e:
+                traceback.print_exc()
+                return BagResult(b, False, time.perf_counter() - start, f"{type(e).__name__}: {e}")
+    finally:
+        if log is not None:
+            log.close()
+    if isinstance(data, str) and data == SKIPPED:
+        return BagResult(b, True, time.perf_counter() - start, skipped=True)
+    return BagResult(b, True, time.perf_counter() - start, data=data)
+
+def log_path_for(args, b: str) -> str | None:
+    bag_dir = args.dir + "/" + b
+    if not os.path.isdir(bag_dir):
+        return None # the bag will fail on its own, keep the error on the console
+    return bag_dir + "/" + b + "_" + args.command + ".log"
+
+def run_parallel(args, bags: list[str]) -> list[BagResult]:
+    # Each worker writes its progress to a per-bag log; only start/finish lines
+    # are printed here so the console stays readable
+    results = {}
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {}
+        for b in bags:
+            log_path = log_path_for(args, b)
+            printC(f"Begin {b} (log: {log_path})", BLUE)
+            futures[pool.submit(run_bag_safe, args, b, log_path)] = b
+        for cnt, future in enumerate(as_completed(futures), start=1):
+            b = futures[future]
+            try:
+                result = future.result()
+            except Exception as e: # worker died, e.g. BrokenProcessPool
+                result = BagResult(b, False, 0., f"{type(e).__name__}: {e}")
+            results[b] = result
+            if result.skipped:
+                printC(f"[{cnt}/{len(bags)}] {b} up to date, skipped", YELLOW)
+            elif result.ok:
+                printC(f"[{cnt}/{len(bags)}] {b} done in {result.elapsed:.1f}s", GREEN)
+            else:
+                printC(f"[{cnt}/{len(bags)}] {b} failed: {result.error}", RED)
+    return [results[b] for b in bags]
+
+def print_summary(results: list[BagResult]):
+    width = max([len(r.bag) for r in results] + [3])
+    print("-" * (width + 40))
+    print(f"{'bag':<{width}}  {'status':<6}  {'time (s)':>9}  error")
+    print("-" * (width + 40))
+    for r in results:
+        if r.skipped:
+            color, status = YELLOW, "cached"
+        else:
+            color = GREEN if r.ok else RED
+            status = "ok" if r.ok else "FAILED"
+        print(f"{r.bag:<{width}}  {color}{status:<6}{RESET}  {r.elapsed:>9.1f}  {r.error}")
+    print("-" * (width + 40))
+    num_failed = sum(not r.ok for r in results)
+    printC(f"{len(results) - num_failed}/{len(results)} bags succeeded", RED if num_failed else GREEN)
+
+def add_profile_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="Record wall time, CPU time, peak RSS and item counts per stage to <bag>_<command>_profile.{json,csv}"
+                        )
+    parser.add_argument("--profile-dump",
+                        type=str,
+                        default=None,
+                        help="Also dump a call profile of this stage, e.g. 'process/cost' or 'extract/messages' (implies --profile)"
+                        )
+    parser.add_argument("--profile-backend",
+                        type=str,
+                        choices=bag_profile.PROFILE_BACKENDS,
+                        default="cprofile",
+                        help="Profiler used for --profile-dump. default: cprofile"
+                        )
+
+def run_live(args):
+    # A single bag, either still being recorded (sqlite3 storage) or replayed from disk
+    import bag_live
+    bag_dir = args.dir + "/" + args.single
+    if args.replay:
+        source = bag_live.ReplaySource(bag_dir, args.rate)
+        printC(f"Replaying {bag_dir} at {args.rate}x", BLUE)
+    else:
+        source = bag_live.SqliteTailSource(bag_dir, args.idle_timeout)
+        printC(f"Following {bag_dir} (stops after {args.idle_timeout}s without new messages)", BLUE)
+    processor = bag_live.LiveProcessor(args.params,
+                                       args.idf,
+                                       args.output,
+                                       args.single,
+                                       bag_live.map_colors[args.color],
+                                       args.render_period
+                                       )
+    bag_live.run_live(source, processor, args.poll)
+    printC(f"Live outputs in {args.output}", BLUE)
+
+def run_aggregate(args):
+    # Reads only the cost curves, so no per-bag stage runs here
+    import bag_aggregate
+    groups = [bag_aggregate.parse_group(spec) for spec in args.group]
+    group_stats = bag_aggregate.aggregate_dir(args.dir,
+                                              groups,
+                                              args.output,
+                                              dt=args.dt,
+                                              percentiles=args.percentiles,
+                                              thresholds=args.thresholds,
+                                              horizon=args.horizon
+                                              )
+    if len(group_stats) == 0:
+        printC("Error: no group matched any processed bag. Exiting...", RED)
+        exit(1)
+    if not args.no_plot:
+        import bag_plotter
+        bag_plotter.plot_aggregate_cost(group_stats, args.output, (min(args.percentiles), max(args.percentiles)))
+
 def main(args):
+    if args.command == "live":
+        args.import_time = import_stage(args.command)
+        run_live(args)
+        return
+    if args.command == "aggregate":
+        run_aggregate(args)
+        return
+    if args.profile_dump is not None:
+        args.profile = True
+        if args.profile_backend == "pyinstrument":
+            try:
+                import pyinstrument
+            except ImportError:
+                printC("Error: --profile-backend pyinstrument requires the pyinstrument package. Exiting...", RED)
+                exit(1)
     bags = list_directories(args.dir, args.all, args.match, args.single)
-    data = []
-    for b in bags:
-        printC(f"Begin {b}", RED) 
-        if args.command == "extract":
-            filepath = args.dir + "/" + b
-            bag_dict = bag_reader.extract_bag(filepath, save=True)
-        elif args.command == "process":
-            filedir = args.dir + "/" + b 
-            filepath = filedir + "/" + b + ".pkl" # pkl file shares name of bag dir
-            bag_dict = load_bag(filepath)
-            bag_process.process_bag(bag_dict, args.params, args.idf, filedir, b, save=True)
-        elif args.command == "plot":
-            filepath = args.dir + "/" + b + "/" + b + "_processed.pkl" # pkl file shares name of bag dir
-            bag_data = load_bag(filepath)
-            data.append(bag_data)
-            if not args.combine:
-                bag_plotter.plot_bag(data[-1],
-                                     args.output,
-                                     args.color,
-                                     background_map=args.background
-                                     )
+    # Imported before any worker is forked, so the pool inherits the loaded modules
+    args.import_time = import_stage(args.command)
+    printC(f"Loaded {args.command} modules in {args.import_time:.2f}s", BLUE)
+    if args.jobs > 1 and len(bags) > 1:
+        results = run_parallel(args, bags)
+    else:
+        results = []
+        for b in bags:
+            printC(f"Begin {b}", RED) 
+            results.append(run_bag_safe(args, b))
+            if not results[-1].ok:
+                printC(f"{b} failed: {results[-1].error}", RED)
+    print_summary(results)
+
     if args.command == "plot" and args.combine:
-        bag_plotter.plot_combined_cost(data, args.output, args.color)
+        import bag_plotter
+        data = [r.data for r in results if r.ok]
+        bag_plotter.plot_combined_cost(data, args.output, args.color, render_jobs=args.render_jobs)
         bag_plotter.plot_combined_global_map(data, args.output, args.color)
+    if not all(r.ok for r in results):
+        exit(1)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="bag_plotter.py",
@@ -79,6 +422,83 @@ if __name__ == "__main__":
                                default="/workspace/bags",
                                help="Directory containing bag files. default: /workspace/bags"
                                )
+    parser_extractor.add_argument("-j",
+                                  "--jobs",
+                                  type=int,
+                                  default=1,
+                                  help="Number of bags to handle concurrently. default: 1"
+                                  )
+    parser_extractor.add_argument("--force",
+                                  action="store_true",
+                                  help="Rerun even if the inputs recorded in the bag's cache manifest are unchanged"
+                                  )
+    parser_extractor.add_argument("-f",
+                                  "--format",
+                                  type=str,
+                                  choices=["columnar", "pkl"],
+                                  default="columnar",
+                                  help="Output format: memory-mappable columnar directory or legacy pickle. default: columnar"
+                                  )
+    parser_extractor.add_argument("-t",
+                                  "--topics",
+                                  type=str,
+                                  nargs="+",
+                                  default=None,
+                                  help="Only extract topics matching these patterns, e.g. '/sim/*' '/r*/pose'. default: all supported"
+                                  )
+    parser_extractor.add_argument("--msgtypes",
+                                  type=str,
+                                  nargs="+",
+                                  default=None,
+                                  help="Only extract these message types, e.g. geometry_msgs/msg/PoseStamped. default: all supported"
+                                  )
+    parser_extractor.add_argument("--start",
+                                  type=float,
+                                  default=None,
+                                  help="Start of the time window in seconds from the beginning of the recording"
+                                  )
+    parser_extractor.add_argument("--stop",
+                                  type=float,
+                                  default=None,
+                                  help="End of the time window in seconds from the beginning of the recording"
+                                  )
+    parser_extractor.add_argument("-w",
+                                  "--mission-window",
+                                  action="store_true",
+                                  help="Only extract between the mission_control takeoff and land edges (overrides start/stop)"
+                                  )
+    parser_extractor.add_argument("--window-padding",
+                                  type=float,
+                                  default=1.,
+                                  help="Seconds of padding around the mission window. default: 1.0"
+                                  )
+    parser_extractor.add_argument("--decode-jobs",
+                                  type=int,
+                                  default=1,
+                                  help="Worker processes deserializing messages within each bag. default: 1"
+                                  )
+    parser_extractor.add_argument("--no-fast-decode",
+                                  action="store_true",
+                                  help="Deserialize every message through the typestore instead of reading "
+                                       "PoseStamped, TwistStamped and MissionControl straight from their bytes"
+                                  )
+    parser_extractor.add_argument("--handlers",
+                                  nargs="+",
+                                  default=[],
+                                  metavar="MODULE",
+                                  help="Import these modules first so they can register handlers for more message types "
+                                       f"(see msg_handlers.py), also read from ${msg_handlers.HANDLER_MODULES_ENV}"
+                                  )
+    parser_extractor.add_argument("--stream",
+                                  action="store_true",
+                                  help="Spill decoded data to disk while reading so memory stays bounded on long bags (columnar only)"
+                                  )
+    parser_extractor.add_argument("--memory-limit",
+                                  type=float,
+                                  default=bag_store.DEFAULT_MEMORY_LIMIT / 1024**2,
+                                  help=f"Decoded data buffered in memory before spilling, in MB (with --stream). default: {bag_store.DEFAULT_MEMORY_LIMIT // 1024**2}"
+                                  )
+    add_profile_args(parser_extractor)
     parser_ext_xor = parser_extractor.add_mutually_exclusive_group(required=True)
     parser_ext_xor.add_argument("-a", "--all", action="store_true", help="Process all bag files\
             in the given directory")
@@ -86,6 +506,26 @@ if __name__ == "__main__":
             contain a given substring")
     parser_ext_xor.add_argument("-s", "--single", type=str, help="Path to a specific bag file")
 
+    # Convert legacy pickles
+    parser_convert = subparsers.add_parser("convert", help="Convert extracted .pkl files to the columnar format")
+    parser_convert.add_argument("-d",
+                                "--dir",
+                                type=str,
+                                default="/workspace/bags",
+                                help="Directory containing bag files. default: /workspace/bags"
+                                )
+    parser_convert.add_argument("-j",
+                                "--jobs",
+                                type=int,
+                                default=1,
+                                help="Number of bags to handle concurrently. default: 1"
+                                )
+    add_profile_args(parser_convert)
+    parser_convert_xor = parser_convert.add_mutually_exclusive_group(required=True)
+    parser_convert_xor.add_argument("-a", "--all", action="store_true", help="Convert all bags in the given directory")
+    parser_convert_xor.add_argument("-m", "--match", type=str, help="Convert all bags that contain a given substring")
+    parser_convert_xor.add_argument("-s", "--single", type=str, help="Convert a specific bag")
+
     # Calculate Cost
     parser_cost = subparsers.add_parser("process", help="Process the raw bag output calculating coverage cost and maps")
     parser_cost.add_argument("-d",
@@ -114,6 +554,47 @@ if __name__ == "__main__":
                              help="Importance density function file.\
                                      default: /workspace/configs/penn_envs/10r_2.env"
                              )
+    parser_cost.add_argument("-j",
+                             "--jobs",
+                             type=int,
+                             default=1,
+                             help="Number of bags to handle concurrently. default: 1"
+                             )
+    parser_cost.add_argument("--force",
+                             action="store_true",
+                             help="Rerun even if the inputs recorded in the bag's cache manifest are unchanged"
+                             )
+    parser_cost.add_argument("--lossless-maps",
+                             action="store_true",
+                             help="Store system maps as binned float32 instead of uint8 (quantization error <= 0.002)"
+                             )
+    parser_cost.add_argument("--cost-jobs",
+                             type=int,
+                             default=1,
+                             help="Worker processes for the coverage cost, each with its own CoverageSystem. default: 1"
+                             )
+    parser_cost.add_argument("--cost-stride",
+                             type=int,
+                             default=1,
+                             help="Evaluate the cost every N pose samples and interpolate in between. default: 1"
+                             )
+    parser_cost.add_argument("--cost-map-rate",
+                             action="store_true",
+                             help="Evaluate the cost only at system map times (quick look), interpolating in between"
+                             )
+    parser_cost.add_argument("--cost-tolerance",
+                             type=float,
+                             default=None,
+                             help="Reuse the last evaluated cost while no robot has moved more than this many cells "
+                                  "(0 only skips exact repeats). default: evaluate every sample"
+                             )
+    parser_cost.add_argument("--cost-verify",
+                             type=int,
+                             default=0,
+                             help="With --cost-tolerance, evaluate this many reused samples exactly and report the "
+                                  "largest error. default: 0"
+                             )
+    add_profile_args(parser_cost)
     parser_cost_xor = parser_cost.add_mutually_exclusive_group(required=True)
     parser_cost_xor.add_argument("-a", "--all", action="store_true", help="Plot bags in the given directory")
     parser_cost_xor.add_argument("-m", "--match", type=str, help="Plot a subsection of bags in the directory")
@@ -165,11 +646,152 @@ if __name__ == "__main__":
                                 help="Path to a background image to system maps"
                                 )
 
+    parser_plotter.add_argument("-j",
+                                "--jobs",
+                                type=int,
+                                default=1,
+                                help="Number of bags to handle concurrently. default: 1"
+                                )
+    parser_plotter.add_argument("--force",
+                                action="store_true",
+                                help="Rerun even if the inputs recorded in the bag's cache manifest are unchanged"
+                                )
+    parser_plotter.add_argument("-r",
+                                "--render-jobs",
+                                type=int,
+                                default=1,
+                                help="Worker processes for rendering video frames. default: 1"
+                                )
+    parser_plotter.add_argument("-g",
+                                "--group",
+                                type=str,
+                                action="append",
+                                default=[],
+                                help="Experiment group LABEL=SELECTOR[,SELECTOR...], where a selector is a glob over bag names "
+                                     "or tag:NAME (listed in the bag's tags.txt). Bags in the n-th group get the n-th palette "
+                                     "color as their system map frame. Repeatable"
+                                )
+    add_profile_args(parser_plotter)
     parser_plot_xor = parser_plotter.add_mutually_exclusive_group(required=True)
     parser_plot_xor.add_argument("-a", "--all", action="store_true", help="Plot bags in the given directory")
     parser_plot_xor.add_argument("-m", "--match", type=str, help="Plot a subsection of bags in the directory")
     parser_plot_xor.add_argument("-s", "--single", type=str, help="Plot a specific bag file")
 
+    # Online
+    parser_live = subparsers.add_parser("live", help="Follow a bag while it is recorded (or replay one), updating cost and system map")
+    parser_live.add_argument("-d",
+                             "--dir",
+                             type=str,
+                             default="/workspace/bags",
+                             help="Directory containing bag files. default: /workspace/bags"
+                             )
+    parser_live.add_argument("-s",
+                             "--single",
+                             type=str,
+                             required=True,
+                             help="Bag to follow"
+                             )
+    parser_live.add_argument("-o",
+                             "--output",
+                             type=str,
+                             default="/workspace/figures",
+                             help="Output directory for the live cost, status and map. default: /workspace/figures"
+                             )
+    parser_live.add_argument("-p",
+                             "--params",
+                             type=str,
+                             default="/workspace/pt/models_256/coverage_control_params_512.toml",
+                             help="Coverage control parameters file.\
+                                     default: /workspace/pt/models_256/coverage_control_params_512.toml"
+                             )
+    parser_live.add_argument("-i",
+                             "--idf",
+                             type=str,
+                             default="/workspace/configs/penn_envs/10r_2.env",
+                             help="Importance density function file.\
+                                     default: /workspace/configs/penn_envs/10r_2.env"
+                             )
+    parser_live.add_argument("-c",
+                             "--color",
+                             type=str,
+                             default="red",
+                             help="Colorscheme to use for the system map. default: red"
+                             )
+    parser_live.add_argument("--replay",
+                             action="store_true",
+                             help="Replay a finished bag instead of following a recording"
+                             )
+    parser_live.add_argument("--rate",
+                             type=float,
+                             default=1.,
+                             help="Replay speed relative to real time, 0 for as fast as possible. default: 1"
+                             )
+    parser_live.add_argument("--poll",
+                             type=float,
+                             default=0.5,
+                             help="Seconds between updates. default: 0.5"
+                             )
+    parser_live.add_argument("--render-period",
+                             type=float,
+                             default=2.,
+                             help="Minimum seconds between system map images. default: 2"
+                             )
+    parser_live.add_argument("--idle-timeout",
+                             type=float,
+                             default=30.,
+                             help="Stop following after this many seconds without new messages. default: 30"
+                             )
+
+    # Statistics across runs
+    parser_aggregate = subparsers.add_parser("aggregate", help="Mean, percentile bands and time-to-threshold of the cost across runs")
+    parser_aggregate.add_argument("-d",
+                                  "--dir",
+                                  type=str,
+                                  default="/workspace/bags",
+                                  help="Directory containing bag files. default: /workspace/bags"
+                                  )
+    parser_aggregate.add_argument("-o",
+                                  "--output",
+                                  type=str,
+                                  default="/workspace/figures",
+                                  help="Output directory for the statistics and figure. default: /workspace/figures"
+                                  )
+    parser_aggregate.add_argument("-g",
+                                  "--group",
+                                  type=str,
+                                  action="append",
+                                  required=True,
+                                  help="Experiment group LABEL=SELECTOR[,SELECTOR...], where a selector is a glob over bag names "
+                                       "or tag:NAME (listed in the bag's tags.txt). Repeatable"
+                                  )
+    parser_aggregate.add_argument("--dt",
+                                  type=float,
+                                  default=0.1,
+                                  help="Spacing of the common time grid in seconds. default: 0.1"
+                                  )
+    parser_aggregate.add_argument("--percentiles",
+                                  type=float,
+                                  nargs="+",
+                                  default=[10., 50., 90.],
+                                  help="Percentiles of the cost across runs; the outer two are drawn as a band. default: 10 50 90"
+                                  )
+    parser_aggregate.add_argument("--thresholds",
+                                  type=float,
+                                  nargs="+",
+                                  default=[0.5],
+                                  help="Normalized costs to report time-to-threshold for. default: 0.5"
+                                  )
+    parser_aggregate.add_argument("--horizon",
+                                  type=str,
+                                  choices=["shortest", "longest"],
+                                  default="shortest",
+                                  help="Grid ends with the shortest run, or the longest with shorter runs dropping out. default: shortest"
+                                  )
+    parser_aggregate.add_argument("--no-plot",
+                                  action="store_true",
+                                  help="Only write the statistics, do not load matplotlib"
+                                  )
+
     #Execution
     args = parser.parse_args()
     main(args)
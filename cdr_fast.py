@@ -0,0 +1,134 @@
+import numpy as np
+from numpy.typing import NDArray
+
+# Batch decoding of fixed-layout messages straight from little-endian CDR bytes.
+# The byte layout of a message type is computed once from the typestore's field
+# definitions and compiled into a NumPy structured dtype, so a batch of same-size
+# messages is read with a single np.frombuffer instead of one deserialize_cdr call
+# and dataclass tree per message. A type qualifies when it only holds primitives and
+# nested messages plus at most one string (std_msgs/Header.frame_id); messages are
+# grouped by string length and size, one dtype each. Anything else, including
+# big-endian payloads, is left to the typestore. Which fields a message type reads is
+# declared by its handler in msg_handlers.py.
+
+CDR_LE = b"\x00\x01"
+PRIMITIVES = {
+        "bool": np.uint8, "byte": np.uint8, "char": np.uint8, "int8": np.int8, "uint8": np.uint8,
+        "int16": np.int16, "uint16": np.uint16, "int32": np.int32, "uint32": np.uint32,
+        "int64": np.int64, "uint64": np.uint64, "float32": np.float32, "float64": np.float64
+        }
+
+def flatten(fielddefs: dict, msgtype: str, prefix: str = "") -> list[tuple[str, str]] | None:
+    # [(path, primitive or "string")] in serialization order, None if not fixed-layout
+    fields = []
+    for name, (nodetype, desc) in fielddefs[msgtype][1]:
+        path = prefix + name
+        if nodetype.name == "BASE" and desc[0] in PRIMITIVES and desc[1] == 0:
+            fields.append((path, desc[0]))
+        elif nodetype.name == "BASE" and desc[0] == "string" and desc[1] == 0:
+            fields.append((path, "string"))
+        elif nodetype.name == "NAME":
+            nested = flatten(fielddefs, desc, path + ".")
+            if nested is None:
+                return None
+            fields.extend(nested)
+        else:
+            return None # arrays, sequences, bounded strings
+    return fields
+
+def align(offset: int, size: int) -> int:
+    return (offset + size - 1) // size * size
+
+def layout(fields: list[tuple[str, str]], string_length: int) -> dict[str, tuple[int, np.dtype]]:
+    # Byte offset (from the start of the raw message) and dtype of every field. CDR aligns
+    # primitives to their size relative to the payload, which starts after the 4-byte
+    # encapsulation header. string_length counts the terminating NUL like the wire format.
+    offsets = {}
+    offset = 0
+    for path, typename in fields:
+        if typename == "string":
+            offset = align(offset, 4)
+            offsets[path + ".length"] = (4 + offset, np.dtype("<u4"))
+            offset += 4 + string_length
+            continue
+        dtype = np.dtype(PRIMITIVES[typename]).newbyteorder("<")
+        offset = align(offset, dtype.itemsize)
+        offsets[path] = (4 + offset, dtype)
+        offset += dtype.itemsize
+    offsets["_end"] = (4 + offset, None)
+    return offsets
+
+class FastDecoder:
+    # Decoder for one connection's message type; dtypes are cached per (string length, size)
+    def __init__(self, fields: list[tuple[str, str]], outputs: list[str], out_dtype):
+        self.fields = fields
+        self.outputs = outputs
+        self.out_dtype = out_dtype
+        self.string = next((path for path, typename in fields if typename == "string"), None)
+        self.has_header = any(path == "header.stamp.sec" for path, _ in fields)
+        self.dtypes = {}
+        # Everything up to the string's length prefix is independent of the string length
+        self.string_offset = layout(fields, 0)[self.string + ".length"][0] if self.string is not None else None
+
+    def string_length(self, raw) -> int:
+        if self.string is None:
+            return 0
+        return int.from_bytes(raw[self.string_offset:self.string_offset + 4], "little")
+
+    def dtype(self, string_length: int, itemsize: int) -> np.dtype | None:
+        key = (string_length, itemsize)
+        if key not in self.dtypes:
+            offsets = layout(self.fields, string_length)
+            if offsets["_end"][0] > itemsize:
+                self.dtypes[key] = None # truncated, let the typestore report it
+            else:
+                names = self.outputs + (["header.stamp.sec", "header.stamp.nanosec"] if self.has_header else [])
+                self.dtypes[key] = np.dtype({"names": names,
+                                             "formats": [offsets[n][1] for n in names],
+                                             "offsets": [offsets[n][0] for n in names],
+                                             "itemsize": itemsize})
+        return self.dtypes[key]
+
+    def decode(self, raws: list) -> list[tuple[float | None, NDArray] | None]:
+        # Per message (header stamp in seconds or None, row), or None where the message
+        # has to go through the typestore. Messages are grouped by size and string length.
+        results = [None] * len(raws)
+        groups = {}
+        for i, raw in enumerate(raws):
+            if bytes(raw[:2]) != CDR_LE:
+                continue
+            groups.setdefault((self.string_length(raw), len(raw)), []).append(i)
+        for (string_length, itemsize), idx in groups.items():
+            dtype = self.dtype(string_length, itemsize)
+            if dtype is None:
+                continue
+            records = np.frombuffer(b"".join(raws[i] for i in idx), dtype=dtype)
+            rows = np.empty((len(idx), len(self.outputs)), dtype=self.out_dtype)
+            for j, name in enumerate(self.outputs):
+                rows[:, j] = records[name]
+            if self.has_header:
+                stamps = (records["header.stamp.sec"].astype(np.float64)
+                          + records["header.stamp.nanosec"].astype(np.float64) / 1e9).tolist()
+            else:
+                stamps = [None] * len(idx)
+            for j, i in enumerate(idx):
+                results[i] = (stamps[j], rows[j])
+        return results
+
+def make_decoder(fielddefs: dict, msgtype: str, outputs: list[str], out_dtype) -> FastDecoder | None:
+    # Decoder reading the outputs fields of msgtype into rows, None if it is not fixed-layout
+    if msgtype not in fielddefs:
+        return None
+    fields = flatten(fielddefs, msgtype)
+    if fields is None or sum(typename == "string" for _, typename in fields) > 1:
+        return None
+    names = [path for path, _ in fields]
+    if any(name not in names for name in outputs):
+        return None
+    return FastDecoder(fields, outputs, out_dtype)
+
+def fixed_layout(outputs: list[str], out_dtype):
+    # Batch decoder factory for a msg_handlers.MessageHandler
+    def factory(fielddefs: dict, msgtype: str) -> FastDecoder | None:
+        return make_decoder(fielddefs, msgtype, outputs, out_dtype)
+    return factory
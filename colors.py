@@ -4,6 +4,13 @@ YELLOW = "\033[33m"
 BLUE = "\033[34m"
 RESET = "\033[0m"
 
+def printC(msg: str, 
+           COLOR: str,
+           end: str = "\n",
+           flush: bool = True
+           ):
+    print(COLOR + msg + RESET, end=end, flush=flush)
+
 catpuccin_colors = [
     'rgba(239, 159, 118, 1.0)',  # Peach
     'rgba(166, 209, 137, 1.0)',  # Green
@@ -21,18 +28,3 @@ map_colors = {
     "buckner" : {"idf": "Reds", "robot": "orange", "robot_marker": "x"},
     "blue" : {"idf": "Blues", "robot": "red", "robot_marker": "X"}
 }
-
-#hacky_color_map = {
-#    "0621_10r_1_test1": 'rgba(239, 159, 118, 1.0)', # Peach
-#    "0621_10r_1_test5": 'rgba(166, 209, 137, 1.0)', # Green
-#    "0621_10r_1_test7": 'rgba(202, 158, 230, 1.0)', # Mauve
-#    "0621_10r_1_test4": 'rgba(133, 193, 220, 1.0)', # Sapphire
-#    "0621_10r_1_test6": 'rgba(231, 130, 132, 1.0)', # Red
-#    "0621_10r_1_test3": 'rgba(129, 200, 190, 1.0)', # Teal
-#}
-
-hacky_color_map = {
-    "0621_10r_1_test1": 'rgba(239, 159, 118, 1.0)', # Peach
-    "0621_10r_1_test3": 'rgba(166, 209, 137, 1.0)', # Green
-    "0621_10r_1_test7": 'rgba(202, 158, 230, 1.0)', # Mauve
-}
@@ -0,0 +1,127 @@
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from numpy.typing import NDArray
+import matplotlib
+import matplotlib.pyplot as plt
+import cv2
+from colors import *
+import bag_profile
+
+# Renders video frames straight from matplotlib's Agg buffer into cv2.VideoWriter,
+# optionally spread over a process pool. Frames are written in task order.
+#
+# A renderer is either a module-level function render_fn(context, *task) -> plt.Figure
+# that builds a fresh figure per frame, or a class constructed as Renderer(context) whose
+# render(*task) returns a BGR frame (used to reuse one figure across frames). Either way
+# it must be picklable, and the context is sent to each worker once.
+
+_worker_renderer = None
+
+def figure_to_frame(fig: plt.Figure) -> NDArray[np.uint8]:
+    # Same pixels as fig.savefig(png) at the figure dpi, as a BGR image for OpenCV
+    fig.canvas.draw()
+    rgba = np.asarray(fig.canvas.buffer_rgba())
+    return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+
+class VideoStream:
+    # cv2.VideoWriter that is opened with the size of the first frame
+    def __init__(self, video_name: str, fps: float = 10):
+        self.video_name = video_name
+        self.fps = fps
+        self.video = None
+        self.num_frames = 0
+
+    def write(self, frame: NDArray[np.uint8]):
+        if self.video is None:
+            height, width, _ = frame.shape
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+            self.video = cv2.VideoWriter(self.video_name, fourcc, self.fps, (width, height))
+        self.video.write(frame)
+        self.num_frames += 1
+
+    def release(self):
+        if self.video is not None:
+            self.video.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class FigureRenderer:
+    # Adapter for figure-per-frame functions
+    def __init__(self, render_fn, context: dict):
+        self.render_fn = render_fn
+        self.context = context
+
+    def render(self, *task) -> NDArray[np.uint8]:
+        fig = self.render_fn(self.context, *task)
+        frame = figure_to_frame(fig)
+        plt.close(fig)
+        return frame
+
+def make_renderer(render_fn, context: dict):
+    if isinstance(render_fn, type):
+        return render_fn(context)
+    return FigureRenderer(render_fn, context)
+
+def _init_worker(render_fn, context: dict, setup_fn=None):
+    global _worker_renderer
+    matplotlib.use("Agg")
+    if setup_fn is not None:
+        setup_fn() # e.g. the seaborn theme, which spawned workers do not inherit
+    _worker_renderer = make_renderer(render_fn, context)
+
+def _render_task(task: tuple) -> NDArray[np.uint8]:
+    return _worker_renderer.render(*task)
+
+def render_frames(render_fn,
+                  context: dict,
+                  tasks,
+                  jobs: int = 1,
+                  setup_fn=None,
+                  max_pending: int | None = None
+                  ):
+    # Yields rendered frames in task order. At most max_pending frames are in flight,
+    # so memory stays bounded when the consumer is slower than the workers.
+    if jobs <= 1:
+        renderer = make_renderer(render_fn, context)
+        for task in tasks:
+            yield renderer.render(*task)
+        return
+    if max_pending is None:
+        max_pending = 4 * jobs
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_init_worker,
+                             initargs=(render_fn, context, setup_fn)
+                             ) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(_render_task, task))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def render_video(render_fn,
+                 context: dict,
+                 tasks: list[tuple],
+                 video_name: str,
+                 fps: float = 10,
+                 jobs: int = 1,
+                 setup_fn=None,
+                 label: str = "video"
+                 ) -> int:
+    num_tasks = len(tasks)
+    with VideoStream(video_name, fps) as video:
+        frames = bag_profile.timed("render", render_frames(render_fn, context, tasks, jobs, setup_fn))
+        for i, frame in enumerate(frames):
+            printC(f"Rendering {label} frames ({i:06d} / {num_tasks:06d})...", BLUE, end="\r", flush=True)
+            wall_start = time.perf_counter()
+            video.write(frame)
+            bag_profile.add("encode", time.perf_counter() - wall_start)
+    printC("\nDone!", GREEN)
+    return video.num_frames
@@ -0,0 +1,206 @@
+import os
+import importlib
+import importlib.util
+from importlib.metadata import entry_points
+from dataclasses import dataclass
+from typing import Callable
+import numpy as np
+from numpy.typing import NDArray
+import cdr_fast
+
+# Registry of the message types extraction understands, msgtype -> MessageHandler.
+# A handler turns a deserialized message into the value stored at its timestamp, declares
+# the schema of that value and optionally a batch decoder that reads whole batches straight
+# from the CDR bytes (see cdr_fast.py). bag_reader resolves handlers once per connection.
+#
+# New message types do not need changes here: a module that calls register_handler when
+# imported is loaded with `baggy.py extract --handlers my_pkg.gps_handlers` or through
+# BAGGY_HANDLERS="mod_a,mod_b", and installed packages can expose such a module (or a
+# function that registers its handlers) under the "baggy.handlers" entry-point group.
+
+HANDLER_ENTRY_POINT_GROUP = "baggy.handlers"
+HANDLER_MODULES_ENV = "BAGGY_HANDLERS"
+
+MISSION_CONTROL_MSGTYPE = "async_pac_gnn_interfaces/msg/MissionControl"
+ROBOT_POSITIONS_MSGTYPE = "async_pac_gnn_interfaces/msg/RobotPositions"
+
+MISSION_CONTROL_FIELDS = ["hw_enable", "ob_enable", "ob_takeoff", "ob_land",
+                          "geofence", "pac_offboard_only", "pac_lpac_l1", "pac_lpac_l2"]
+MISSION_CONTROL_LEGACY_FIELDS = ["hw_enable", "offboard_enable", "takeoff", "land",
+                                 "geofence", "pac_offboard_only", "pac_lpac_l1", "pac_lpac_l2"]
+
+@dataclass(frozen=True)
+class MessageHandler:
+    msgtype: str
+    convert: Callable[[object], NDArray] # deserialized message -> stored value
+    # Output schema: dtype and shape of each stored value, None marks a variable-length axis
+    dtype: np.dtype
+    shape: tuple
+    # (fielddefs, msgtype) -> object with decode(raws) like cdr_fast.FastDecoder, or None
+    # when the recorded definition does not fit; consulted once per message definition
+    batch_decoder: Callable[[dict, str], object] | None = None
+    # (fielddefs, msgtype) -> convert, for types whose field names changed between recordings
+    select_convert: Callable[[dict, str], Callable[[object], NDArray]] | None = None
+    stacked: bool = False # collected into one bag_store.StackedTopic, e.g. the (T, N, 2) robot positions
+    unwindowed: bool = False # always read in full, process needs it regardless of the window
+
+    def converter(self, fielddefs: dict, msgtype: str) -> Callable[[object], NDArray]:
+        if self.select_convert is None:
+            return self.convert
+        return self.select_convert(fielddefs, msgtype)
+
+    def describe(self) -> str:
+        # e.g. "float64 (3,) batch", "float32 (N, 2)"
+        shape = ", ".join("N" if n is None else str(n) for n in self.shape) + ("," if len(self.shape) == 1 else "")
+        return f"{np.dtype(self.dtype).name} ({shape}){' batch' if self.batch_decoder is not None else ''}"
+
+HANDLERS: dict[str, MessageHandler] = {}
+_loaded_modules = [] # handler modules imported so far, handed to decode workers
+_entry_points_loaded = False
+
+def register_handler(handler: MessageHandler, replace: bool = False):
+    if handler.msgtype in HANDLERS and not replace and HANDLERS[handler.msgtype] is not handler:
+        raise ValueError(f"A handler for {handler.msgtype} is already registered (pass replace=True to override)")
+    HANDLERS[handler.msgtype] = handler
+
+def get_handler(msgtype: str) -> MessageHandler | None:
+    return HANDLERS.get(msgtype)
+
+def is_supported(msgtype: str) -> bool:
+    return msgtype in HANDLERS
+
+def field_names(fielddefs: dict, msgtype: str) -> list[str]:
+    if msgtype not in fielddefs:
+        return []
+    return [name for name, _ in fielddefs[msgtype][1]]
+
+def handler_modules(modules: list[str] | None = None) -> list[str]:
+    # The given module paths followed by those listed in BAGGY_HANDLERS
+    modules = list(modules) if modules is not None else []
+    modules += [m.strip() for m in os.environ.get(HANDLER_MODULES_ENV, "").split(",") if m.strip()]
+    return list(dict.fromkeys(modules))
+
+def module_source(module: str) -> str | None:
+    # Source file of a handler module without importing it, for cache keys
+    try:
+        spec = importlib.util.find_spec(module)
+    except (ImportError, ValueError):
+        return None
+    return spec.origin if spec is not None else None
+
+def load_handlers(modules: list[str] | None = None) -> list[str]:
+    # Imports handler modules given by path or BAGGY_HANDLERS and the "baggy.handlers"
+    # entry points, once each. Returns every module path loaded so far.
+    global _entry_points_loaded
+    for module in handler_modules(modules):
+        if module not in _loaded_modules:
+            importlib.import_module(module)
+            _loaded_modules.append(module)
+    if not _entry_points_loaded:
+        _entry_points_loaded = True
+        for entry_point in entry_points(group=HANDLER_ENTRY_POINT_GROUP):
+            loaded = entry_point.load()
+            if callable(loaded):
+                loaded()
+    return list(_loaded_modules)
+
+def get_position(msg):
+    return np.array([msg.pose.position.x, msg.pose.position.y, msg.pose.position.z])
+
+def get_vel(msg):
+    return np.array([msg.twist.linear.x, msg.twist.linear.y, msg.twist.linear.z])
+
+# sensor_msgs/PointField datatype constants -> numpy scalar types
+PC2_DATATYPES = {
+        1: np.int8,
+        2: np.uint8,
+        3: np.int16,
+        4: np.uint16,
+        5: np.int32,
+        6: np.uint32,
+        7: np.float32,
+        8: np.float64
+        }
+
+def pc2_dtype(msg: object) -> np.dtype:
+    # Structured dtype for a single point, built from the message layout
+    byte_order = ">" if msg.is_bigendian else "<"
+    names, formats, offsets = [], [], []
+    for field in msg.fields:
+        names.append(field.name)
+        formats.append(np.dtype(PC2_DATATYPES[field.datatype]).newbyteorder(byte_order))
+        offsets.append(field.offset)
+    return np.dtype({"names": names,
+                     "formats": formats,
+                     "offsets": offsets,
+                     "itemsize": msg.point_step
+                     })
+
+def pc2_to_structured(msg: object) -> NDArray:
+    # Zero-copy view over msg.data, one record per point
+    dtype = pc2_dtype(msg)
+    num_points = msg.width * msg.height
+    if msg.row_step == msg.width * msg.point_step:
+        return np.frombuffer(msg.data, dtype=dtype, count=num_points)
+    # Padded rows: drop the padding before viewing
+    rows = np.frombuffer(msg.data, dtype=np.uint8).reshape(msg.height, msg.row_step)
+    rows = np.ascontiguousarray(rows[:, :msg.width * msg.point_step])
+    return rows.view(dtype).reshape(num_points)
+
+def get_pc2(msg, field_names: tuple[str, ...] = ("x", "y", "intensity")) -> NDArray:
+    cloud = pc2_to_structured(msg)
+    out_dtype = np.result_type(*[cloud.dtype[name].newbyteorder("=") for name in field_names])
+    points_arr = np.empty((cloud.shape[0], len(field_names)), dtype=out_dtype)
+    for i, name in enumerate(field_names):
+        points_arr[:, i] = cloud[name]
+    return points_arr
+
+def get_mission_ctrl_legacy(msg): # supporting old naming conventions
+    return np.array([
+            msg.hw_enable,
+            msg.offboard_enable,
+            msg.takeoff,
+            msg.land,
+            msg.geofence,
+            msg.pac_offboard_only,
+            msg.pac_lpac_l1,
+            msg.pac_lpac_l2
+            ], dtype = bool)
+
+def get_mission_ctrl(msg):
+    return np.array([
+            msg.hw_enable,
+            msg.ob_enable,
+            msg.ob_takeoff,
+            msg.ob_land,
+            msg.geofence,
+            msg.pac_offboard_only,
+            msg.pac_lpac_l1,
+            msg.pac_lpac_l2
+            ], dtype = bool)
+
+def is_legacy_mission_ctrl(fielddefs: dict, msgtype: str) -> bool:
+    return "offboard_enable" in field_names(fielddefs, msgtype)
+
+def select_mission_ctrl(fielddefs: dict, msgtype: str):
+    return get_mission_ctrl_legacy if is_legacy_mission_ctrl(fielddefs, msgtype) else get_mission_ctrl
+
+def mission_ctrl_decoder(fielddefs: dict, msgtype: str) -> cdr_fast.FastDecoder | None:
+    fields = MISSION_CONTROL_LEGACY_FIELDS if is_legacy_mission_ctrl(fielddefs, msgtype) else MISSION_CONTROL_FIELDS
+    return cdr_fast.make_decoder(fielddefs, msgtype, fields, bool)
+
+def get_all_robot_positions(msg) -> NDArray:
+    # Flat [x0, y0, x1, y1, ...] float32 array reinterpreted as (N, 2), no copy
+    return np.asarray(msg.positions).reshape(-1, 2)
+
+for _handler in [
+        MessageHandler("geometry_msgs/msg/PoseStamped", get_position, np.float64, (3,),
+                       batch_decoder=cdr_fast.fixed_layout(["pose.position.x", "pose.position.y", "pose.position.z"], np.float64)),
+        MessageHandler("geometry_msgs/msg/TwistStamped", get_vel, np.float64, (3,),
+                       batch_decoder=cdr_fast.fixed_layout(["twist.linear.x", "twist.linear.y", "twist.linear.z"], np.float64)),
+        MessageHandler("sensor_msgs/msg/PointCloud2", get_pc2, np.float32, (None, 3)),
+        MessageHandler(MISSION_CONTROL_MSGTYPE, get_mission_ctrl, bool, (8,),
+                       batch_decoder=mission_ctrl_decoder, select_convert=select_mission_ctrl, unwindowed=True),
+        MessageHandler(ROBOT_POSITIONS_MSGTYPE, get_all_robot_positions, np.float32, (None, 2), stacked=True)
+        ]:
+    register_handler(_handler)
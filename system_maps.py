@@ -0,0 +1,117 @@
+import numpy as np
+from numpy.typing import NDArray
+from scipy import ndimage
+
+# Quantized storage: values in [0, 1] map to codes 0..QUANT_MAX, NAN_CODE marks unexplored cells
+QUANT_MAX = 254
+NAN_CODE = 255
+
+def scatter_indices(maps: list[NDArray[np.float32]] | NDArray[np.float32],
+                    binning_factor: int
+                    ) -> tuple[NDArray[np.int64], NDArray[np.int64], NDArray[np.int64], NDArray]:
+    # Flattens a stack of sparse (x, y, value) maps, shape (T, N, 3) or a list of (N_i, 3),
+    # into (frame, y_cell, x_cell, value) columns for a single scatter
+    num_maps = len(maps)
+    if isinstance(maps, np.ndarray) and maps.ndim == 3:
+        points = maps.reshape(-1, maps.shape[-1])
+        frame_idx = np.repeat(np.arange(num_maps), maps.shape[1])
+    else:
+        maps = [np.asarray(m).reshape(-1, 3) for m in maps]
+        points = np.concatenate(maps) if num_maps > 0 else np.empty((0, 3))
+        frame_idx = np.repeat(np.arange(num_maps), [m.shape[0] for m in maps])
+    x_coord = points[:, 0].astype(int) // binning_factor
+    y_coord = points[:, 1].astype(int) // binning_factor
+    return frame_idx, y_coord, x_coord, points[:, 2]
+
+def bin_maps(maps: list[NDArray[np.float32]] | NDArray[np.float32],
+             map_size: int = 512,
+             binning_factor: int = 2
+             ) -> NDArray[np.float64]:
+    dense_size = map_size // binning_factor
+    frame_idx, y_coord, x_coord, val = scatter_indices(maps, binning_factor)
+    map_dense = np.full((len(maps), dense_size, dense_size), np.nan)
+    map_dense[frame_idx, y_coord, x_coord] = val
+    return map_dense
+
+def zoom_maps(map_dense: NDArray,
+              binning_factor: int = 2,
+              order: int = 1,
+              dtype: type = np.float32
+              ) -> NDArray:
+    # Zoom frame by frame: a 3D zoom would interpolate (and, for order > 1, prefilter)
+    # across the time axis and mix neighbouring frames
+    num_maps, rows, cols = map_dense.shape
+    map_upscaled = np.empty((num_maps, rows * binning_factor, cols * binning_factor), dtype=dtype)
+    for i in range(num_maps):
+        ndimage.zoom(map_dense[i], binning_factor, output=map_upscaled[i], order=order)
+    np.clip(map_upscaled, 0, 1, out=map_upscaled)
+    return map_upscaled
+
+class SystemMaps:
+    # Compact stand-in for the dense (T, map_size, map_size) float32 stack of system maps.
+    # Frames are kept at the native binned resolution, optionally quantized to uint8,
+    # and are only dequantized and upscaled when indexed. Indexing mirrors the dense
+    # array: maps[i] is a 2D upscaled frame, maps[a:b] is another SystemMaps.
+    def __init__(self,
+                 binned: NDArray,
+                 binning_factor: int,
+                 order: int = 1
+                 ):
+        self.binned = binned
+        self.binning_factor = binning_factor
+        self.order = order
+
+    @classmethod
+    def from_points(cls,
+                    maps: list[NDArray[np.float32]] | NDArray[np.float32],
+                    map_size: int = 512,
+                    binning_factor: int = 2,
+                    quantize: bool = True
+                    ) -> "SystemMaps":
+        if not quantize:
+            return cls(bin_maps(maps, map_size, binning_factor).astype(np.float32), binning_factor)
+        dense_size = map_size // binning_factor
+        frame_idx, y_coord, x_coord, val = scatter_indices(maps, binning_factor)
+        binned = np.full((len(maps), dense_size, dense_size), NAN_CODE, dtype=np.uint8)
+        binned[frame_idx, y_coord, x_coord] = np.rint(np.clip(val, 0, 1) * QUANT_MAX).astype(np.uint8)
+        return cls(binned, binning_factor)
+
+    @property
+    def quantized(self) -> bool:
+        return self.binned.dtype == np.uint8
+
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        num_maps, rows, cols = self.binned.shape
+        return (num_maps, rows * self.binning_factor, cols * self.binning_factor)
+
+    @property
+    def nbytes(self) -> int:
+        return self.binned.nbytes
+
+    @property
+    def dense_nbytes(self) -> int:
+        # Size of the equivalent upscaled float32 stack
+        return int(np.prod(self.shape)) * np.dtype(np.float32).itemsize
+
+    def __len__(self) -> int:
+        return self.binned.shape[0]
+
+    def binned_frames(self, idx: int | slice) -> NDArray[np.float64]:
+        frames = self.binned[idx]
+        if not self.quantized:
+            return frames.astype(np.float64)
+        return np.where(frames == NAN_CODE, np.nan, frames / QUANT_MAX)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return SystemMaps(self.binned[idx], self.binning_factor, self.order)
+        frame = self.binned_frames(idx)
+        return zoom_maps(frame[np.newaxis], self.binning_factor, self.order)[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_dense(self) -> NDArray[np.float32]:
+        return zoom_maps(self.binned_frames(slice(None)), self.binning_factor, self.order)
@@ -0,0 +1,182 @@
+import struct
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import cdr_fast
+import msg_handlers
+
+# Parity checks for the structured-dtype PointCloud2 decoding in msg_handlers.get_pc2.
+# The reference is the read_points_list path used before it (needs sensor_msgs_py from a
+# ROS install); a struct-based reference covers the same layouts without ROS.
+
+FIELD_NAMES = ("x", "y", "intensity")
+FLOAT32 = 7
+
+def make_pc2(points: np.ndarray, is_bigendian: bool = False, point_step: int = 16) -> SimpleNamespace:
+    # x, y, z, intensity as float32 at offsets 0, 4, 8, 12, zero bytes after that
+    fields = [SimpleNamespace(name=name, offset=4 * i, datatype=FLOAT32, count=1)
+              for i, name in enumerate(("x", "y", "z", "intensity"))]
+    fmt = (">" if is_bigendian else "<") + "4f"
+    data = b"".join(struct.pack(fmt, *pt) + bytes(point_step - 16) for pt in points)
+    return SimpleNamespace(fields=fields,
+                           is_bigendian=is_bigendian,
+                           point_step=point_step,
+                           row_step=point_step * points.shape[0],
+                           width=points.shape[0],
+                           height=1,
+                           is_dense=True,
+                           data=data)
+
+def struct_reference(msg: SimpleNamespace) -> np.ndarray:
+    fmt = (">" if msg.is_bigendian else "<") + "f"
+    offsets = {field.name: field.offset for field in msg.fields}
+    return np.array([[struct.unpack_from(fmt, msg.data, i * msg.point_step + offsets[name])[0]
+                      for name in FIELD_NAMES]
+                     for i in range(msg.width * msg.height)], dtype=np.float32)
+
+LAYOUTS = [pytest.param(False, 16, id="little-endian"),
+           pytest.param(True, 16, id="big-endian"),
+           pytest.param(False, 32, id="padded-little-endian"),
+           pytest.param(True, 24, id="padded-big-endian")]
+
+@pytest.fixture
+def points() -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.uniform(-100, 100, size=(50, 4)).astype(np.float32)
+
+@pytest.mark.parametrize("is_bigendian, point_step", LAYOUTS)
+def test_get_pc2_matches_struct_reference(points, is_bigendian, point_step):
+    msg = make_pc2(points, is_bigendian, point_step)
+    result = msg_handlers.get_pc2(msg)
+    assert result.shape == (points.shape[0], 3)
+    np.testing.assert_array_equal(result, struct_reference(msg))
+    np.testing.assert_array_equal(result, points[:, [0, 1, 3]])
+
+@pytest.mark.parametrize("is_bigendian, point_step", LAYOUTS)
+def test_get_pc2_matches_read_points_list(points, is_bigendian, point_step):
+    point_cloud2 = pytest.importorskip("sensor_msgs_py.point_cloud2")
+    msg = make_pc2(points, is_bigendian, point_step)
+    expected = np.array(point_cloud2.read_points_list(msg, field_names=list(FIELD_NAMES)))
+    np.testing.assert_array_equal(msg_handlers.get_pc2(msg), expected)
+
+def test_get_pc2_empty_cloud():
+    msg = make_pc2(np.empty((0, 4), dtype=np.float32))
+    assert msg_handlers.get_pc2(msg).shape == (0, 3)
+
+# Batch decoders (cdr_fast) of the registered handlers, checked against
+# typestore.deserialize_cdr followed by the handler's converter
+
+MISSION_CONTROL_MSGDEF = """std_msgs/Header header
+bool hw_enable
+bool ob_enable
+bool ob_takeoff
+bool ob_land
+bool geofence
+bool pac_offboard_only
+bool pac_lpac_l1
+bool pac_lpac_l2
+"""
+MISSION_CONTROL_LEGACY_MSGDEF = """std_msgs/Header header
+bool hw_enable
+bool offboard_enable
+bool takeoff
+bool land
+bool geofence
+bool pac_offboard_only
+bool pac_lpac_l1
+bool pac_lpac_l2
+"""
+# Lengths 0-8 put the fields after frame_id at every offset modulo 8
+FRAME_IDS = ["", "a", "ab", "abc", "abcd", "map", "world", "odom_ned", "base_link_frd"]
+
+def make_typestore(mission_control_msgdef: str | None = None):
+    rosbags_typesys = pytest.importorskip("rosbags.typesys")
+    store = rosbags_typesys.get_typestore(rosbags_typesys.Stores.ROS2_JAZZY)
+    if mission_control_msgdef is not None:
+        store.register(rosbags_typesys.get_types_from_msg(mission_control_msgdef, msg_handlers.MISSION_CONTROL_MSGTYPE))
+    return store
+
+def make_header(store, i: int, frame_id: str):
+    return store.types["std_msgs/msg/Header"](
+            stamp=store.types["builtin_interfaces/msg/Time"](sec=1700000000 + i, nanosec=1000 * i + 7),
+            frame_id=frame_id)
+
+def make_pose(store, i: int, frame_id: str, rng):
+    types = store.types
+    x, y, z = rng.uniform(-1e3, 1e3, size=3)
+    return types["geometry_msgs/msg/PoseStamped"](
+            header=make_header(store, i, frame_id),
+            pose=types["geometry_msgs/msg/Pose"](
+                position=types["geometry_msgs/msg/Point"](x=x, y=y, z=z),
+                orientation=types["geometry_msgs/msg/Quaternion"](x=0., y=0., z=0., w=1.)))
+
+def make_twist(store, i: int, frame_id: str, rng):
+    types = store.types
+    v = rng.uniform(-10, 10, size=6)
+    return types["geometry_msgs/msg/TwistStamped"](
+            header=make_header(store, i, frame_id),
+            twist=types["geometry_msgs/msg/Twist"](
+                linear=types["geometry_msgs/msg/Vector3"](x=v[0], y=v[1], z=v[2]),
+                angular=types["geometry_msgs/msg/Vector3"](x=v[3], y=v[4], z=v[5])))
+
+def make_mission_control(store, i: int, frame_id: str, rng):
+    msgtype = msg_handlers.MISSION_CONTROL_MSGTYPE
+    names = [name for name, _ in store.fielddefs[msgtype][1] if name != "header"]
+    flags = rng.integers(0, 2, size=len(names)).astype(bool).tolist()
+    return store.types[msgtype](header=make_header(store, i, frame_id), **dict(zip(names, flags)))
+
+def assert_matches_typestore(store, msgtype: str, raws: list):
+    handler = msg_handlers.get_handler(msgtype)
+    decoder = handler.batch_decoder(store.fielddefs, msgtype)
+    assert decoder is not None
+    convert = handler.converter(store.fielddefs, msgtype)
+    results = decoder.decode(raws)
+    for raw, result in zip(raws, results):
+        assert result is not None
+        msg = store.deserialize_cdr(raw, msgtype)
+        stamp, row = result
+        assert stamp == msg.header.stamp.sec + msg.header.stamp.nanosec / 1e9
+        expected = convert(msg)
+        assert row.dtype == expected.dtype
+        np.testing.assert_array_equal(row, expected)
+
+CDR_CASES = [pytest.param("geometry_msgs/msg/PoseStamped", None, make_pose, id="pose"),
+             pytest.param("geometry_msgs/msg/TwistStamped", None, make_twist, id="twist"),
+             pytest.param(msg_handlers.MISSION_CONTROL_MSGTYPE, MISSION_CONTROL_MSGDEF, make_mission_control,
+                          id="mission-control"),
+             pytest.param(msg_handlers.MISSION_CONTROL_MSGTYPE, MISSION_CONTROL_LEGACY_MSGDEF, make_mission_control,
+                          id="mission-control-legacy")]
+
+@pytest.mark.parametrize("msgtype, msgdef, make_msg", CDR_CASES)
+def test_fast_decoder_matches_typestore(msgtype, msgdef, make_msg):
+    store = make_typestore(msgdef)
+    rng = np.random.default_rng(1)
+    # One batch mixing every frame_id length, so several layouts are decoded together
+    raws = [bytes(store.serialize_cdr(make_msg(store, i, frame_id, rng), msgtype))
+            for i, frame_id in enumerate(FRAME_IDS * 3)]
+    assert_matches_typestore(store, msgtype, raws)
+
+@pytest.mark.parametrize("msgtype, msgdef, make_msg", CDR_CASES)
+def test_fast_decoder_trailing_padding(msgtype, msgdef, make_msg):
+    # Recorders may pad the CDR payload; the padding must not shift any field
+    store = make_typestore(msgdef)
+    rng = np.random.default_rng(2)
+    raws = [bytes(store.serialize_cdr(make_msg(store, i, frame_id, rng), msgtype)) + bytes(padding)
+            for i, frame_id in enumerate(FRAME_IDS)
+            for padding in range(4)]
+    assert_matches_typestore(store, msgtype, raws)
+
+@pytest.mark.parametrize("msgtype, msgdef, make_msg", CDR_CASES)
+def test_fast_decoder_leaves_big_endian_to_typestore(msgtype, msgdef, make_msg):
+    store = make_typestore(msgdef)
+    rng = np.random.default_rng(3)
+    little = bytes(store.serialize_cdr(make_msg(store, 0, "map", rng), msgtype))
+    big = bytes(store.serialize_cdr(make_msg(store, 1, "map", rng), msgtype, little_endian=False))
+    results = msg_handlers.get_handler(msgtype).batch_decoder(store.fielddefs, msgtype).decode([little, big])
+    assert results[0] is not None
+    assert results[1] is None
+
+def test_fast_decoder_rejects_variable_layouts():
+    store = make_typestore()
+    assert cdr_fast.make_decoder(store.fielddefs, "sensor_msgs/msg/PointCloud2", ["height"], np.float64) is None
+    assert cdr_fast.make_decoder(store.fielddefs, "geometry_msgs/msg/PoseArray", ["header.frame_id"], np.float64) is None
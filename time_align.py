@@ -0,0 +1,78 @@
+import numpy as np
+from numpy.typing import NDArray
+
+# Time alignment on sorted timestamp arrays via np.searchsorted: O((N + M) log N)
+# instead of building an (M, N) distance matrix.
+# nearest_index matches np.argmin(np.abs(t - q)) exactly, including ties (first index wins).
+
+def is_sorted(t: NDArray) -> bool:
+    return t.shape[0] < 2 or bool(np.all(t[1:] >= t[:-1]))
+
+def _sorted_view(t: NDArray) -> tuple[NDArray, NDArray | None]:
+    # Unsorted inputs are aligned through a stable argsort and mapped back
+    t = np.asarray(t)
+    if is_sorted(t):
+        return t, None
+    order = np.argsort(t, kind="stable")
+    return t[order], order
+
+def nearest_index(t: NDArray, query) -> NDArray[np.int64] | np.int64:
+    t_sorted, order = _sorted_view(t)
+    q = np.asarray(query)
+    right = np.clip(np.searchsorted(t_sorted, q, side="left"), 1, t_sorted.shape[0] - 1)
+    left = right - 1
+    if t_sorted.shape[0] == 1:
+        idx = np.zeros(q.shape, dtype=np.int64)
+        return idx if idx.ndim > 0 else idx[()]
+    # Among equal timestamps argmin returns the first one, and on equal distances
+    # the one that comes first in the original array
+    left = np.searchsorted(t_sorted, t_sorted[left], side="left")
+    right = np.searchsorted(t_sorted, t_sorted[right], side="left")
+    if order is not None:
+        left, right = order[left], order[right]
+    t_arr = np.asarray(t)
+    dist_left = np.abs(t_arr[left] - q)
+    dist_right = np.abs(t_arr[right] - q)
+    take_left = (dist_left < dist_right) | ((dist_left == dist_right) & (left <= right))
+    idx = np.where(take_left, left, right)
+    return idx if idx.ndim > 0 else idx[()]
+
+def previous_index(t: NDArray, query) -> NDArray[np.int64] | np.int64:
+    # Last sample at or before the query, clamped to the first sample
+    t_sorted, order = _sorted_view(t)
+    q = np.asarray(query)
+    idx = np.clip(np.searchsorted(t_sorted, q, side="right") - 1, 0, t_sorted.shape[0] - 1)
+    if order is not None:
+        idx = order[idx]
+    return idx if idx.ndim > 0 else idx[()]
+
+def interpolate(t: NDArray, values: NDArray, query) -> NDArray:
+    # Linear interpolation of values (T, ...) along time, clamped at both ends
+    t_sorted, order = _sorted_view(t)
+    values = np.asarray(values)
+    if order is not None:
+        values = values[order]
+    q = np.asarray(query, dtype=np.float64)
+    if t_sorted.shape[0] == 1:
+        return np.broadcast_to(values[0], q.shape + values.shape[1:]).copy()
+    right = np.clip(np.searchsorted(t_sorted, q, side="right"), 1, t_sorted.shape[0] - 1)
+    left = right - 1
+    dt = t_sorted[right] - t_sorted[left]
+    w = np.clip(np.divide(q - t_sorted[left], dt, out=np.zeros_like(q), where=dt > 0), 0., 1.)
+    w = w.reshape(w.shape + (1,) * (values.ndim - 1))
+    return values[left] * (1. - w) + values[right] * w
+
+# Mission window in seconds between the first takeoff and land edges of mission_control
+def experiment_window(mission_control_data: NDArray[bool], 
+                      t_mission_control: NDArray[np.float32]
+                      ) -> tuple[np.float64, np.float64]:
+    takeoff = mission_control_data[:,2]
+    landing = mission_control_data[:,3]
+
+    idx_start = np.argmax(np.diff(takeoff.astype(int)) == 1)
+    idx_stop = np.argmax(np.diff(landing.astype(int)) == 1)
+    assert idx_start < idx_stop
+
+    start_time = t_mission_control[idx_start] / 1e9
+    stop_time = t_mission_control[idx_stop] / 1e9
+    return start_time, stop_time
@@ -0,0 +1,156 @@
+import os
+import re
+import json
+import numpy as np
+from numpy.typing import NDArray
+import time_align
+from bag_store import BagStore, topic_arrays, bag_namespaces
+
+# Dense per-robot trajectories built from the r<i>/pose and r<i>/vel topics.
+# Samples of every robot are packed into one (robots, T, 3) array. When all robots share
+# the same timestamps, t is (T,); otherwise t is (robots, T) with each row sorted, shorter
+# rows padded with +inf timestamps and NaN samples, and lengths gives the real sizes.
+#
+# Extraction writes them next to the topics of the columnar store:
+#   <bag>_columnar/_trajectories/<topic>/t.npy, values.npy, lengths.npy, robots.json
+
+TRAJECTORY_DIR = "_trajectories"
+TRAJECTORY_TOPICS = ["pose", "vel"]
+
+def robot_namespaces(bag: BagStore | dict) -> list[str]:
+    # r0, r1, ..., r10 in numeric order
+    robots = [k for k in bag_namespaces(bag) if re.fullmatch(r"r\d+", k)]
+    return sorted(robots, key=lambda k: int(k[1:]))
+
+class Trajectories:
+    def __init__(self,
+                 robots: list[str],
+                 t: NDArray[np.float64],
+                 values: NDArray[np.float64],
+                 lengths: NDArray[np.int64]
+                 ):
+        self.robots = robots
+        self.t = t
+        self.values = values
+        self.lengths = lengths
+
+    @classmethod
+    def from_samples(cls,
+                     robots: list[str],
+                     times: list[NDArray],
+                     samples: list[NDArray]
+                     ) -> "Trajectories":
+        # Per-robot (n_i,) timestamps and (n_i, 3) samples, in any order
+        order = [np.argsort(t, kind="stable") for t in times]
+        times = [np.asarray(t, dtype=np.float64)[o] for t, o in zip(times, order)]
+        samples = [np.asarray(s, dtype=np.float64)[o] for s, o in zip(samples, order)]
+        lengths = np.array([t.shape[0] for t in times], dtype=np.int64)
+        if all(t.shape == times[0].shape and np.array_equal(t, times[0]) for t in times):
+            return cls(robots, times[0], np.stack(samples), lengths)
+        num_samples = int(lengths.max())
+        t = np.full((len(robots), num_samples), np.inf)
+        values = np.full((len(robots), num_samples, 3), np.nan)
+        for i in range(len(robots)):
+            t[i, :lengths[i]] = times[i]
+            values[i, :lengths[i]] = samples[i]
+        return cls(robots, t, values, lengths)
+
+    @property
+    def num_robots(self) -> int:
+        return len(self.robots)
+
+    @property
+    def shared(self) -> bool:
+        return self.t.ndim == 1
+
+    def times(self, i: int) -> NDArray[np.float64]:
+        return self.t if self.shared else self.t[i, :self.lengths[i]]
+
+    def samples(self, i: int) -> NDArray[np.float64]:
+        return self.values[i, :self.lengths[i]]
+
+    def start(self) -> NDArray[np.float64]:
+        return self.values[:, 0]
+
+    def end(self) -> NDArray[np.float64]:
+        return self.values[np.arange(self.num_robots), self.lengths - 1]
+
+    def nearest_index(self, query) -> NDArray[np.int64]:
+        # (robots,) for a scalar query, (robots, Q) for an array of Q times
+        if self.shared:
+            idx = time_align.nearest_index(self.t, query)
+            return np.broadcast_to(idx, (self.num_robots,) + np.shape(idx)).copy()
+        return np.stack([np.asarray(time_align.nearest_index(self.times(i), query)) for i in range(self.num_robots)])
+
+    def at(self, query) -> NDArray[np.float64]:
+        # Nearest sample of every robot, (robots, 3) or (robots, Q, 3)
+        idx = self.nearest_index(query)
+        rows = np.arange(self.num_robots).reshape((-1,) + (1,) * (idx.ndim - 1))
+        return self.values[rows, idx]
+
+    def range_index(self, start: float, stop: float) -> NDArray[np.int64]:
+        # [first, last) sample indices per robot with start <= t < stop, shape (robots, 2)
+        if self.shared:
+            bounds = np.searchsorted(self.t, [start, stop], side="left")
+            return np.broadcast_to(bounds, (self.num_robots, 2)).copy()
+        first = (self.t < start).sum(axis=1) # rows are sorted and padded with +inf
+        last = (self.t < stop).sum(axis=1)
+        return np.stack([first, np.maximum(first, last)], axis=1)
+
+    def range(self, start: float, stop: float) -> "Trajectories":
+        bounds = self.range_index(start, stop)
+        if self.shared:
+            a, b = bounds[0]
+            return Trajectories(self.robots, self.t[a:b], self.values[:, a:b], np.full(self.num_robots, b - a))
+        return Trajectories.from_samples(self.robots,
+                                         [self.times(i)[a:b] for i, (a, b) in enumerate(bounds)],
+                                         [self.samples(i)[a:b] for i, (a, b) in enumerate(bounds)]
+                                         )
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        np.save(path + "/t.npy", self.t)
+        np.save(path + "/values.npy", self.values)
+        np.save(path + "/lengths.npy", self.lengths)
+        with open(path + "/robots.json", "w") as f:
+            json.dump(self.robots, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "Trajectories":
+        with open(path + "/robots.json", "r") as f:
+            robots = json.load(f)
+        return cls(robots,
+                   np.load(path + "/t.npy"),
+                   np.load(path + "/values.npy", mmap_mode="r" if mmap else None),
+                   np.load(path + "/lengths.npy")
+                   )
+
+def build_trajectories(bag: BagStore | dict, topic: str = "pose") -> Trajectories | None:
+    robots = [r for r in robot_namespaces(bag) if topic in (bag.topics(r) if isinstance(bag, BagStore) else bag[r])]
+    if len(robots) == 0:
+        return None
+    times, samples = [], []
+    for r in robots:
+        t, values = topic_arrays(bag, r, topic)
+        times.append(t)
+        samples.append(np.asarray(values).reshape(-1, 3))
+    return Trajectories.from_samples(robots, times, samples)
+
+def save_trajectories(store_path: str, topics: list[str] = TRAJECTORY_TOPICS) -> list[str]:
+    # Builds the trajectories of a freshly written columnar store, returns the saved topics
+    bag = BagStore(store_path)
+    saved = []
+    for topic in topics:
+        trajectories = build_trajectories(bag, topic)
+        if trajectories is not None:
+            trajectories.save(store_path + "/" + TRAJECTORY_DIR + "/" + topic)
+            saved.append(topic)
+    return saved
+
+def load_trajectories(bag: BagStore | dict, topic: str = "pose") -> Trajectories | None:
+    # Stored trajectories when extraction wrote them, otherwise built from the topics
+    if isinstance(bag, BagStore):
+        path = bag.path + "/" + TRAJECTORY_DIR + "/" + topic
+        if os.path.isfile(path + "/robots.json"):
+            return Trajectories.load(path)
+    return build_trajectories(bag, topic)